@@ -0,0 +1,216 @@
+"""
+An asyncio based engine for running NetDevices.
+
+Instead of the polling threads that start_device creates, every
+device is run as a set of coroutines on a single event loop.
+Coroutines only wake up when a socket has data or a queue has
+something on it, so idle devices cost nothing and thousands of
+devices can share one process.
+
+The devices themselves are unchanged, the engine only drives the
+prepare_send and process_msg hooks of NetDevice and the async
+methods of the device's transport.
+"""
+
+import asyncio
+from time import time
+from netdevice import SLEEP_TIME, MAX_BATCH, NetDevice
+from scheduler import Scheduler
+from msg import Msg, frame_size
+import log
+
+class AsyncEngine():
+    """
+    Runs a set of NetDevices as coroutines on one event loop.
+
+    Devices in the watch list are expected to have an exit
+    attribute (like nodes do), the engine returns from run once
+    all of them have set it.
+    """
+
+    def __init__(self, devices: list, watch: list = []) -> None:
+        self.devices = devices
+        self.watch = watch
+        self.tasks = []
+
+    def _check_done(self):
+        """
+        Wake up run if every watched device has finished.
+        """
+        if (all(x.exit for x in self.watch)):
+            self.done.set()
+
+    async def _get(self, q: Scheduler, wake: asyncio.Event,
+                   timeout: float = None) -> Msg:
+        """
+        Wait for the next frame on an output queue, wake is set
+        whenever a frame is put on it.
+        """
+        while (q.empty()):
+            wake.clear()
+            await asyncio.wait_for(wake.wait(), timeout)
+        return q.get_nowait()
+
+    async def _next_batch(self, dev: NetDevice, next_hop: int,
+                          wake: asyncio.Event) -> list:
+        """
+        Async version of NetDevice.next_batch.
+        """
+        q = dev.out_qs[next_hop]
+        batch = []
+        size = 0
+        msg = await self._get(q, wake)
+        deadline = time() + dev.flush_time
+        while (True):
+            if (dev.prepare_send(next_hop, msg)):
+                batch.append(msg)
+                size += frame_size(msg)
+            if (size >= MAX_BATCH):
+                break
+            try:
+                msg = await self._get(q, wake,
+                                      max(deadline - time(), 0))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _send_batch(self, dev: NetDevice, next_hop: int,
+                          batch: list):
+        """
+        Async version of NetDevice.send_batch.
+        """
+        if (not await dev.transport.asend(dev, next_hop, batch)):
+
+            # If sending fails, put msgs back on queue
+            # once the peer had some time to start
+
+            loop = asyncio.get_running_loop()
+            dev.metrics.inc("delayed_sends", next_hop, len(batch))
+            log.warn(log.SEND, "-- {} MSGS VIA PORT {:#x} ARE DELAYED",
+                     len(batch), next_hop)
+            for msg in batch:
+                loop.call_later(SLEEP_TIME, dev.put_send,
+                                next_hop, msg)
+            return
+
+        dev.metrics.inc("frames_sent", next_hop, len(batch))
+        if (dev.capture is not None):
+            dev.capture.sent(dev.clock(), next_hop, batch)
+        if (log.on(log.SEND, log.DEBUG)):
+            for msg in batch:
+                log.debug(log.SEND, ">> {} SENDS '{}{}' TO {} VIA PORT {:#x}",
+                          msg.src, "" if (msg.size) else "ACK:",
+                          str(msg.payload, "utf-8", "replace"),
+                          msg.dest, next_hop)
+
+    async def _send_loop(self, dev: NetDevice, next_hop: int,
+                         wake: asyncio.Event):
+        """
+        Coroutine version of NetDevice.send_loop.
+        """
+        await self.ready.wait()
+        while (True):
+            batch = await self._next_batch(dev, next_hop, wake)
+            if (batch):
+                await self._send_batch(dev, next_hop, batch)
+
+    async def _process_loop(self, dev: NetDevice):
+        """
+        Coroutine version of NetDevice.process_loop.
+        """
+        await self.ready.wait()
+        while (True):
+            wait = dev.tick()
+            if (getattr(dev, "exit", False)):
+                self._check_done()
+            try:
+                if (dev.rcv_q.empty()):
+                    in_port, in_msg = await asyncio.wait_for(
+                            dev.rcv_q.get(), wait)
+                else:
+                    in_port, in_msg = dev.rcv_q.get_nowait()
+            except asyncio.TimeoutError:
+                continue
+            dev.process_msg(in_port, in_msg)
+
+    async def start_device(self, dev: NetDevice):
+        """
+        Async version of NetDevice.start_device.
+        """
+
+        # Move anything recieved at creation time to an
+        # asyncio queue
+
+        old_rcv = dev.rcv_q
+        dev.rcv_q = asyncio.PriorityQueue()
+        while (not old_rcv.empty()):
+            dev.rcv_q.put_nowait(old_rcv.get())
+
+        await dev.transport.aopen(dev)
+
+        # One sender per output port, woken up by its queue
+
+        for next_hop, q in dev.out_qs.items():
+            wake = asyncio.Event()
+            q.on_put = wake.set
+            self.tasks.append(asyncio.create_task(
+                self._send_loop(dev, next_hop, wake)))
+        self.tasks.append(asyncio.create_task(
+            self._process_loop(dev)))
+
+    async def run(self, until=None):
+        """
+        Start all devices and wait for the watched ones to finish.
+
+        If until is given it is awaited after that, and the
+        devices keep running until it returns.
+        """
+        self.done = asyncio.Event()
+        self.ready = asyncio.Event()
+        start = time()
+        for dev in self.devices:
+            dev.transport.bind([dev])
+        for dev in self.devices:
+            await self.start_device(dev)
+
+        # Only start sending once every device is listening
+
+        self.ready.set()
+        log.info(log.SIM, "{} DEVICES READY IN {:.3f} SEC",
+                 len(self.devices), time() - start)
+        self._check_done()
+        await self.done.wait()
+        if (until is not None):
+            await until()
+
+        # Shutdown coroutines and ports
+
+        for task in self.tasks:
+            task.cancel()
+        for dev in self.devices:
+            dev.transport.close(dev)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+def run(devices: list, watch: list = []):
+    """
+    Runs the devices on a new event loop until all
+    watched devices are done.
+    """
+    asyncio.run(AsyncEngine(devices, watch).run())
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    class Sink(NetDevice):
+        exit = False
+        def process_msg(self, in_port, in_msg):
+            self.got = in_msg
+            self.exit = True
+
+    tmp = NetDevice([910], [911])
+    tmp2 = Sink([911], [910])
+    tmp.put_send(911, Msg(0, 0x12, 0x13, 4, 0, 0, "test"))
+    run([tmp, tmp2], [tmp2])
+    print(f"output: {tmp2.got}")
+    assert tmp2.got.data == "test"
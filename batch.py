@@ -0,0 +1,221 @@
+"""
+Batch versions of the msg codec for working with millions of
+frames at once (replay, load generation and offline analysis).
+
+Frames are handled as a packed buffer in the framing.py stream
+format. The header fields of all frames come back as one NumPy
+structured array, and the checksums of all frames are calculated
+together, one byte position at a time with the table of msg.CRC.
+Output is byte for byte the same as the per frame codec in msg.py.
+Only v1 headers are supported.
+
+NumPy is only needed for this module.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import msg
+from msg import HEADER, Msg
+from framing import FRAME_LEN
+
+# The 8 byte header, in wire order
+
+FIELDS = ("src", "dest", "crc", "size", "ordering", "priority",
+          "atype")
+HEADER_DTYPE = None if (np is None) else \
+        np.dtype([(x, ">u2" if (x == "crc") else "u1")
+                  for x in FIELDS])
+
+def _need_numpy():
+    if (np is None):
+        raise Exception("The batch module needs NumPy installed!")
+    if (msg.VERSION != 1):
+        raise Exception("The batch module only handles v1 headers!")
+
+def _crcs(data, starts, lengths):
+    """
+    The msg.CRC of every [start, start + length) range of data.
+    """
+    crc = msg.CRC
+    table = np.array(crc.table, np.uint32)
+    shift = np.uint32(crc.width - 8)
+    mask = np.uint32(crc.mask)
+    reg = np.full(len(starts), crc.init, np.uint32)
+    for i in range(int(lengths.max(initial=0))):
+        on = np.flatnonzero(lengths > i)
+        tmp = reg[on]
+        x = data[starts[on] + i]
+        if (crc.reflected):
+            reg[on] = table[(tmp ^ x) & 0xFF] ^ (tmp >> 8)
+        else:
+            reg[on] = table[((tmp >> shift) ^ x) & 0xFF] ^ \
+                    ((tmp << 8) & mask)
+    return reg ^ crc.xorout
+
+def _encode(msgs: list):
+    """
+    Pull the headers (with crcs) and payloads out of a list of Msgs.
+    Returns the header array, the joined payloads and their lengths.
+    """
+    _need_numpy()
+    ret = np.array([(m.src, m.dest, 0, m.size, m.ordering,
+                     m.priority, m.atype) for m in msgs],
+                   dtype=HEADER_DTYPE)
+    payloads = [m.payload for m in msgs]
+    lengths = np.fromiter(map(len, payloads), np.int64,
+                          len(payloads))
+    payloads = np.frombuffer(b''.join(payloads), np.uint8)
+    set_crcs(ret, payloads, lengths)
+
+    # Msgs that failed their check stay bad, like in msg.dumps
+
+    ret["crc"] ^= np.fromiter((not m.crc for m in msgs), np.uint16,
+                              len(msgs))
+    return (ret, payloads, lengths)
+
+def set_crcs(hdrs, payloads, lengths):
+    """
+    Fill in the crc field of a header array.
+    payloads holds the payloads of all frames back to back.
+    """
+    hdrs["crc"] = 0
+    data = np.frombuffer(pack_arrays(hdrs, payloads, lengths),
+                         np.uint8)
+    sizes = lengths + HEADER.size
+    starts = np.cumsum(sizes + FRAME_LEN.size) - sizes
+    hdrs["crc"] = _crcs(data, starts, sizes)
+
+def headers(msgs: list):
+    """
+    Get the header fields of a list of Msgs as a structured array,
+    with the crc of every frame filled in.
+    """
+    return _encode(msgs)[0]
+
+def dumps_batch(msgs: list) -> bytes:
+    """
+    Encode a list of Msgs to a packed buffer of frames, the same
+    as framing.pack([msg.dumps(x) for x in msgs]).
+    """
+    return pack_arrays(*_encode(msgs))
+
+def pack_arrays(hdrs, payloads, lengths) -> bytes:
+    """
+    Build a packed buffer of frames straight from a header array
+    (with crcs set), the payloads back to back and their lengths.
+    """
+    sizes = lengths + HEADER.size
+    ends = np.cumsum(sizes + FRAME_LEN.size)
+    starts = ends - sizes
+
+    # Fill in the length prefixes, headers and payloads
+
+    ret = np.empty(int(ends[-1]) if len(ends) else 0, np.uint8)
+    ret[starts - 2] = sizes >> 8
+    ret[starts - 1] = sizes & 0xFF
+    ret[starts[:, None] + np.arange(HEADER.size)] = \
+            hdrs.view(np.uint8).reshape(-1, HEADER.size)
+    src = np.cumsum(lengths) - lengths
+    ret[np.repeat(starts + HEADER.size - src, lengths)
+        + np.arange(len(payloads))] = payloads
+    return ret.tobytes()
+
+def index_batch(buf: bytes):
+    """
+    Find the frames in a packed buffer.
+    Returns arrays of the start and length of every frame.
+    """
+    _need_numpy()
+    starts = []
+    lengths = []
+    offset = 0
+    while (offset + FRAME_LEN.size <= len(buf)):
+        size, = FRAME_LEN.unpack_from(buf, offset)
+        offset += FRAME_LEN.size
+        if (offset + size > len(buf)):
+            break
+        starts.append(offset)
+        lengths.append(size)
+        offset += size
+    return (np.array(starts, np.int64), np.array(lengths, np.int64))
+
+def loads_batch(buf: bytes):
+    """
+    Decode the headers of every frame in a packed buffer.
+
+    Returns a tuple of:
+      - structured array of the header fields
+      - boolean mask, True where the checksum is good
+      - start and length of every frame in buf
+    """
+    starts, lengths = index_batch(buf)
+    data = np.frombuffer(buf, np.uint8)
+    full = lengths >= HEADER.size
+    hdrs = np.zeros(len(starts), dtype=HEADER_DTYPE)
+    hdrs[full] = data[starts[full, None] + np.arange(HEADER.size)] \
+            .copy().view(HEADER_DTYPE)[:, 0]
+
+    # The crc was calculated with its own field set to 0
+
+    tmp = data.copy()
+    tmp[starts[full] + msg.CRC_AT] = 0
+    tmp[starts[full] + msg.CRC_AT + 1] = 0
+    ok = (_crcs(tmp, starts, lengths) == hdrs["crc"]) & full
+    return (hdrs, ok, starts, lengths)
+
+def to_msgs(buf: bytes, hdrs, ok, starts, lengths) -> list:
+    """
+    Turn the output of loads_batch into Msg objects.
+    """
+    ret = []
+    view = memoryview(buf)
+    for h, good, start, size in zip(hdrs.tolist(), ok.tolist(),
+                                    starts.tolist(), lengths.tolist()):
+        src, dest, crc, size_f, ordering, priority, atype = h
+        tmp = Msg(priority, src, dest, size_f, atype, ordering, None,
+                  good)
+        tmp._payload = view[start + HEADER.size:start + size]
+        ret.append(tmp)
+    return ret
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    from framing import pack
+
+    tmp = [Msg(i % 2, 0x12, 0x21, len(str(i)) * i, 0, i % 256,
+               str(i) * i) for i in range(40)]
+    tmp[9].crc = False
+    b = dumps_batch(tmp)
+    assert b == pack([msg.dumps(x) for x in tmp])
+    assert not loads_batch(b)[1][9]
+    tmp[9].crc = True
+    b = dumps_batch(tmp)
+    hdrs, ok, starts, lengths = loads_batch(b)
+    print(f"headers: {hdrs[:3]}")
+    assert ok.all()
+    assert list(hdrs["ordering"]) == [x.ordering for x in tmp]
+
+    # Flip a bit in frames 5 and 7
+
+    bad = bytearray(b)
+    bad[starts[5] + HEADER.size] ^= 0x01
+    bad[starts[7] + 3] ^= 0x80 # In the crc
+    hdrs, ok, starts, lengths = loads_batch(bytes(bad))
+    assert ok.tolist() == [(i not in (5, 7)) for i in range(40)]
+
+    out = to_msgs(b, *loads_batch(b))
+    assert [x.data for x in out] == [x.data for x in tmp]
+
+    # Generate frames without any Msg objects
+
+    hdrs, ok, starts, lengths = loads_batch(b)
+    payloads = np.concatenate([np.frombuffer(b, np.uint8)[
+            x + HEADER.size:x + y] for x, y in zip(starts, lengths)])
+    hdrs["crc"] = 0
+    set_crcs(hdrs, payloads, lengths - HEADER.size)
+    assert pack_arrays(hdrs, payloads, lengths - HEADER.size) == b
@@ -0,0 +1,362 @@
+"""
+Benchmarks for the simulator.
+
+There are two parts:
+  - e2e → runs Main with a range of node counts and traffic
+    patterns, and measures recorded messages/s, send to ACK latency,
+    CPU time and peak RSS. Every run is done in its own forked process.
+  - micro → times the per frame hot paths (msg codec, crc, switch
+    table and firewall checks) in ns per call.
+
+Every benchmark is repeated and the best result is kept. Results are
+written as JSON (to bench_output.txt by default) and compared to a
+stored baseline. Any result that got worse by more than the
+tolerance is printed and makes the program exit with 1, and so does
+a missing baseline (unless --no-baseline is given). Everything runs
+offline on the local machine, the baseline has to be recorded on the
+machine it is compared on (and the tolerance raised on noisy ones):
+
+    python bench.py --save-baseline
+    python bench.py
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+from itertools import cycle
+from time import time
+import msg
+import hac
+
+NODES = [4, 16] # Node counts of the e2e runs
+PATTERNS = ["uniform", "pairs", "hotspot"]
+MSGS = 200 # Frames sent by every node
+TIMEOUT = 300 # Max sec of a single e2e run
+POLL_TIME = 0.5 # Sec between checks that an e2e run is alive
+REPEAT = 3 # Runs of every e2e benchmark
+NUMBER = 20000 # Calls per timing of a micro benchmark
+MICRO_REPEAT = 7 # Timings of every micro benchmark
+
+OUTPUT = "bench_output.txt"
+BASELINE = "bench_baseline.json"
+TOLERANCE = 0.3 # Allowed slowdown vs. the baseline
+
+# The results that are checked against the baseline, and if
+# bigger is better. Latency is reported but too noisy to check.
+
+CHECKS = {
+    "msgs_per_sec": True,
+    "cpu_s": False,
+    "peak_rss_kb": False,
+    "ns": False,
+}
+
+def node_names(num_nodes: int) -> list:
+    """
+    The HACs Main gives its nodes.
+    """
+    nets = cycle([1, 2])
+    return [f"{next(nets)}_{i}" for i in range(num_nodes)]
+
+def write_files(num_nodes: int, pattern: str, msgs: int,
+                seed: int = 0):
+    """
+    Write the node and firewall files of a run to the current
+    directory. Patterns:
+      - uniform → every frame goes to a random other node
+      - pairs → nodes only talk to their neighbour
+      - hotspot → everyone sends to node 0, which sends to everyone
+    """
+    rnd = random.Random(seed)
+    names = node_names(num_nodes)
+    for i, me in enumerate(names):
+        if (pattern == "uniform"):
+            dests = [x for x in names if (x != me)]
+        elif (pattern == "pairs"):
+            dests = [names[i ^ 1]]
+        elif (pattern == "hotspot"):
+            dests = names[1:] if (i == 0) else names[:1]
+        else:
+            raise Exception(f"Unknown pattern {pattern}!")
+        with open(f"node{me}.txt", "w") as f:
+            for k in range(msgs):
+                f.write(f"{rnd.choice(dests)}: frame {k} from {me}\n")
+    open("firewall.txt", "w").close()
+
+def percentile(data: list, p: float, scale: float = 1) -> float:
+    """
+    The p-th percentile of sorted data times scale, None if data is
+    empty.
+    """
+    if (not data):
+        return None
+    return data[min(int(len(data) * p / 100), len(data) - 1)] * scale
+
+def _e2e_run(conn, num_nodes: int, pattern: str, msgs: int,
+             engine: str, transport: str, shards: int):
+    """
+    The body of the process doing one e2e run.
+    """
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    try:
+        write_files(num_nodes, pattern, msgs)
+        sys.stdout = open(os.devnull, "w")
+        if (num_nodes - 1 > hac.FORMAT.max_dev):
+            hac.set_format(16, 16)
+
+        import main
+        sim = main.Main(num_nodes)
+        start = time()
+        sim.run_sim(engine, transport, shards)
+        wall = time() - start
+
+        me = resource.getrusage(resource.RUSAGE_SELF)
+        kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rtts = sorted(x for node in sim.nodes for x in node.rtts)
+        msgs = sum(x.rcv_msgs for x in sim.nodes)
+        conn.send({
+            "msgs": msgs,
+            "wall_s": wall,
+            "msgs_per_sec": msgs / wall,
+            "p50_ms": percentile(rtts, 50, 1000),
+            "p90_ms": percentile(rtts, 90, 1000),
+            "p99_ms": percentile(rtts, 99, 1000),
+            "cpu_s": (me.ru_utime + me.ru_stime
+                      + kids.ru_utime + kids.ru_stime),
+            "peak_rss_kb": max(me.ru_maxrss, kids.ru_maxrss),
+        })
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def e2e(num_nodes: int, pattern: str, msgs: int = MSGS,
+        engine: str = "thread", transport: str = "tcp",
+        shards: int = 1) -> dict:
+    """
+    Run one simulation in a new process and return its results.
+    """
+    ctx = mp.get_context("fork")
+    conn, child = ctx.Pipe()
+    job = ctx.Process(target=_e2e_run,
+                      args=(child, num_nodes, pattern, msgs, engine,
+                            transport, shards))
+    job.start()
+    child.close()
+    start = time()
+    while (not conn.poll(POLL_TIME)):
+        if (not job.is_alive()):
+            job.join()
+            raise Exception(f"e2e run of {num_nodes} nodes ({pattern})"
+                            f" died with exit code {job.exitcode}!")
+        if (time() - start > TIMEOUT):
+            job.terminate()
+            job.join()
+            raise Exception(f"e2e run of {num_nodes} nodes ({pattern})"
+                            f" took over {TIMEOUT} sec!")
+    try:
+        ret = conn.recv()
+    except EOFError:
+        job.join()
+        raise Exception(f"e2e run of {num_nodes} nodes ({pattern})"
+                        f" died with exit code {job.exitcode}!")
+    job.join()
+    return ret
+
+def micro(number: int = NUMBER) -> dict:
+    """
+    Time the per frame hot paths, in ns per call.
+    """
+    from netdevice import NetDevice
+    from switch import SwitchingTable
+    import crc
+
+    tmp = msg.Msg(0, 0x12, 0x21, 64, 0, 3, "x" * 64)
+    b = msg.dumps(tmp)
+    now = time()
+    st = SwitchingTable()
+    for i in range(1000):
+        st.learn(i, i % 8, now)
+    dev = NetDevice([0], [1], [0x20], [0x13])
+
+    cases = {
+        "dumps": lambda: msg.dumps(tmp),
+        "loads": lambda: msg.loads(b),
+        "loads_data": lambda: msg.loads(b).data,
+        "calc_crc": lambda: msg.calc_crc(b),
+        "crc8_table": lambda: crc.CRC8.calc(b),
+        "crc32": lambda: crc.CRC32.calc(b),
+        "switch_lookup": lambda: st.lookup(500, now),
+        "switch_learn": lambda: st.learn(500, 3, now),
+        "is_blocked": lambda: dev.is_blocked(tmp),
+    }
+    ret = dict()
+    for name, fn in cases.items():
+        best = min(timeit.repeat(fn, number=number,
+                                 repeat=MICRO_REPEAT))
+        ret[name] = {"ns": best / number * 1e9}
+    return ret
+
+def best(runs: list) -> dict:
+    """
+    Combine the results of repeated runs, keeping the best value of
+    every result.
+    """
+    ret = dict(runs[0])
+    for key in ret:
+        tmp = [x[key] for x in runs if (x[key] is not None)]
+        if (not tmp):
+            continue
+        ret[key] = max(tmp) if (CHECKS.get(key, False)) else min(tmp)
+    return ret
+
+def compare(results: dict, baseline: dict,
+            tolerance: float = TOLERANCE) -> list:
+    """
+    Find the results that are worse than the baseline by more
+    than tolerance. Returns a list of messages.
+    """
+    ret = []
+    for name, base in baseline.items():
+        cur = results.get(name, None)
+        if (cur is None):
+            continue
+        for key, bigger in CHECKS.items():
+            if ((base.get(key, None) is None)
+                    or (cur.get(key, None) is None)):
+                continue
+            if (bigger):
+                bad = (cur[key] < base[key] * (1 - tolerance))
+            else:
+                bad = (cur[key] > base[key] * (1 + tolerance))
+            if (bad):
+                ret.append(f"{name} {key}: {cur[key]:.4g}"
+                           f" (baseline {base[key]:.4g})")
+    return ret
+
+def run(args) -> dict:
+    """
+    Run the selected benchmarks.
+    Returns a dict of benchmark name → results.
+    """
+    ret = dict()
+    if (not args.skip_micro):
+        for name, res in micro(args.number).items():
+            ret[f"micro/{name}"] = res
+            print(f"micro/{name}: {res['ns']:.0f} ns")
+    if (not args.skip_e2e):
+        for num_nodes in args.nodes:
+            for pattern in args.patterns:
+                name = f"e2e/{pattern}/{num_nodes}"
+                res = best([e2e(num_nodes, pattern, args.msgs,
+                                args.engine, args.transport,
+                                args.shards)
+                            for i in range(args.repeat)])
+                ret[name] = res
+                print(f"{name}: {res['msgs_per_sec']:.0f} msgs/s,"
+                      f" p50 {res['p50_ms'] or 0:.2f} ms,"
+                      f" p99 {res['p99_ms'] or 0:.2f} ms,"
+                      f" cpu {res['cpu_s']:.2f} s,"
+                      f" rss {res['peak_rss_kb']} kB")
+    return ret
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    res = micro(10)
+    print(f"micro: {res}")
+    assert set(res) >= {"dumps", "loads", "calc_crc", "is_blocked"}
+
+    base = {"a": {"ns": 100, "msgs_per_sec": 1000},
+            "b": {"ns": 100}}
+    assert not compare({"a": {"ns": 110, "msgs_per_sec": 900}},
+                       base)
+    tmp = compare({"a": {"ns": 140, "msgs_per_sec": 600},
+                   "b": {"ns": 50}}, base)
+    print(f"regressions: {tmp}")
+    assert len(tmp) == 2
+
+    tmp = best([{"msgs_per_sec": 10, "cpu_s": 2},
+                {"msgs_per_sec": 20, "cpu_s": 3}])
+    assert tmp == {"msgs_per_sec": 20, "cpu_s": 2}
+    assert percentile([1, 2, 3, 4], 50) == 3
+    assert percentile([], 50) is None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, nargs='+', default=NODES,
+                        help='Node counts of the e2e runs.')
+    parser.add_argument('--patterns', nargs='+', default=PATTERNS,
+                        choices=PATTERNS,
+                        help='Traffic patterns of the e2e runs.')
+    parser.add_argument('--msgs', type=int, default=MSGS,
+                        help='Frames sent by every node.')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'],
+                        default='thread')
+    parser.add_argument('--transport',
+                        choices=['tcp', 'inproc', 'inproc-raw'],
+                        default='tcp')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='Runs of every e2e benchmark.')
+    parser.add_argument('--number', type=int, default=NUMBER,
+                        help='Calls per timing of a micro benchmark.')
+    parser.add_argument('--skip-e2e', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--out', default=OUTPUT,
+                        help='Where to write the results.')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the baseline.')
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='Do not fail if there is no baseline.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='Allowed slowdown, 0.3 is 30%%.')
+    args = parser.parse_args()
+
+    results = run(args)
+    out = {
+        "meta": {
+            "time": time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent=2)
+
+    if (args.save_baseline):
+        with open(args.baseline, "w") as f:
+            json.dump(out, f, indent=2)
+        print(f"BASELINE SAVED TO {args.baseline}")
+    elif (os.path.exists(args.baseline)):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        bad = compare(results, baseline, args.tolerance)
+        for x in bad:
+            print(f"!! REGRESSION {x}")
+        if (bad):
+            sys.exit(1)
+        print(f"NO REGRESSIONS VS {args.baseline}")
+    elif (args.no_baseline):
+        print(f"NO BASELINE AT {args.baseline}")
+    else:
+        print(f"!! NO BASELINE AT {args.baseline}, record one with"
+              " --save-baseline or pass --no-baseline")
+        sys.exit(1)
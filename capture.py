@@ -0,0 +1,376 @@
+"""
+Binary capture of the frames crossing the ports of a device, and
+replay of a capture into a fresh device.
+
+A capture file starts with a header:
+  - MAGIC, the capture format version, and the length of the
+    device description
+  - the device description as JSON (its kind, name, HAC, ports,
+    bridge id, firewall rules, and the HAC format and frame header
+    version in use), so replay can build the same device
+Followed by one record per frame:
+  - the time in ns (from the clock of the device, so captures
+    of the des engine have virtual times), the port, RX or TX,
+    and the length of the frame
+  - the frame as it is on the wire (see msg.dumps)
+
+Files are only ever appended to. Records go through a large write
+buffer, one write call per frame, so the sending threads are never
+held up by the disk. Frames that are handed over as Msg objects
+(the inproc transport) are encoded with dumps for the capture.
+
+Run this file to replay a capture:
+  python capture.py switch0.hcap [--speed 2] [--max]
+"""
+
+import json
+import os
+import struct
+import tempfile
+import threading as t
+from time import time, sleep
+from msg import dumps, loads, peek
+from stp import BPDU
+from netdevice import NetDevice
+import hac
+import msg as m
+import log
+
+MAGIC = b"HACP"
+VERSION = 1 # Capture format in use
+HEADER = struct.Struct("!4sBI") # magic, version, description length
+RECORD = struct.Struct("!QiBI") # ns, port, direction, length
+CAPTURE_BUF = 1 << 20 # Bytes buffered before a write to disk
+RX = 0 # Frame recieved on a port
+TX = 1 # Frame sent on a port
+DRAIN_TIME = 0.2 # Sec without change before a replay is done
+
+def describe(dev: NetDevice) -> dict:
+    """
+    The description of a device stored in its capture.
+    """
+    return {"kind": type(dev).__name__.lower(),
+            "name": dev.metrics.name,
+            "hac": getattr(dev, "shac", None),
+            "ports_in": list(dev.ports_in),
+            "ports_out": list(dev.ports_out),
+            "cut_through": getattr(dev, "cut_through", False),
+            "bridge_id": (dev.stp.bridge if (hasattr(dev, "stp"))
+                          else None),
+            "nets": sorted(dev.firewall.nets),
+            "hosts": sorted(dev.firewall.hosts),
+            "net_bits": hac.FORMAT.net_bits,
+            "dev_bits": hac.FORMAT.dev_bits,
+            "version": m.VERSION}
+
+class CaptureWriter():
+    """
+    Appends the frames of one device to a capture file.
+    Can be written to from any thread.
+    """
+
+    def __init__(self, path: str, dev: NetDevice,
+                 buf_size: int = CAPTURE_BUF) -> None:
+        self.path = path
+        self.file = open(path, "ab", buffering=buf_size)
+        if (self.file.tell() == 0):
+            desc = json.dumps(describe(dev)).encode("utf-8")
+            self.file.write(HEADER.pack(MAGIC, VERSION, len(desc)))
+            self.file.write(desc)
+
+            # Nothing may be left in the buffer of a process that
+            # forks, or the child writes it again
+
+            self.file.flush()
+        self.closed = False
+
+    def write(self, now: float, port: int, direction: int,
+              data: bytes):
+        """
+        Append one frame.
+        """
+        self.file.write(RECORD.pack(int(now * 1e9), port, direction,
+                                    len(data)) + data)
+
+    def sent(self, now: float, port: int, msgs: list):
+        """
+        Append frames sent on a port.
+        """
+        for msg in msgs:
+            self.write(now, port, TX, dumps(msg))
+
+    def recieved(self, now: float, port: int, data: bytes):
+        """
+        Append a frame recieved on a port.
+        """
+        self.write(now, port, RX, data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """
+        Write everything buffered and close the file.
+        """
+        if (self.closed):
+            return
+        self.closed = True
+        self.file.close()
+
+def read(path: str) -> tuple:
+    """
+    Read a capture file, and switch to the HAC format (and so the
+    frame header) it was taken with.
+    Returns the device description and a generator of
+    (time, port, direction, frame bytes) for every record.
+    """
+    f = open(path, "rb")
+    magic, version, size = HEADER.unpack(f.read(HEADER.size))
+    if ((magic != MAGIC) or (version != VERSION)):
+        f.close()
+        raise Exception(f"{path} is not a v{VERSION} capture!")
+    desc = json.loads(f.read(size))
+
+    # Captures from before the format was stored are all 4 + 4 bits
+
+    fmt = hac.set_format(desc.get("net_bits", 4), desc.get("dev_bits", 4))
+    if (fmt.version != desc.get("version", 1)):
+        f.close()
+        raise Exception(f"{path} has v{desc['version']} frames, but"
+                        f" {fmt} uses v{fmt.version}!")
+
+    def records():
+        with f:
+            while (True):
+                head = f.read(RECORD.size)
+                if (len(head) < RECORD.size):
+                    return
+                ns, port, direction, size = RECORD.unpack(head)
+                data = f.read(size)
+                if (len(data) < size):
+                    return # Cut off while being written
+                yield ns / 1e9, port, direction, data
+
+    return desc, records()
+
+def replay(records, dev: NetDevice, speed: float = 1) -> int:
+    """
+    Feed the recieved frames of a capture to a device, as if they
+    arrived on their ports. speed scales the time between frames,
+    None sends them as fast as possible.
+    Returns the number of frames fed.
+    """
+    count = 0
+    start = None
+    for when, port, direction, data in records:
+        if (direction != RX):
+            continue
+        if (speed is not None):
+            if (start is None):
+                start = (when, time())
+            wait = start[1] + (when - start[0]) / speed - time()
+            if (wait > 0):
+                sleep(wait)
+        dev.recieve_frame(port, data)
+        count += 1
+    return count
+
+def build(desc: dict) -> NetDevice:
+    """
+    Make a device like the one a capture was taken on.
+    """
+    import switch as s
+    import node as n
+
+    if (desc["kind"] == "node"):
+
+        # Nodes need a node file (an empty one sends nothing) and
+        # write an output file, they go in a temp dir so the files
+        # of the captured node are left alone
+
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            open(f"node{desc['hac']}.txt", "w").close()
+            dev = n.Node(desc["ports_in"][0], desc["ports_out"][0],
+                         desc["hac"])
+        finally:
+            os.chdir(cwd)
+        log.info(log.SIM, "REPLAY OUTPUT GOES TO {}",
+                 os.path.join(tmp, dev.sink.path))
+    elif (desc["kind"] == "switch"):
+        dev = s.Switch(desc["ports_in"], desc["ports_out"],
+                       cut_through=desc.get("cut_through", False),
+                       bridge_id=desc.get("bridge_id", None))
+    else:
+        raise Exception(f"Can not replay into a {desc['kind']}!")
+    for x in desc["nets"]:
+        dev.firewall.add_net(x)
+    for x in desc["hosts"]:
+        dev.firewall.add_host(x)
+    dev.metrics.name = desc["name"]
+    return dev
+
+class Drain(NetDevice):
+    """
+    Listens on the output ports of a replayed device and drops
+    every frame it gets. The BPDUs of a switch are not counted, it
+    keeps sending them.
+    """
+    last = None # When the last frame came in
+
+    def recieve_frame(self, port: int, data: bytes):
+        if (peek(data, False).atype == BPDU):
+            return
+        self.metrics.inc("frames_received", port)
+        self.last = time()
+
+def run_replay(path: str, speed: float = 1) -> tuple:
+    """
+    Replay a capture into a new device running on its own threads,
+    with an in process transport, until it has forwarded
+    everything. Returns (frames fed, frames sent, sec taken).
+    """
+    from transport import InProcTransport
+
+    desc, records = read(path)
+    link = InProcTransport(raw=True)
+    dev = build(desc)
+    drain = Drain(desc["ports_out"], [], transport=link)
+    dev.transport = link
+    link.open(drain)
+    ready = t.Event()
+    dev.start_device(ready)
+    ready.set()
+
+    start = time()
+    fed = replay(records, dev, speed)
+
+    # Wait until the device stops sending
+
+    sent = -1
+    while (True):
+        sleep(DRAIN_TIME)
+        tmp = sum(drain.metrics.snapshot()["counters"].get(
+                "frames_received", {}).values())
+        if ((tmp == sent) and (dev.rcv_q.qsize() == 0)):
+            break
+        sent = tmp
+    took = (time() if (drain.last is None) else drain.last) - start
+    dev.transport.close(dev)
+    if (hasattr(dev, "sink")):
+        dev.sink.close()
+    log.info(log.SIM, "REPLAYED {} FRAMES INTO {}, {} SENT IN {:.3f}"
+             " SEC ({:.0f} FRAMES/SEC)", fed, desc["name"], sent,
+             took, fed / max(took, 1e-9))
+    return fed, sent, took
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    from msg import Msg
+    from transport import InProcTransport
+    import switch as s
+
+    path = os.path.join(tempfile.mkdtemp(), "sw.hcap")
+    tmp = s.Switch([930, 932], [931, 933])
+    tmp.metrics.name = "sw"
+    tmp.capture = CaptureWriter(path, tmp)
+    tmp.transport = InProcTransport(raw=True)
+    tmp.recieve_frame(930, dumps(Msg(0, 0x12, 0x23, 1, 0, 0, "a")))
+    tmp.recieve_msg(932, Msg(0, 0x23, 0x12, 1, 0, 0, "b"))
+    tmp.capture.sent(0, 931, [Msg(0, 0x23, 0x12, 1, 0, 0, "b")])
+    tmp.capture.close()
+
+    # Appending keeps the first header
+
+    tmp.capture = CaptureWriter(path, tmp)
+    tmp.recieve_frame(930, dumps(Msg(0, 0x12, 0x23, 1, 0, 1, "c")))
+    tmp.capture.close()
+
+    desc, records = read(path)
+    records = list(records)
+    print(f"capture: {desc} {records}")
+    assert (desc["kind"] == "switch") and \
+            (desc["ports_out"] == [931, 933])
+    assert [(x[1], x[2], loads(x[3]).data) for x in records] == \
+            [(930, RX, "a"), (932, RX, "b"), (931, TX, "b"),
+             (930, RX, "c")]
+
+    # Replaying floods the frames out of the other ports
+
+    fed, sent, took = run_replay(path, None)
+    print(f"replay: {fed} {sent} {took}")
+    assert (fed == 3) and (sent == 3)
+
+    # Captures of wide HACs (v2 frames) are read and replayed in the
+    # format they were taken with
+
+    path = os.path.join(os.path.dirname(path), "wide.hcap")
+    hac.set_format(16, 16)
+    try:
+        a = hac.FORMAT.to_hac("1_40")
+        b = hac.FORMAT.to_hac("2_300")
+        tmp = s.Switch([934, 936], [935, 937])
+        tmp.metrics.name = "wide"
+        tmp.capture = CaptureWriter(path, tmp)
+        tmp.transport = InProcTransport(raw=True)
+        tmp.recieve_frame(934, dumps(Msg(0, a, b, 1, 0, 0, "a")))
+        tmp.recieve_frame(936, dumps(Msg(0, b, a, 1, 0, 0, "b")))
+        tmp.capture.close()
+        hac.set_format(4, 4)
+
+        desc, records = read(path)
+        assert (hac.FORMAT.dev_bits == 16) and (m.VERSION == 2)
+        assert [(loads(x[3]).src, loads(x[3]).data)
+                for x in records] == [(a, "a"), (b, "b")]
+        fed, sent, took = run_replay(path, None)
+        print(f"wide replay: {fed} {sent} {took}")
+        assert (fed == 2) and (sent == 2)
+
+        # Nodes with a device number that only fits in the wide
+        # format can be built again
+
+        tmp = build({"kind": "node", "name": "node1_40", "hac": "1_40",
+                     "ports_in": [938], "ports_out": [939],
+                     "nets": [], "hosts": []})
+        tmp.sink.close()
+        assert tmp.node_id == a
+    finally:
+        hac.set_format(4, 4)
+
+    # Replaying into a node leaves the files of the node alone
+
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        with open("node1_5output.txt", "w") as f:
+            f.write("kept\n")
+        tmp = build({"kind": "node", "name": "node1_5", "hac": "1_5",
+                     "ports_in": [940], "ports_out": [941],
+                     "nets": [], "hosts": []})
+        tmp.sink.close()
+        assert not os.path.exists("node1_5.txt")
+        with open("node1_5output.txt") as f:
+            assert f.read() == "kept\n"
+    finally:
+        os.chdir(cwd)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Replay a capture file into a new device.")
+    parser.add_argument('path',
+                        help='The capture file.')
+    parser.add_argument('--speed',
+                        type=float,
+                        default=1,
+                        help='How much faster than captured to replay.')
+    parser.add_argument('--max',
+                        action='store_true',
+                        help='Replay as fast as possible.')
+    args = parser.parse_args()
+    run_replay(args.path, None if (args.max) else args.speed)
+    log.flush()
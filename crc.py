@@ -0,0 +1,141 @@
+"""
+Table driven CRCs.
+
+A Crc is defined by its width, polynomial, initial value, final
+xor and bit order, like in the usual CRC catalogues. Data is run
+through a 256 entry table one byte at a time. The stdlib has C
+versions of CRC16 (binascii.crc_hqx) and CRC32 (zlib.crc32), which
+are used instead of the table when they are the same CRC, the
+tables are kept to check them against.
+
+Every calc takes the result of an earlier calc to continue from,
+so a frame can be checked in pieces without joining them.
+"""
+
+import binascii
+import zlib
+
+def _reflect(i: int, width: int) -> int:
+    """
+    Reverse the low width bits of i.
+    """
+    ret = 0
+    for j in range(width):
+        if (i & (1 << j)):
+            ret |= 1 << (width - 1 - j)
+    return ret
+
+class Crc():
+    """
+    One CRC algorithm.
+
+    fast is a C function taking (data, value) that gives the same
+    results as calc.
+    """
+
+    def __init__(self, name: str, width: int, poly: int,
+                 init: int = 0, xorout: int = 0,
+                 reflected: bool = False, fast=None) -> None:
+        self.name = name
+        self.width = width
+        self.poly = poly
+        self.init = init
+        self.xorout = xorout
+        self.reflected = reflected
+        self.mask = (1 << width) - 1
+        self.table = self._table()
+        self.fast = fast
+
+    def _table(self) -> list:
+        """
+        The register after running each byte value through it.
+        """
+        ret = []
+        if (self.reflected):
+            poly = _reflect(self.poly, self.width)
+            for i in range(256):
+                reg = i
+                for j in range(8):
+                    reg = (reg >> 1) ^ (poly if (reg & 1) else 0)
+                ret.append(reg)
+        else:
+            top = 1 << (self.width - 1)
+            for i in range(256):
+                reg = i << (self.width - 8)
+                for j in range(8):
+                    reg = ((reg << 1) ^ (self.poly if (reg & top)
+                                         else 0)) & self.mask
+                ret.append(reg)
+        return ret
+
+    def update(self, data: bytes, reg: int) -> int:
+        """
+        Run data through the register with the table.
+        """
+        table = self.table
+        if (self.reflected):
+            for x in data:
+                reg = table[(reg ^ x) & 0xFF] ^ (reg >> 8)
+        elif (self.width == 8):
+            for x in data:
+                reg = table[reg ^ x]
+        else:
+            shift = self.width - 8
+            mask = self.mask
+            for x in data:
+                reg = table[(reg >> shift) ^ x] ^ ((reg << 8) & mask)
+        return reg
+
+    def slow(self, data: bytes, value: int = None) -> int:
+        """
+        The CRC of data, always using the table.
+        """
+        if (value is None):
+            value = self.init ^ self.xorout
+        return self.update(data, value ^ self.xorout) ^ self.xorout
+
+    def calc(self, data: bytes, value: int = None) -> int:
+        """
+        The CRC of data, or of the data the CRC value was
+        calculated on followed by data.
+        """
+        if (value is None):
+            value = self.init ^ self.xorout
+        if (self.fast is not None):
+            return self.fast(data, value)
+        return self.slow(data, value)
+
+CRC8 = Crc("CRC-8/SMBUS", 8, 0x07)
+CRC16 = Crc("CRC-16/XMODEM", 16, 0x1021, fast=binascii.crc_hqx)
+CRC32 = Crc("CRC-32", 32, 0x04C11DB7, 0xFFFFFFFF, 0xFFFFFFFF,
+            reflected=True, fast=zlib.crc32)
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    import random
+
+    # The check values from the catalogue
+
+    for crc, check in [(CRC8, 0xF4), (CRC16, 0x31C3),
+                       (CRC32, 0xCBF43926)]:
+        got = crc.calc(b"123456789")
+        print(f"{crc.name}: {got:#x}")
+        assert got == crc.slow(b"123456789") == check
+
+        # In pieces, and the tables match the C versions
+
+        assert crc.calc(b"6789", crc.calc(b"12345")) == check
+        assert crc.slow(b"6789", crc.slow(b"12345")) == check
+        data = random.randbytes(300)
+        assert crc.calc(data) == crc.slow(data)
+
+    # Every single bit error is caught
+
+    data = bytearray(b"hello world")
+    good = CRC8.calc(data)
+    for i in range(len(data) * 8):
+        data[i // 8] ^= 1 << (i % 8)
+        assert CRC8.calc(data) != good
+        data[i // 8] ^= 1 << (i % 8)
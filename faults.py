@@ -0,0 +1,281 @@
+"""
+Impairment of the links between devices.
+
+A FaultModel gives the chance (0 to 1) of every fault a frame can
+hit on a link:
+  - corrupt → the frame arrives with a bad crc, and is NACKed
+  - loss → the frame never arrives
+  - duplicate → the frame arrives twice
+  - reorder → the frame is held back hold sec, so the frames sent
+    after it overtake it
+and delay, the sec added to every frame on top of that.
+
+Every link (output port) draws from its own random generator,
+seeded by the seed of the model and the port, so the faults a link
+gives its frames do not depend on the traffic of other links. With
+the des engine, which runs in the same order every time, this makes
+runs repeatable.
+
+FaultyTransport puts a model on every link of another transport.
+The des engine has no transport and applies the model itself (see
+des.py).
+"""
+
+import asyncio
+import random
+import threading as t
+from copy import copy
+from dataclasses import dataclass
+from heapq import heappush, heappop
+from time import time
+from transport import Transport
+import log
+
+HOLD = 0.001 # Sec a reordered frame is held back
+
+@dataclass
+class FaultModel():
+    """
+    The faults of every link of a simulation.
+    """
+    corrupt: float = 0
+    loss: float = 0
+    duplicate: float = 0
+    reorder: float = 0
+    delay: float = 0
+    hold: float = HOLD
+    seed: int = 0
+
+    def __bool__(self) -> bool:
+        """
+        Checks if the model does anything.
+        """
+        return bool(self.corrupt or self.loss or self.duplicate
+                    or self.reorder or self.delay)
+
+    def link(self, port: int) -> "Link":
+        return Link(self, port)
+
+class Link():
+    """
+    The faults of one link.
+    """
+
+    def __init__(self, model: FaultModel, port: int) -> None:
+        self.model = model
+        self.port = port
+        self.random = random.Random(f"{model.seed}/{port}")
+
+    def apply(self, frame, corrupt, metrics=None) -> list:
+        """
+        Decide what happens to a frame.
+        corrupt(frame) returns a copy of the frame with a bad crc.
+        Returns a (delay in sec, frame) for every copy that
+        arrives, and counts the faults in metrics if given.
+        """
+        model = self.model
+        rand = self.random.random
+        if ((model.loss) and (rand() < model.loss)):
+            self._count(metrics, "fault_losses")
+            return []
+        copies = 1
+        if ((model.duplicate) and (rand() < model.duplicate)):
+            self._count(metrics, "fault_duplicates")
+            copies = 2
+        ret = []
+        for i in range(copies):
+            tmp = frame
+            if ((model.corrupt) and (rand() < model.corrupt)):
+                self._count(metrics, "fault_corruptions")
+                tmp = corrupt(frame)
+            delay = model.delay
+            if ((model.reorder) and (rand() < model.reorder)):
+                self._count(metrics, "fault_reorders")
+                delay += model.hold
+            ret.append((delay, tmp))
+        return ret
+
+    def _count(self, metrics, name: str):
+        if (metrics is not None):
+            metrics.inc(name, self.port)
+
+def corrupt_msg(msg):
+    """
+    A copy of a Msg that fails its check, see msg.dumps.
+    """
+    ret = copy(msg)
+    ret.crc = False
+    return ret
+
+def corrupt_frame(crc_at: int):
+    """
+    Returns a function flipping a bit of the crc in the bytes of a
+    frame, crc_at is the offset of the crc in the header.
+    """
+    def ret(data: bytes) -> bytes:
+        tmp = bytearray(data)
+        tmp[crc_at] ^= 1
+        return bytes(tmp)
+    return ret
+
+class FaultyTransport(Transport):
+    """
+    Sends frames with another transport, after a fault model had
+    its way with them.
+
+    Frames that are not delayed are sent right away, and sending
+    fails like it would on the other transport. Delayed frames are
+    sent by a background thread (or the event loop) once their time
+    has come, and are lost if the port is down by then.
+    """
+
+    def __init__(self, inner: Transport, model: FaultModel) -> None:
+        self.inner = inner
+        self.model = model
+        self.links = dict() # port → Link
+        self.locks = dict() # port → Lock held while sending
+        self.later = [] # heap of (when, n, dev, port, msg)
+        self.n = 0
+        self.cond = t.Condition()
+        self.wire = None # Thread sending delayed frames
+
+    def link(self, port: int) -> Link:
+        tmp = self.links.get(port, None)
+        if (tmp is None):
+            tmp = self.links.setdefault(port, self.model.link(port))
+        return tmp
+
+    def plan(self, dev, next_hop: int, msgs: list) -> tuple:
+        """
+        Apply the faults to a batch.
+        Returns the frames to send now and the delayed ones.
+        """
+        link = self.link(next_hop)
+        now = []
+        later = []
+        for msg in msgs:
+            for delay, tmp in link.apply(msg, corrupt_msg,
+                                         dev.metrics):
+                if (delay > 0):
+                    later.append((delay, tmp))
+                else:
+                    now.append(tmp)
+        return now, later
+
+    def bind(self, devices: list):
+        self.inner.bind(devices)
+
+    def open(self, dev):
+        self.inner.open(dev)
+
+    def _send(self, dev, next_hop: int, msgs: list) -> bool:
+        """
+        Send on the other transport, one thread at a time per port.
+        """
+        lock = self.locks.get(next_hop, None)
+        if (lock is None):
+            lock = self.locks.setdefault(next_hop, t.Lock())
+        with lock:
+            return self.inner.send(dev, next_hop, msgs)
+
+    def send(self, dev, next_hop: int, msgs: list) -> bool:
+        now, later = self.plan(dev, next_hop, msgs)
+        if (now and (not self._send(dev, next_hop, now))):
+            return False
+        if (later):
+            start = time()
+            with self.cond:
+                for delay, msg in later:
+                    heappush(self.later, (start + delay, self.n, dev,
+                                          next_hop, msg))
+                    self.n += 1
+                if (self.wire is None):
+                    self.wire = t.Thread(target=self.wire_loop,
+                                         daemon=True)
+                    self.wire.start()
+                self.cond.notify()
+        return True
+
+    def wire_loop(self):
+        """
+        Send every delayed frame once its time has come.
+        """
+        while (True):
+            with self.cond:
+                while ((not self.later) or
+                       (self.later[0][0] > time())):
+                    self.cond.wait(None if (not self.later)
+                                   else self.later[0][0] - time())
+                when, n, dev, port, msg = heappop(self.later)
+            if (not self._send(dev, port, [msg])):
+                log.warn(log.SEND, "-- DELAYED FRAME VIA PORT {:#x}"
+                         " LOST", port)
+
+    def close(self, dev):
+        self.inner.close(dev)
+
+    async def aopen(self, dev):
+        await self.inner.aopen(dev)
+
+    async def asend(self, dev, next_hop: int, msgs: list) -> bool:
+        now, later = self.plan(dev, next_hop, msgs)
+        if (now and (not await self.inner.asend(dev, next_hop, now))):
+            return False
+        loop = asyncio.get_running_loop()
+        for delay, msg in later:
+            loop.call_later(delay, self._asend_later, dev, next_hop, msg)
+        return True
+
+    def _asend_later(self, dev, next_hop: int, msg):
+        """
+        Send a delayed frame once its timer fires, the coroutine is
+        only made here so none is left unawaited if the loop stops.
+        """
+        asyncio.ensure_future(self.inner.asend(dev, next_hop, [msg]))
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    from msg import Msg
+    from netdevice import NetDevice
+    from transport import InProcTransport
+
+    # The same seed gives the same faults on a link
+
+    tmp = FaultModel(corrupt=0.2, loss=0.2, duplicate=0.2,
+                     reorder=0.2, seed=3)
+    def outcomes(port: int) -> list:
+        tmp2 = tmp.link(port)
+        return [len(tmp2.apply(i, lambda x: -x)) for i in range(200)]
+
+    runs = [outcomes(5) for i in range(2)]
+    assert runs[0] == runs[1]
+    assert {0, 1, 2} <= set(runs[0])
+    assert outcomes(6) != runs[0]
+    assert not FaultModel()
+
+    link = FaultyTransport(InProcTransport(raw=True),
+                           FaultModel(corrupt=0.5, duplicate=0.5,
+                                      reorder=0.5, hold=0.05, seed=1))
+    a = NetDevice([940], [941], transport=link)
+    b = NetDevice([941], [940], transport=link)
+    link.open(b)
+    for i in range(20):
+        assert link.send(a, 941, [Msg(0, 0x12, 0x13, 1, 0, i,
+                                      str(i))])
+    got = []
+    for i in range(40):
+        try:
+            got.append(b.rcv_q.get(timeout=0.5)[1])
+        except Exception:
+            break
+    print(f"output: {[x.data for x in got]}")
+    snap = a.snapshot()["counters"]
+    print(f"faults: {snap}")
+    nacks = b.snapshot()["counters"].get("crc_nacks", {})
+    assert len(got) == 20 + sum(snap["fault_duplicates"].values())
+    assert sum(nacks.values()) == sum(
+            snap["fault_corruptions"].values())
+    tmp = [x.ordering for x in got if (x.size)] # Not the NACKs
+    assert tmp != sorted(tmp)
@@ -0,0 +1,182 @@
+"""
+The firewall of the HAC system.
+
+Rules come from firewall.txt, one per line as <rule>: <comment>.
+A rule is either a HAC (<net>_<dev>), which blocks frames to that
+device, or <net>_#, which blocks frames to the whole network. Frames
+within a network are never blocked, and neither are ACKs and NACKs
+(see NetDevice.is_blocked).
+
+Rules are compiled into a table with one byte per HAC (for formats
+up to hac.TABLE_BITS bits, sets of HACs and networks for wider
+ones), so a check costs the same no matter how many rules there
+are. Rules can be added and removed while frames are being checked,
+every change is written to the table with a single assignment.
+Switches pass rules on to each other in rule frames (see
+Switch.push_rule).
+"""
+
+import threading as t
+import hac
+
+ADD_RULE = 0b11111111 # atype of a frame adding a rule
+DEL_RULE = 0b11111101 # atype of a frame removing a rule
+
+def parse(lines: list) -> tuple:
+    """
+    Read the lines of a firewall file.
+    Returns a tuple of the network rules (as <net>_0) and the
+    device rules, each without duplicates.
+    """
+    nets = dict()
+    hosts = dict()
+    for x in lines:
+        rule, sep, comment = x.rpartition(": ")
+        if (not sep):
+            raise Exception("Malformed firewall file!")
+        if ("#" in rule):
+            nets[rule.replace("#", "0")] = None
+        else:
+            hosts[rule] = None
+    return list(nets), list(hosts)
+
+class Firewall():
+    """
+    The compiled rules of one device.
+    """
+
+    def __init__(self, nets: list = (), hosts: list = (),
+                 fmt: hac.AddressFormat = None) -> None:
+        self.fmt = hac.FORMAT if (fmt is None) else fmt
+        self.mask = self.fmt.net_mask
+        self.nets = set() # Blocked networks, as HACs with dev 0
+        self.hosts = set() # Blocked HACs
+        self.lock = t.Lock() # Held while changing the rules
+        self.table = None # HAC → 1 if blocked
+        if (self.fmt.bits <= hac.TABLE_BITS):
+            self.table = bytearray(1 << self.fmt.bits)
+        for x in nets:
+            self.add_net(x)
+        for x in hosts:
+            self.add_host(x)
+
+    def __len__(self) -> int:
+        return len(self.nets) + len(self.hosts)
+
+    def blocked(self, src: int, dest: int) -> bool:
+        """
+        Checks if a frame from src to dest should be blocked.
+        """
+        if (self.table is not None):
+            hit = self.table[dest]
+        else:
+            hit = ((dest in self.hosts)
+                   or ((dest & self.mask) in self.nets))
+        return (hit and ((src ^ dest) & self.mask) != 0)
+
+    def _span(self, net: int) -> tuple:
+        """
+        The first and last + 1 HAC of a network.
+        """
+        net &= self.mask
+        return net, net + self.fmt.max_dev + 1
+
+    def add_net(self, net: int) -> bool:
+        """
+        Block a network. Returns False if it already was.
+        """
+        lo, hi = self._span(net)
+        with self.lock:
+            if (lo in self.nets):
+                return False
+            self.nets.add(lo)
+            if (self.table is not None):
+                self.table[lo:hi] = b"\x01" * (hi - lo)
+        return True
+
+    def remove_net(self, net: int) -> bool:
+        """
+        Unblock a network, its blocked devices stay blocked.
+        Returns False if it was not blocked.
+        """
+        lo, hi = self._span(net)
+        with self.lock:
+            if (lo not in self.nets):
+                return False
+            self.nets.discard(lo)
+            if (self.table is not None):
+                self.table[lo:hi] = bytes(
+                        (x in self.hosts) for x in range(lo, hi))
+        return True
+
+    def add_host(self, dest: int) -> bool:
+        """
+        Block a HAC. Returns False if it already was.
+        """
+        with self.lock:
+            if (dest in self.hosts):
+                return False
+            self.hosts.add(dest)
+            if (self.table is not None):
+                self.table[dest] = 1
+        return True
+
+    def remove_host(self, dest: int) -> bool:
+        """
+        Unblock a HAC, unless its network is blocked.
+        Returns False if it was not blocked.
+        """
+        with self.lock:
+            if (dest not in self.hosts):
+                return False
+            self.hosts.discard(dest)
+            if (self.table is not None):
+                self.table[dest] = ((dest & self.mask) in self.nets)
+        return True
+
+    def apply(self, atype: int, rule: str) -> bool:
+        """
+        Apply a rule frame. Returns False if it changed nothing.
+        """
+        net = ("#" in rule)
+        dest = self.fmt.to_hac(rule.replace("#", "0"))
+        if (atype == ADD_RULE):
+            return self.add_net(dest) if (net) else self.add_host(dest)
+        if (atype == DEL_RULE):
+            return (self.remove_net(dest) if (net)
+                    else self.remove_host(dest))
+        raise Exception(f"Not a rule frame: {atype:#x}")
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    nets, hosts = parse(["1_#: no net 1\n", "2_3: no 2_3\n",
+                         "2_3: again\n"])
+    print(f"rules: {nets} {hosts}")
+    assert (nets == ["1_0"]) and (hosts == ["2_3"])
+    try:
+        parse(["2_3\n"])
+        assert False
+    except Exception as e:
+        print(f"error: {e}")
+
+    for fmt in [hac.AddressFormat(), hac.AddressFormat(16, 16)]:
+        tmp = Firewall([fmt.to_hac("1_0")], [fmt.to_hac("2_3")], fmt)
+        a = fmt.to_hac("1_5")
+        b = fmt.to_hac("2_3")
+        c = fmt.to_hac("2_4")
+        assert tmp.blocked(b, a) and tmp.blocked(a, b)
+        assert not tmp.blocked(fmt.to_hac("1_1"), a) # Same net
+        assert not tmp.blocked(a, c)
+
+        assert not tmp.apply(ADD_RULE, "2_3") # Duplicate
+        assert len(tmp) == 2
+        assert tmp.apply(ADD_RULE, "2_#")
+        assert tmp.apply(DEL_RULE, "2_3")
+        assert tmp.blocked(a, b) # Its net is still blocked
+        assert tmp.apply(DEL_RULE, "2_#")
+        assert not tmp.blocked(a, b)
+        assert tmp.apply(DEL_RULE, "1_#")
+        assert (not tmp.blocked(b, a)) and (len(tmp) == 0)
+        assert not tmp.apply(DEL_RULE, "1_#")
@@ -0,0 +1,162 @@
+"""
+The stream format used on the links between devices.
+
+Every frame (the output of msg.dumps) is prefixed by its length
+so that any number of frames can be concatenated and sent with
+one write. The reader parses frames incrementaly out of a single
+reusable buffer, no matter how the stream was split up by TCP, and
+the writer encodes Msg objects straight into one.
+"""
+
+import struct
+import socket
+from msg import dumps_into, frame_size
+
+# Every frame on a connection is prefixed by its length
+
+FRAME_LEN = struct.Struct("!H")
+MAX_FRAME = (1 << (FRAME_LEN.size * 8)) - 1
+
+BUF_SIZE = 1 << 16 # Size of the recieve buffer in bytes
+RECV_SIZE = 1 << 14 # Least amount of room for a single read
+
+def frame(data: bytes) -> bytes:
+    """
+    Prefix a frame with its length so many can share a stream.
+    """
+    if (len(data) > MAX_FRAME):
+        raise Exception(f"Frame of {len(data)} bytes is too large!")
+    return FRAME_LEN.pack(len(data)) + data
+
+def pack(frames: list) -> bytes:
+    """
+    Concatenate many frames into one buffer to be sent at once.
+    """
+    return b''.join([frame(x) for x in frames])
+
+class FrameWriter():
+    """
+    Encodes batches of Msg objects as length prefixed frames into a
+    reusable buffer, which only grows when a batch does not fit.
+    Every frame is written in place with msg.dumps_into.
+    """
+
+    def __init__(self, size: int = BUF_SIZE) -> None:
+        self.buf = bytearray(size)
+
+    def pack(self, msgs: list) -> memoryview:
+        """
+        Encode msgs, the result is only good until the next pack.
+        """
+        need = sum(FRAME_LEN.size + frame_size(x) for x in msgs)
+        if (need > len(self.buf)):
+            self.buf = bytearray(max(need, len(self.buf) * 2))
+        at = 0
+        for x in msgs:
+            end = dumps_into(x, self.buf, at + FRAME_LEN.size)
+            size = end - at - FRAME_LEN.size
+            if (size > MAX_FRAME):
+                raise Exception(f"Frame of {size} bytes is too large!")
+            FRAME_LEN.pack_into(self.buf, at, size)
+            at = end
+        return memoryview(self.buf)[:at]
+
+class FrameReader():
+    """
+    Parses length prefixed frames out of a stream.
+
+    Data is read straight into a preallocated buffer with recv_into
+    (or added with feed), frames are then pulled out with frames().
+    The buffer is only compacted when it runs out of room.
+    """
+
+    def __init__(self, size: int = BUF_SIZE) -> None:
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, size: int):
+        """
+        Make sure size more bytes fit at the end of the buffer.
+        """
+        if (self.end + size <= len(self.buf)):
+            return
+        used = self.end - self.start
+        self.buf[:used] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = used
+        if (used + size > len(self.buf)):
+            self.view.release()
+            self.buf.extend(bytes(used + size - len(self.buf)))
+            self.view = memoryview(self.buf)
+
+    def feed(self, data: bytes):
+        """
+        Add data that was read from the stream.
+        """
+        self._make_room(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv_into(self, sock: socket.socket) -> int:
+        """
+        Read whatever is available on a socket into the buffer.
+        Returns the number of bytes read, 0 if the stream closed.
+        """
+        self._make_room(RECV_SIZE)
+        ret = sock.recv_into(self.view[self.end:])
+        self.end += ret
+        return ret
+
+    def frames(self):
+        """
+        Yield every complete frame in the buffer.
+        """
+        while (self.end - self.start >= FRAME_LEN.size):
+            size, = FRAME_LEN.unpack_from(self.buf, self.start)
+            begin = self.start + FRAME_LEN.size
+            if (begin + size > self.end):
+                return
+            self.start = begin + size
+            yield bytes(self.view[begin:self.start])
+        if (self.start == self.end):
+            self.start = self.end = 0
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    data = pack([b"one", b"x" * 300, b""])
+    print(f"bytes: {data[:12]}...")
+
+    # Feed the stream one byte at a time
+
+    tmp = FrameReader(8)
+    out = []
+    for i in range(len(data)):
+        tmp.feed(data[i:i + 1])
+        out.extend(tmp.frames())
+    print(f"output: {[len(x) for x in out]}")
+    assert out == [b"one", b"x" * 300, b""]
+
+    # Read from a socket
+
+    a, b = socket.socketpair()
+    a.sendall(data)
+    a.close()
+    tmp = FrameReader()
+    out = []
+    while (tmp.recv_into(b)):
+        out.extend(tmp.frames())
+    b.close()
+    assert out == [b"one", b"x" * 300, b""]
+
+    # Msgs packed in place match their dumps, the buffer grows for
+    # large batches
+
+    from msg import Msg, dumps
+    msgs = [Msg(0, 0x12, 0x23, 3, 0, i, "abc") for i in range(100)]
+    tmp = FrameWriter(8)
+    for x in [msgs[:1], msgs]:
+        assert tmp.pack(x) == pack([dumps(y) for y in x])
@@ -0,0 +1,112 @@
+"""
+HACs (Hamdy Access Codes), the addresses of the HAC system.
+
+A HAC is written as <net>_<dev> and is an int with the network
+number in the high net_bits and the device number in the low
+dev_bits. The original format is 4 + 4 bits, so a HAC fits in one
+byte of the v1 frame header. Wider formats (up to 32 bits in total)
+switch msg.py to the v2 header, which has 4 byte addresses.
+
+The format is global to a simulation and has to be set with
+set_format before any devices are created.
+"""
+
+import msg
+
+TABLE_BITS = 16 # Formats up to this size get full lookup tables
+
+class AddressFormat():
+    """
+    Converts between HAC strings and ints for one address width.
+
+    For small formats every conversion is precomputed, wider ones
+    remember the conversions done so far.
+    """
+
+    def __init__(self, net_bits: int = 4, dev_bits: int = 4) -> None:
+        if ((net_bits < 1) or (dev_bits < 1)
+                or (net_bits + dev_bits > 32)):
+            raise Exception("A HAC can have at most 32 bits!")
+        self.net_bits = net_bits
+        self.dev_bits = dev_bits
+        self.bits = net_bits + dev_bits
+        self.version = 1 if (self.bits <= 8) else 2
+        self.max_net = (1 << net_bits) - 1
+        self.max_dev = (1 << dev_bits) - 1
+        self.net_mask = self.max_net << dev_bits
+
+        self.names = dict() # HAC → string
+        self.hacs = dict() # string → HAC
+        if (self.bits <= TABLE_BITS):
+            for i in range(1 << self.bits):
+                tmp = f"{i >> dev_bits}_{i & self.max_dev}"
+                self.names[i] = tmp
+                self.hacs[tmp] = i
+
+    def __repr__(self) -> str:
+        return (f"AddressFormat(net_bits={self.net_bits},"
+                f" dev_bits={self.dev_bits})")
+
+    def to_hac(self, s: str) -> int:
+        """
+        Convert a <net>_<dev> string to a HAC.
+        """
+        ret = self.hacs.get(s, None)
+        if (ret is not None):
+            return ret
+        net, dev = s.split("_")
+        net = int(net)
+        dev = int(dev)
+        if ((not (0 <= net <= self.max_net))
+                or (not (0 <= dev <= self.max_dev))):
+            raise Exception(f"HAC {s} does not fit in {self}!")
+        ret = (net << self.dev_bits) | dev
+        self.hacs[s] = ret
+        return ret
+
+    def from_hac(self, i: int) -> str:
+        """
+        Inverse of to_hac.
+        """
+        ret = self.names.get(i, None)
+        if (ret is None):
+            ret = f"{i >> self.dev_bits}_{i & self.max_dev}"
+            self.names[i] = ret
+        return ret
+
+    def net(self, i: int) -> int:
+        """
+        The network part of a HAC (still in the high bits).
+        """
+        return i & self.net_mask
+
+FORMAT = AddressFormat()
+
+def set_format(net_bits: int, dev_bits: int) -> AddressFormat:
+    """
+    Use a new address format, and the frame header it needs.
+    """
+    global FORMAT
+    FORMAT = AddressFormat(net_bits, dev_bits)
+    msg.set_version(FORMAT.version)
+    return FORMAT
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    tmp = AddressFormat()
+    assert tmp.to_hac("2_3") == 0x23
+    assert tmp.from_hac(0x23) == "2_3"
+    assert tmp.net(0x23) == 0x20
+    try:
+        tmp.to_hac("1_16")
+        assert False
+    except Exception as e:
+        print(f"error: {e}")
+
+    tmp = AddressFormat(16, 16)
+    assert tmp.version == 2
+    assert tmp.to_hac("2_40000") == (2 << 16) | 40000
+    assert tmp.from_hac((2 << 16) | 40000) == "2_40000"
+    assert tmp.net(tmp.to_hac("7_1")) == tmp.net(tmp.to_hac("7_9"))
@@ -0,0 +1,172 @@
+"""
+Event logging for the simulator.
+
+Every event has a category (what part of the simulator it comes
+from) and a level. Events below the level of their category are
+dropped after a single dict lookup, and callers that would have to
+do work just to log (like looping over a batch) check on() first.
+
+Enabled events are not formatted where they happen. The format
+string and its arguments are put on a ring buffer (a deque, whose
+append and popleft are atomic), and a background thread formats and
+writes them every DRAIN_TIME sec. If the drain can not keep up the
+oldest events are dropped. Call flush to write everything out, it
+is done at exit as well.
+"""
+
+import atexit
+import os
+import sys
+import threading as t
+from collections import deque
+from time import sleep
+
+DEBUG = 10 # Every frame
+INFO = 20 # Devices starting and finishing, data recorded
+WARN = 30 # Errors, drops and retries
+ERROR = 40
+OFF = 100
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warn": WARN,
+          "error": ERROR, "off": OFF}
+
+# Categories
+
+SEND = "send" # Send loops
+RECV = "recv" # Frames arriving on a device
+SWITCH = "switch"
+NODE = "node"
+FIREWALL = "firewall"
+MSG = "msg" # The msg codec
+SIM = "sim" # Main and the engines
+
+CATEGORIES = (SEND, RECV, SWITCH, NODE, FIREWALL, MSG, SIM)
+
+RING_SIZE = 1 << 16 # Max events waiting to be written
+DRAIN_TIME = 0.05 # Sec between writes
+
+_min = {x: INFO for x in CATEGORIES} # category → lowest level shown
+_ring = deque(maxlen=RING_SIZE)
+_lock = t.Lock() # Held while writing
+_out = None # sys.stdout if None
+_drain = None
+
+def configure(level: int = None, categories: list = None,
+              out=None):
+    """
+    Set the level of all categories, or of only the given ones
+    (all others are turned off), and where events are written
+    (a file, None keeps the current one).
+    """
+    global _out
+    if (level is not None):
+        for x in CATEGORIES:
+            if ((categories is None) or (x in categories)):
+                _min[x] = level
+            else:
+                _min[x] = OFF
+    if (out is not None):
+        flush()
+        _out = out
+
+def on(cat: str, level: int = INFO) -> bool:
+    """
+    Checks if events of a category and level are shown.
+    """
+    return (level >= _min[cat])
+
+def event(cat: str, level: int, fmt: str, *args):
+    """
+    Log an event, the text is fmt.format(*args).
+    """
+    if (level < _min[cat]):
+        return
+    _ring.append((fmt, args))
+    if (_drain is None):
+        _start()
+
+def debug(cat: str, fmt: str, *args):
+    event(cat, DEBUG, fmt, *args)
+
+def info(cat: str, fmt: str, *args):
+    event(cat, INFO, fmt, *args)
+
+def warn(cat: str, fmt: str, *args):
+    event(cat, WARN, fmt, *args)
+
+def error(cat: str, fmt: str, *args):
+    event(cat, ERROR, fmt, *args)
+
+def flush():
+    """
+    Write every waiting event.
+    """
+    with _lock:
+        lines = []
+        try:
+            while (True):
+                fmt, args = _ring.popleft()
+                lines.append(fmt.format(*args) if (args) else fmt)
+        except IndexError:
+            pass
+        if (lines):
+            out = sys.stdout if (_out is None) else _out
+            out.write("\n".join(lines) + "\n")
+            out.flush()
+
+def _drain_loop():
+    while (True):
+        sleep(DRAIN_TIME)
+        flush()
+
+def _start():
+    """
+    Start the background thread writing events.
+    """
+    global _drain
+    with _lock:
+        if (_drain is not None):
+            return
+        _drain = t.Thread(target=_drain_loop, daemon=True)
+        _drain.start()
+
+def _after_fork():
+    """
+    A forked child has no drain thread, and the events that were
+    waiting are written by the parent.
+    """
+    global _drain, _lock
+    _drain = None
+    _lock = t.Lock()
+    _ring.clear()
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(flush)
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    import io
+
+    tmp = io.StringIO()
+    old = dict(_min)
+    try:
+        configure(INFO, out=tmp)
+        debug(SWITCH, "hidden {}", 1)
+        info(SWITCH, "shown {} {}", 1, "a")
+        warn(NODE, "plain {}")
+        assert on(NODE, WARN) and (not on(NODE, DEBUG))
+        flush()
+        print(f"output: {tmp.getvalue()!r}")
+        assert tmp.getvalue() == "shown 1 a\nplain {}\n"
+
+        configure(DEBUG, [NODE])
+        assert on(NODE, DEBUG) and (not on(SWITCH, ERROR))
+        error(SWITCH, "hidden")
+        flush()
+        assert tmp.getvalue().count("\n") == 2
+    finally:
+        _min.update(old)
+        flush()
+        globals()["_out"] = None
@@ -14,39 +14,50 @@ For further details, see the rest of the documentation.
 from itertools import cycle
 from random import shuffle
 import threading as t
-from time import sleep
+from time import sleep, time
 from netdevice import SLEEP_TIME
 import switch as s
+import stp
 import node as n
+import aioengine
+import des
+import shard
+import hac
+import metrics
+import firewall
+import capture as cap
+import log
+import transport as tr
+from faults import FaultModel, FaultyTransport
 import argparse
-import re
+
+SAMPLE_TIME = 0.1 # Sec between metric samples of a threaded run
+CORRUPT = 0.05 # The 5% failure rate of the links
 
 class Main():
     """
     The primary test object as described in the asignment.
     """
 
-    def __init__(self, num_nodes: int) -> None:
+    def __init__(self, num_nodes: int,
+                 cut_through: bool = False, cores: int = 1) -> None:
 
         # Check that the number of nodes can be devided
 
         if (num_nodes % 2):
             raise Exception("Number of nodes must be even.")
+        if (cores < 1):
+            raise Exception("At least one core switch is needed.")
+
+        # Node numbers are used as the device part of their HAC
+
+        if (num_nodes - 1 > hac.FORMAT.max_dev):
+            raise Exception(f"At most {hac.FORMAT.max_dev + 1} nodes"
+                            f" fit in {hac.FORMAT}, use wider HACs.")
 
         # Read firewall
-        global_blocks = list()
-        local_blocks = list()
         with open("firewall.txt") as f:
-            rules = f.readlines()
-            for x in rules:
-                m = re.match(r"(.*): (.*)", x)
-                if (m is None):
-                    raise Exception("Malformed Node File!")
-                if ("#" in m[1]):
-                    shac = m[1].replace("#", "0")
-                    global_blocks.append(shac)
-                else:
-                    local_blocks.append(m[1])
+            global_blocks, local_blocks = firewall.parse(f)
 
         # Set up ports
         nets = cycle([1,2])
@@ -55,7 +66,7 @@ class Main():
         for i in range(num_nodes):
             self.node_ports.append((i, i + num_nodes,
                                     f'{next(nets)}_{i}'))
-        print(self.node_ports)
+        log.info(log.SIM, "{}", self.node_ports)
 
         # Set up nodes
 
@@ -64,63 +75,188 @@ class Main():
             tmp = n.Node(*i)
             self.nodes.append(tmp)
 
-        # set up backbone ports
+        # set up backbone ports, every core switch has a link to
+        # each edge switch
 
         tmp_out = [x[0] for x in self.node_ports]
         tmp_in = [x[1] for x in self.node_ports]
-        backbone_in_left = num_nodes * 2
-        backbone_out_left = (num_nodes * 2) + 1
-        backbone_in_right = (num_nodes * 2) + 2
-        backbone_out_right = (num_nodes * 2) + 3
+        backbone = [range(num_nodes * 2 + i * 4, num_nodes * 2 + i * 4 + 4)
+                    for i in range(cores)]
+        backbone_in_left = [x[0] for x in backbone]
+        backbone_out_left = [x[1] for x in backbone]
+        backbone_in_right = [x[2] for x in backbone]
+        backbone_out_right = [x[3] for x in backbone]
 
-        # Set up switches
+        # Set up switches, the core switches share a bridge id so
+        # the edge switches spread their flows over all of them
+        # (see stp.py)
 
         self.switches = []
         tmp = s.Switch([*tmp_in[:num_nodes//2],
-                        backbone_in_left],
+                        *backbone_in_left],
                        [*tmp_out[:num_nodes//2],
-                        backbone_out_left])
+                        *backbone_out_left], cut_through=cut_through)
         self.switches.append(tmp)
         tmp = s.Switch([*tmp_in[num_nodes//2:],
-                        backbone_in_right],
+                        *backbone_in_right],
                        [*tmp_out[num_nodes//2:],
-                        backbone_out_right])
+                        *backbone_out_right], cut_through=cut_through)
         self.switches.append(tmp)
-        tmp = s.Switch([backbone_out_right, backbone_out_left],
-                [backbone_in_right, backbone_in_left], global_blocks,
-                       local_blocks)
-        self.switches.append(tmp)
-
-    def run_sim(self):
+        for i in range(cores):
+            tmp = s.Switch([backbone_out_right[i], backbone_out_left[i]],
+                    [backbone_in_right[i], backbone_in_left[i]],
+                           global_blocks, local_blocks,
+                           cut_through=cut_through,
+                           bridge_id=stp.CORE_ID)
+            self.switches.append(tmp)
+        for i, x in enumerate(self.switches):
+            x.metrics.name = f"switch{i}"
+
+    def run_sim(self, engine: str = "thread",
+                transport: str = "tcp", shards: int = 1,
+                latency: float = des.LATENCY,
+                bandwidth: float = des.BANDWIDTH,
+                seed: int = des.SEED,
+                faults: FaultModel = None):
         """
         Runs the simulation of the programed network.
+
+        engine selects how the devices are run:
+          - thread → threads for every device
+          - asyncio → coroutines on a single event loop
+          - des → events on a virtual clock, with links of the
+            given latency (sec) and bandwidth (bits/sec) and the
+            random frame errors seeded by seed (see des.py)
+
+        transport selects how frames get between devices,
+        see tr.make for the options. The des engine has its own
+        links and does not use it.
+
+        faults is put on every link, see faults.py.
+
+        With more than 1 shard the devices are split over that many
+        processes (see shard.py), and transport is not used.
         """
 
+        if (engine == "des"):
+            if (shards > 1):
+                raise Exception("The des engine can not be sharded!")
+            des.run([*self.nodes, *self.switches], self.nodes,
+                    latency, bandwidth, seed, faults)
+            self.close_sinks()
+            self.report()
+            return
+
+        if (shards > 1):
+            shard.run(self.nodes, self.switches, shards, engine,
+                      faults)
+            self.close_sinks()
+            self.report()
+            return
+
         # Start devices in random order
 
         devices = [*self.nodes, *self.switches]
         shuffle(devices)
 
-        # For each netdevice object start its threads
-
+        link = tr.make(transport)
+        if (faults):
+            link = FaultyTransport(link, faults)
+        for dev in devices:
+            dev.transport = link
+
+        if (engine == "asyncio"):
+            aioengine.run(devices, self.nodes)
+            log.info(log.SIM, "SHUTING DOWN COROUTINES")
+            self.close_sinks()
+            self.report()
+            return
+        elif (engine != "thread"):
+            raise Exception(f"Unknown engine {engine}!")
+
+        # Bind every listening port, then start the threads of
+        # each netdevice object, and let them go once all are up
+
+        ready = t.Event()
+        start = time()
+        link.bind(devices)
         for dev in devices:
-            dev.start_device()
+            dev.start_device(ready)
+        ready.set()
+        log.info(log.SIM, "{} DEVICES READY IN {:.3f} SEC",
+                 len(devices), time() - start)
 
-        # Periodicly check to see if the threads are done
+        # Periodicly check to see if the threads are done,
+        # and sample the metrics so their peaks are known
 
         running = True
+        sample_at = 0
         while (running):
             sleep(SLEEP_TIME)
             tmp = [x for x in self.nodes
                    if (not x.exit)]
             running = bool(tmp)
+            if (time() >= sample_at):
+                self.metrics()
+                sample_at = time() + SAMPLE_TIME
 
         # Shutdown threads and ports
 
-        print(f"SHUTING DOWN THREADS")
+        log.info(log.SIM, "SHUTING DOWN THREADS")
         for dev in [*self.nodes, *self.switches]:
-            for soc in dev.sockets_in:
-                soc[1].close()
+            dev.transport.close(dev)
+        self.close_sinks()
+        self.report()
+
+    def close_sinks(self):
+        """
+        Write out and close the output files of all nodes, and the
+        capture files of all devices.
+        """
+        for node in self.nodes:
+            node.sink.close()
+        for dev in [*self.nodes, *self.switches]:
+            if (dev.capture is not None):
+                dev.capture.close()
+
+    def capture(self, prefix: str):
+        """
+        Capture the frames of every device to <prefix><name>.hcap,
+        see capture.py.
+        """
+        for dev in [*self.nodes, *self.switches]:
+            dev.capture = cap.CaptureWriter(
+                    f"{prefix}{dev.metrics.name}.hcap", dev)
+
+    def metrics(self) -> list:
+        """
+        Snapshots of the metrics of every device, see metrics.py.
+        Can be called from any thread while the simulation runs.
+        """
+        return [x.snapshot() for x in [*self.nodes, *self.switches]]
+
+    def dump_metrics(self, path: str):
+        """
+        Write the metrics of every device to a file, in the
+        Prometheus text format if it ends in .prom, else as JSON.
+        """
+        snaps = self.metrics()
+        with open(path, "w") as f:
+            if (path.endswith(".prom")):
+                f.write(metrics.to_prometheus(snaps))
+            else:
+                f.write(metrics.to_json(snaps))
+
+    def report(self):
+        """
+        Print the goodput of every node that recieved data.
+        """
+        for node in self.nodes:
+            tmp = node.goodput()
+            if (tmp is not None):
+                log.info(log.SIM, "## NODE {} RECIEVED {} MESSAGES,"
+                         " {} BYTES AT {:.0f} BYTES/SEC", node.node_id,
+                         node.rcv_msgs, node.rcv_bytes, tmp)
 
 if __name__ == '__main__':
 
@@ -132,20 +268,119 @@ if __name__ == '__main__':
     parser.add_argument('nodes',
                         metavar='N',
                         type=int,
-                        help='Number of nodes (max 255) used.')
+                        help='Number of nodes used.')
+    parser.add_argument('--engine',
+                        choices=['thread', 'asyncio', 'des'],
+                        default='thread',
+                        help='How the devices are run.')
+    parser.add_argument('--transport',
+                        choices=['tcp', 'inproc', 'inproc-raw'],
+                        default='tcp',
+                        help='How frames get between devices.')
+    parser.add_argument('--net-bits',
+                        type=int,
+                        default=4,
+                        help='Bits of the network part of a HAC.')
+    parser.add_argument('--dev-bits',
+                        type=int,
+                        help='Bits of the device part of a HAC (4, or'
+                             ' 16 if there are more nodes than fit).')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='Number of processes to run on.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=des.LATENCY,
+                        help='Sec a frame takes to cross a link'
+                             ' (des engine only).')
+    parser.add_argument('--bandwidth',
+                        type=float,
+                        default=des.BANDWIDTH,
+                        help='Bits per sec of a link (des engine only).')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=des.SEED,
+                        help='Seed of the link faults.')
+    parser.add_argument('--corrupt',
+                        type=float,
+                        default=CORRUPT,
+                        help='Chance of a frame getting a bad crc.')
+    parser.add_argument('--loss',
+                        type=float,
+                        default=0,
+                        help='Chance of a frame being lost.')
+    parser.add_argument('--duplicate',
+                        type=float,
+                        default=0,
+                        help='Chance of a frame arriving twice.')
+    parser.add_argument('--reorder',
+                        type=float,
+                        default=0,
+                        help='Chance of a frame being overtaken.')
+    parser.add_argument('--delay',
+                        type=float,
+                        default=0,
+                        help='Sec added to every frame.')
+    parser.add_argument('--cut-through',
+                        action='store_true',
+                        help='Switches forward frames without checking'
+                             ' their crc.')
+    parser.add_argument('--cores',
+                        type=int,
+                        default=1,
+                        help='Number of core switches linking the two'
+                             ' edge switches.')
+    parser.add_argument('--metrics',
+                        metavar='PATH',
+                        help='Write the metrics of all devices to PATH'
+                             ' (Prometheus text if it ends in .prom,'
+                             ' else JSON).')
+    parser.add_argument('--capture',
+                        metavar='PREFIX',
+                        help='Capture the frames of every device to'
+                             ' PREFIX<device>.hcap (see capture.py).')
+    parser.add_argument('--log-level',
+                        choices=list(log.LEVELS),
+                        default='info',
+                        help='Lowest level of events shown,'
+                             ' debug shows every frame.')
+    parser.add_argument('--log',
+                        nargs='+',
+                        choices=log.CATEGORIES,
+                        metavar='CATEGORY',
+                        help='Only show events of these categories'
+                             f' ({", ".join(log.CATEGORIES)}).')
     args = parser.parse_args()
-    if ((args.nodes > 255) or (args.nodes <= 0)):
+    if (args.nodes <= 0):
         raise Exception("N out of range!")
 
+    # Node numbers are the device part of their HAC, so widen it
+    # to fit them all unless told otherwise
+
+    dev_bits = args.dev_bits
+    if (dev_bits is None):
+        dev_bits = 4 if (args.nodes <= 1 << 4) else 16
+    hac.set_format(args.net_bits, dev_bits)
+    log.configure(log.LEVELS[args.log_level], args.log)
+
     # set up sim env
 
-    print(f"STARTING SIM")
+    log.info(log.SIM, "STARTING SIM")
     tmp = None
-    tmp = Main(args.nodes)
+    tmp = Main(args.nodes, args.cut_through, args.cores)
+    if (args.capture):
+        tmp.capture(args.capture)
 
     # run sim
 
-    tmp.run_sim()
-    print(f"SIM FINISHED")
+    faults = FaultModel(args.corrupt, args.loss, args.duplicate,
+                        args.reorder, args.delay, seed=args.seed)
+    tmp.run_sim(args.engine, args.transport, args.shards,
+                args.latency, args.bandwidth, args.seed, faults)
+    if (args.metrics):
+        tmp.dump_metrics(args.metrics)
+    log.info(log.SIM, "SIM FINISHED")
+    log.flush()
 
 
@@ -0,0 +1,204 @@
+"""
+Counters, gauges and histograms kept by every NetDevice.
+
+Counting is done without locks: every thread that counts on a
+device gets its own dict, and snapshots add them up. Gauges (like
+queue depths) are read when a snapshot is taken, and the highest
+value seen by any snapshot is kept as well. Snapshots are plain
+dicts that can be dumped as JSON or as Prometheus text.
+"""
+
+import json
+import threading as t
+
+# Upper bounds in sec of the ACK round trip time histogram buckets
+
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10)
+
+HISTOGRAMS = {"ack_rtt"} # The names passed to Metrics.observe
+
+PREFIX = "hac_" # Prefix of all Prometheus metric names
+
+class Metrics():
+    """
+    The metrics of one device.
+
+    Counters can be split up by port, counters without a port
+    are reported with the port "".
+    """
+
+    def __init__(self, name: str = "") -> None:
+        self.name = name
+        self.local = t.local()
+        self.counts = [] # The counter dict of every thread
+        self.lock = t.Lock() # Only held to add a thread
+        self.peaks = dict()
+        self.final = None # Snapshot from another process
+
+    def _counts(self) -> dict:
+        """
+        The counter dict of the current thread.
+        """
+        try:
+            return self.local.counts
+        except AttributeError:
+            ret = self.local.counts = dict()
+            with self.lock:
+                self.counts.append(ret)
+            return ret
+
+    def inc(self, name: str, port: int = None, n: int = 1):
+        """
+        Add n to a counter.
+        """
+        tmp = self._counts()
+        key = (name, port)
+        tmp[key] = tmp.get(key, 0) + n
+
+    def observe(self, name: str, value: float):
+        """
+        Add a value to a histogram.
+        """
+        tmp = self._counts()
+        for i, x in enumerate(RTT_BUCKETS):
+            if (value <= x):
+                break
+        else:
+            i = len(RTT_BUCKETS)
+        key = (name, i)
+        tmp[key] = tmp.get(key, 0) + 1
+        key = (name, "sum")
+        tmp[key] = tmp.get(key, 0) + value
+
+    def snapshot(self, gauges: dict = {}) -> dict:
+        """
+        Add up the counters of all threads.
+
+        Returns a dict with:
+          - counters → name → port → count
+          - gauges → name → value, with the peak of every gauge
+            as <name>_peak
+          - histograms → name → cumulative bucket counts, sum and
+            count
+        """
+        if (self.final is not None):
+            return self.final
+
+        totals = dict()
+        with self.lock:
+            counts = [x.copy() for x in self.counts]
+        for tmp in counts:
+            for key, value in tmp.items():
+                totals[key] = totals.get(key, 0) + value
+
+        counters = dict()
+        hists = dict()
+        for (name, port), value in totals.items():
+            if (name in HISTOGRAMS):
+                hist = hists.setdefault(name, {
+                    "buckets": [0] * (len(RTT_BUCKETS) + 1),
+                    "sum": 0})
+                if (port == "sum"):
+                    hist["sum"] = value
+                else:
+                    hist["buckets"][port] += value
+            else:
+                port = "" if (port is None) else str(port)
+                counters.setdefault(name, dict())[port] = value
+        for hist in hists.values():
+            total = 0
+            for i, x in enumerate(hist["buckets"]):
+                total += x
+                hist["buckets"][i] = total
+            hist["count"] = total
+
+        ret_gauges = dict()
+        for name, value in gauges.items():
+            peak = max(self.peaks.get(name, value), value)
+            self.peaks[name] = peak
+            ret_gauges[name] = value
+            ret_gauges[f"{name}_peak"] = peak
+
+        return {"device": self.name, "counters": counters,
+                "gauges": ret_gauges, "histograms": hists}
+
+def to_json(snaps: list) -> str:
+    """
+    Dump a list of snapshots as JSON.
+    """
+    return json.dumps(snaps, indent=2)
+
+def to_prometheus(snaps: list) -> str:
+    """
+    Dump a list of snapshots in the Prometheus text format.
+    """
+    lines = dict() # metric → (type, [lines])
+
+    def add(metric: str, kind: str, line: str):
+        lines.setdefault(metric, (kind, []))[1].append(line)
+
+    for snap in snaps:
+        dev = f'device="{snap["device"]}"'
+        for name, ports in snap["counters"].items():
+            metric = f"{PREFIX}{name}_total"
+            for port, value in ports.items():
+                label = dev if (port == "") else f'{dev},port="{port}"'
+                add(metric, "counter", f"{metric}{{{label}}} {value}")
+        for name, value in snap["gauges"].items():
+            metric = f"{PREFIX}{name}"
+            add(metric, "gauge", f"{metric}{{{dev}}} {value}")
+        for name, hist in snap["histograms"].items():
+            metric = f"{PREFIX}{name}_seconds"
+            for le, value in zip([*RTT_BUCKETS, "+Inf"],
+                                 hist["buckets"]):
+                add(metric, "histogram",
+                    f'{metric}_bucket{{{dev},le="{le}"}} {value}')
+            add(metric, "histogram",
+                f"{metric}_sum{{{dev}}} {hist['sum']}")
+            add(metric, "histogram",
+                f"{metric}_count{{{dev}}} {hist['count']}")
+
+    ret = []
+    for metric, (kind, tmp) in lines.items():
+        ret.append(f"# TYPE {metric} {kind}")
+        ret.extend(tmp)
+    return "\n".join(ret) + "\n"
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    tmp = Metrics("switch0")
+
+    def work():
+        for i in range(1000):
+            tmp.inc("frames_sent", i % 2)
+
+    jobs = [t.Thread(target=work) for i in range(4)]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    tmp.inc("floods")
+    tmp.observe("ack_rtt", 0.003)
+    tmp.observe("ack_rtt", 20)
+
+    snap = tmp.snapshot({"rcv_q": 3})
+    tmp.snapshot({"rcv_q": 1})
+    snap2 = tmp.snapshot({"rcv_q": 2})
+    print(f"snapshot: {snap}")
+    assert snap["counters"]["frames_sent"] == {"0": 2000, "1": 2000}
+    assert snap["counters"]["floods"] == {"": 1}
+    assert snap2["gauges"] == {"rcv_q": 2, "rcv_q_peak": 3}
+    hist = snap["histograms"]["ack_rtt"]
+    assert (hist["count"] == 2) and (hist["buckets"][2] == 1)
+
+    text = to_prometheus([snap])
+    print(text)
+    assert 'hac_frames_sent_total{device="switch0",port="1"} 2000' \
+            in text
+    assert 'hac_ack_rtt_seconds_bucket{device="switch0",le="+Inf"} 2' \
+            in text
+    assert text.count("# TYPE hac_rcv_q gauge") == 1
+    assert json.loads(to_json([snap]))[0]["device"] == "switch0"
@@ -7,93 +7,256 @@ Flows the folowing fomrat:
   - ordering → check order
   - priority
   - data
+
+On the wire a msg is a header followed by the utf-8 data. There
+are two header formats, all devices of a simulation use the same one
+(see set_version and hac.py):
+  - v1, 8 bytes → src, dest, crc, size, ordering, priority, atype
+  - v2, 15 bytes → version (2), src, dest, crc, size, ordering,
+    priority, atype, with src and dest 4 bytes each
+The crc is a CRC16 (see crc.py) of the whole frame with the crc
+field set to 0.
+
+Nothing here adds errors, faults.py does that on the links between
+devices.
 """
 
-ERRS = True # Enabels the 5% failure rate.
+import struct
+import crc as c
+
+HEADER = struct.Struct("!2BH4B")
+CRC_AT = 2 # Offset of the crc in the header
+HEADER_V2 = struct.Struct("!B2IH4B")
+CRC_AT_V2 = 9
+CRC = c.CRC16
+NO_CRC = bytes(2) # The crc field while the crc is calculated
 
-from dataclasses import dataclass, field
-from random import randint
+VERSION = 1 # Header format in use
 
 
-@dataclass(order=True)
 class Msg():
-    priority: int
-    src: int = field(compare=False)
-    dest: int = field(compare=False)
-    size: int = field(compare=False)
-    atype: int = field(compare=False)
-    ordering: int = field(compare=False)
-    data: str = field(compare=False)
-    crc: bool = field(compare=False, default=True)
+    """
+    A single frame.
+
+    Msgs are ordered (and compared) by priority only, so they can be
+    put on a PriorityQueue. The data of a Msg that came from loads
+    is only decoded once it is asked for.
+
+    A Msg from peek keeps the frame it was read from (_wire), which
+    dumps sends on as is. Change it with bounce (or set data), which
+    drop the frame, copies do not keep it either.
+    """
+    __slots__ = ("priority", "src", "dest", "size", "atype",
+                 "ordering", "crc", "_data", "_payload", "_wire")
+
+    def __init__(self, priority: int, src: int, dest: int,
+                 size: int, atype: int, ordering: int,
+                 data: str, crc: bool = True) -> None:
+        self.priority = priority
+        self.src = src
+        self.dest = dest
+        self.size = size
+        self.atype = atype
+        self.ordering = ordering
+        self.crc = crc
+        self._data = data
+        self._payload = None
+        self._wire = None
+
+    @property
+    def data(self) -> str:
+        if (self._data is None):
+            self._data = str(self._payload, "utf-8")
+        return self._data
+
+    @data.setter
+    def data(self, value: str):
+        self._data = value
+        self._payload = None
+        self._wire = None
+
+    @property
+    def payload(self) -> bytes:
+        """
+        The encoded data.
+        """
+        if (self._payload is None):
+            self._payload = self._data.encode("utf-8")
+        return self._payload
+
+    def bounce(self, atype: int):
+        """
+        Turn the Msg into an ACK or NACK (atype) back to its
+        sender.
+        """
+        self.size = 0
+        self.atype = atype
+        self.crc = True
+        self.src, self.dest = self.dest, self.src
+        self._wire = None
+
+    def __lt__(self, other) -> bool:
+        return (self.priority < other.priority)
+
+    def __le__(self, other) -> bool:
+        return (self.priority <= other.priority)
+
+    def __gt__(self, other) -> bool:
+        return (self.priority > other.priority)
+
+    def __ge__(self, other) -> bool:
+        return (self.priority >= other.priority)
+
+    def __eq__(self, other) -> bool:
+        if (other.__class__ is not self.__class__):
+            return NotImplemented
+        return (self.priority == other.priority)
+
+    __hash__ = None
+
+    def __copy__(self):
+        ret = Msg.__new__(Msg)
+        for x in Msg.__slots__:
+            setattr(ret, x, getattr(self, x))
+        ret._wire = None
+        return ret
+
+    def __repr__(self) -> str:
+        return (f"Msg(priority={self.priority}, src={self.src},"
+                f" dest={self.dest}, size={self.size},"
+                f" atype={self.atype}, ordering={self.ordering},"
+                f" data={self.data!r}, crc={self.crc})")
 
 def calc_crc(data: bytes) -> bytes:
     """
     Calculates the crc for a given set of bytes.
     """
-    tmp = sum(data)
-    tmp = tmp.to_bytes(((tmp.bit_length() + 7) // 8), "big")
+    return CRC.calc(data).to_bytes(2, "big")
+
+def set_version(version: int):
+    """
+    Select the header format used by dumps and loads.
+    """
+    global VERSION
+    if (version not in (1, 2)):
+        raise Exception(f"Unknown header version {version}!")
+    VERSION = version
 
-    if (randint(0,100) < 5):
-        print("?? ADDING ERROR!")
-        tmp = b'\x68\x20\x73\x75\x63\x6B\x73'
+def header_size() -> int:
+    """
+    The size of the header in use.
+    """
+    return HEADER.size if (VERSION == 1) else HEADER_V2.size
 
-    return tmp[-1].to_bytes(1, "big")
+def frame_size(msg: Msg) -> int:
+    """
+    The number of bytes dumps will return for msg.
+    """
+    if (msg._wire is not None):
+        return len(msg._wire)
+    return header_size() + len(msg.payload)
 
-def _dump_empty(msg: Msg) -> bytes:
+def _bad(msg: Msg) -> int:
     """
-    Used internaly for crc calculation.
+    What to flip in the crc of a Msg, a Msg that failed its check
+    (or was corrupted by faults.py) stays bad when sent on.
     """
-    ret = msg.src.to_bytes(1, "big")
-    ret += msg.dest.to_bytes(1, "big")
-    ret += b'\x00'
-    ret += msg.size.to_bytes(1, "big")
-    ret += msg.ordering.to_bytes(1, "big")
-    ret += msg.priority.to_bytes(1, "big")
-    ret += msg.atype.to_bytes(1, "big")
-    ret += msg.data.encode("utf-8")
+    return 0 if (msg.crc) else 1
 
-    return ret
+def dumps_into(msg: Msg, buf: bytearray, offset: int = 0) -> int:
+    """
+    Writes a Msg into buf at offset.
+    Returns the offset after the end of the frame.
+    """
+    if (msg._wire is not None):
+        end = offset + len(msg._wire)
+        buf[offset:end] = msg._wire
+        return end
+    payload = msg.payload
+    if (VERSION == 1):
+        HEADER.pack_into(buf, offset, msg.src, msg.dest, 0,
+                         msg.size, msg.ordering, msg.priority,
+                         msg.atype)
+        start = offset + HEADER.size
+        at = offset + CRC_AT
+    else:
+        HEADER_V2.pack_into(buf, offset, VERSION, msg.src, msg.dest,
+                            0, msg.size, msg.ordering, msg.priority,
+                            msg.atype)
+        start = offset + HEADER_V2.size
+        at = offset + CRC_AT_V2
+    end = start + len(payload)
+    buf[start:end] = payload
+    value = CRC.calc(memoryview(buf)[offset:end]) ^ _bad(msg)
+    buf[at:at + 2] = value.to_bytes(2, "big")
+    return end
 
 def dumps(msg: Msg) -> bytes:
     """
     Turns a Msg to bytes to be sent.
     """
+    if (msg._wire is not None):
+        return msg._wire
+    payload = msg.payload
+    if (VERSION == 1):
+        value = CRC.calc(payload, CRC.calc(HEADER.pack(
+                msg.src, msg.dest, 0, msg.size, msg.ordering,
+                msg.priority, msg.atype))) ^ _bad(msg)
+        return HEADER.pack(msg.src, msg.dest, value, msg.size,
+                           msg.ordering, msg.priority,
+                           msg.atype) + payload
+    value = CRC.calc(payload, CRC.calc(HEADER_V2.pack(
+            VERSION, msg.src, msg.dest, 0, msg.size, msg.ordering,
+            msg.priority, msg.atype))) ^ _bad(msg)
+    return HEADER_V2.pack(VERSION, msg.src, msg.dest, value,
+                          msg.size, msg.ordering, msg.priority,
+                          msg.atype) + payload
 
-    ret = _dump_empty(msg)
 
-    crc = calc_crc(ret)
+def loads(msg: bytes, check: bool = True) -> Msg:
+    """
+    Turns a bytes to Msg.
 
-    ret = msg.src.to_bytes(1, "big")
-    ret += msg.dest.to_bytes(1, "big")
-    ret += crc
-    ret += msg.size.to_bytes(1, "big")
-    ret += msg.ordering.to_bytes(1, "big")
-    ret += msg.priority.to_bytes(1, "big")
-    ret += msg.atype.to_bytes(1, "big")
-    ret += msg.data.encode("utf-8")
+    The data is kept as a view of msg until it is used. If check
+    is not set the crc is taken to be good without checking it.
+    """
+    view = memoryview(msg)
+    if (VERSION == 1):
+        src, dest, value, size, ordering, priority, atype = \
+                HEADER.unpack_from(view)
+        start = HEADER.size
+        at = CRC_AT
+    else:
+        version, src, dest, value, size, ordering, priority, \
+                atype = HEADER_V2.unpack_from(view)
+        if (version != VERSION):
+            raise Exception(f"Got a v{version} frame, expected"
+                            f" v{VERSION}!")
+        start = HEADER_V2.size
+        at = CRC_AT_V2
 
-    return ret
+    ret = Msg(priority, src, dest, size, atype, ordering, None)
+    ret._payload = view[start:]
 
+    # The crc was calculated with its own field set to 0
 
-def loads(msg: bytes) -> Msg:
-    """
-    Turns a bytes to Msg.
-    """
-    src = msg[0]
-    dest = msg[1]
-    crc = msg[2]
-    size = msg[3]
-    ordering = msg[4]
-    priority = msg[5]
-    atype = msg[6]
-    data = msg[7:].decode("utf-8")
+    if (check):
+        ret.crc = (CRC.calc(view[at + 2:], CRC.calc(
+                NO_CRC, CRC.calc(view[:at]))) == value)
 
-    ret = Msg(priority, src, dest, size, atype, ordering, data)
+    return ret
 
-    tmp = _dump_empty(ret)
-    tmp = calc_crc(tmp)
-    ret.crc = (int.from_bytes(tmp, "big") == crc)
+def peek(frame: bytes, check: bool = True) -> Msg:
+    """
+    Read a frame for a device that passes it on without looking
+    at its data. The Msg keeps the frame, and dumps returns it
+    untouched.
 
+    With check off (cut through) only the header is read, so the
+    cost does not depend on the size of the data.
+    """
+    ret = loads(frame, check)
+    ret._wire = frame
     return ret
 
 
@@ -108,3 +271,50 @@ def unit_test():
     tmp2 = loads(b)
     print(f"output: {tmp2}")
     assert tmp == tmp2
+    assert tmp2.data == "test" and tmp2.crc
+
+    # Any flipped bit fails the check, and a bad Msg stays bad
+
+    for i in range(len(b) * 8):
+        bad = bytearray(b)
+        bad[i // 8] ^= 1 << (i % 8)
+        assert not loads(bytes(bad)).crc
+    tmp2 = loads(bytes(bad))
+    assert not loads(dumps(tmp2)).crc
+
+    # Frames read with peek are passed on as they are, even
+    # unchecked bad ones
+
+    tmp2 = peek(b, check=False)
+    assert (dumps(tmp2) is b) and (tmp2.dest == 4)
+    assert dumps(peek(bytes(bad), check=False)) == bytes(bad)
+    assert not peek(bytes(bad)).crc
+    tmp2.bounce(1)
+    assert loads(dumps(tmp2)).dest == 2
+
+    # Frames can be written back to back into one buffer
+
+    buf = bytearray(frame_size(tmp) * 2)
+    end = dumps_into(tmp, buf, dumps_into(tmp, buf))
+    assert end == len(buf)
+    assert bytes(buf) == b * 2
+    assert loads(buf[end // 2:]).data == "test"
+
+    # v2 headers carry 4 byte addresses
+
+    set_version(2)
+    try:
+        tmp = Msg(1, 0x10002, 0xFFFF0001, 4, 0, 7, "wide")
+        b = dumps(tmp)
+        assert len(b) == frame_size(tmp) == HEADER_V2.size + 4
+        buf = bytearray(len(b))
+        dumps_into(tmp, buf)
+        assert bytes(buf) == b
+        tmp2 = loads(b)
+        print(f"output: {tmp2}")
+        assert tmp2.crc and (tmp2.dest == 0xFFFF0001)
+        assert (tmp2.src, tmp2.data) == (0x10002, "wide")
+        b = b[:-1] + b"x"
+        assert not loads(b).crc
+    finally:
+        set_version(1)
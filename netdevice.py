@@ -1,101 +1,137 @@
 """
 Contains all the features shared by the nodes and the switches.
 This includes send / recieve functionality, which is built
-on top of TCP/IP, although the statefull nature of TCP is
-intenionaly ignored as this would not be an accurate
-simulation of network switching communication.
+on top of a Transport (TCP/IP by default, see transport.py),
+although the statefull nature of TCP is intenionaly ignored as
+this would not be an accurate simulation of network switching
+communication.
 """
 
 import itertools as it
 from dataclasses import field, dataclass
-from queue import PriorityQueue
-from random import randint
+from queue import PriorityQueue, Empty
 from time import time, sleep
 import socket
-from msg import Msg, dumps, loads
+from msg import Msg, dumps, loads, frame_size
+from transport import Transport, TcpTransport
+from metrics import Metrics
+from firewall import Firewall, ADD_RULE, DEL_RULE
+from stp import BPDU
+from scheduler import Scheduler, CLASSES
+import hac
+import log
 import threading as t
 
 SLEEP_TIME = 0.001 # How long to wait in sec between loops
-TCP_PORT_PREFIX = 3000 + randint(0,100)
 
 # How long to wait on a conections
 
 socket.setdefaulttimeout(1)
 
+# Nagle style batching of outgoing frames. After the first frame
+# the sender waits up to FLUSH_TIME sec for more frames, or until
+# MAX_BATCH bytes are queued, before writing them all at once.
+
+FLUSH_TIME = 0.0005
+MAX_BATCH = 1 << 16
+
 @dataclass
 class NetDevice():
     """
     Represents a device that can send and recieve messages.
 
-    A NetDevice has three threads that are activated when
-    it is run. One for sending, one for reciving, and
-    one thread that is overwriten by nodes and switches to do
-    their respective processing.
+    A NetDevice has threads that are activated when it is
+    run. One sender for every port in ports_out, and one thread
+    that is overwriten by nodes and switches to do their
+    respective processing. Recieving is done by the transport.
+
+    Messages queued with put_send go on the output queue of
+    their port (out_qs) and will be placed on the rcv_q on the
+    other end of the specified port.
+
+    Msg objects with the priority flag set are sent before
+    any others queued on their port, see scheduler.py for more
+    info on that. The number of priority classes and the weights
+    of the flows are set with sched_classes and flow_weights.
 
-    Messages put on the send_q in a tuple of the format:
-        (port to send on, Msg object)
-    Will be placed on the rcv_q on the other end of the
-    specified port.
+    Nodes and switches read the time with clock, which the
+    discrete event engine (see des.py) replaces with its own.
 
-    Msg objects with the priority flag set will
-    automatically be placed at the front fo th queue.
+    global_blocks (networks, as HACs with device 0) and local_blocks
+    (HACs) are the firewall rules the device starts with, they are
+    compiled into firewall (see firewall.py).
 
-    See msg.py for more info on that.
+    If capture is set (a capture.CaptureWriter) every frame sent or
+    recieved is written to it.
     """
     ports_in: list
     ports_out: list
     global_blocks: list = field(default_factory=list, repr=False)
     local_blocks: list = field(default_factory=list, repr=False)
     do_firewall: bool = False
-    send_q: PriorityQueue = field(
-            default_factory=PriorityQueue,
-            repr=False)
     rcv_q: PriorityQueue = field(
             default_factory=PriorityQueue,
             repr=False)
     node_id: int = -1
+    flush_time: float = field(default=FLUSH_TIME, repr=False)
+    sched_classes: int = field(default=CLASSES, repr=False)
+    flow_weights: dict = field(default=None, repr=False)
+    clock: object = field(default=time, repr=False, compare=False)
+    transport: Transport = field(default_factory=TcpTransport,
+                                 repr=False)
+    metrics: Metrics = field(default_factory=Metrics, repr=False,
+                             compare=False)
+    firewall: Firewall = field(init=False, repr=False, compare=False)
+    out_qs: dict = field(init=False, repr=False, compare=False)
+    capture: object = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.firewall = Firewall(self.global_blocks, self.local_blocks)
+        self.out_qs = {x: Scheduler(self.sched_classes,
+                                    self.flow_weights)
+                       for x in self.ports_out}
 
     def to_hac(self, s: str) -> int:
         """
         Takes a string of the format <number>_<number> and converts it to the
-        hack format where the first 4 bytes are the first number and the last 4
-        are the second mumber.
+        hack format where the high bits are the first number and the low
+        bits are the second mumber (4 and 4 by default, see hac.py).
         """
-        net, dev = s.split("_")
-        netb = (int(net) << 4).to_bytes(1, "big")
-        devb = (int(dev)).to_bytes(1, "big")
-        ret = int.from_bytes(netb, "big") | int.from_bytes(devb, "big")
-        return ret
+        return hac.FORMAT.to_hac(s)
 
     def from_hack(self, i: int) -> str:
         """
         Inverse of the to_hac function.
         """
-        net = (i & 0b11110000) >> 4
-        dev = i & 0b00001111
-        ret = f"{int(net)}_{int(dev)}"
-        return ret
+        return hac.FORMAT.from_hac(i)
 
     def is_blocked(self, msg: Msg) -> bool:
         """
         Checks to see if a message should be blocked by the firewall.
+        Only data frames are, ACKs and NACKs always get through so
+        the traffic the firewall let through can be acked.
         """
-        src_net = msg.src & 0b11110000
-        dest_net = msg.dest & 0b11110000
-        src_node = msg.src & 0b00001111
-        dest_node = msg.dest & 0b00001111
+        return ((msg.size > 0)
+                and self.firewall.blocked(msg.src, msg.dest))
 
-        is_local = (src_net == dest_net)
-        is_blocked = ((dest_net in self.global_blocks) or \
-                        (dest_node in self.local_blocks))
+    def put_send(self, next_hop: int, msg: Msg):
+        """
+        Queue a message to be sent on the given port.
+        """
 
-        if (is_blocked):
-            if (is_local):
-                return True
-            else:
-                return False
-        else:
-            return True
+        # Can not send on a port that is not attached
+
+        q = self.out_qs.get(next_hop, None)
+        if (q is None):
+            raise Exception(
+                    f"Can not send to port {next_hop:x}")
+        q.put(msg)
+
+    def put_rcv(self, port: int, msg: Msg):
+        """
+        Queue a message to be processed by process_msg.
+        """
+        self.rcv_q.put_nowait((port, msg))
 
     def __repr__(self) -> str:
         """
@@ -108,169 +144,215 @@ class NetDevice():
              f"\n\tWRITE PORTS: {w}")
         return t
 
-    def send_loop(self):
+    def prepare_send(self, next_hop: int, msg: Msg) -> bool:
         """
-        This function will be run as a background thread
-        sending any messages added to send_q.
+        Run the checks done on every outbound message.
+        Returns False if the message should not go on the wire.
         """
 
-        # Pull a message of the queue
+        # Check to see if the message is firewalled
+
+        if(self.is_blocked(msg)):
+            log.warn(log.FIREWALL, "|| FIREWALL BLOCKED MSG TO {}",
+                     msg.dest)
+            self.metrics.inc("firewall_blocks", next_hop)
 
+            # Send NACK, but not for ACKs and NACKs, their NACK
+            # would be blocked and bounced back again forever
+
+            if (msg.size):
+                msg.bounce(0b00000010)
+                self.put_rcv(-1, msg)
+            return False
+
+        return True
+
+    def next_batch(self, next_hop: int) -> list:
+        """
+        Wait for frames on the output queue of a port.
+        Returns a list of Msg objects, which may be empty if the
+        firewall blocked them.
+        """
+        q = self.out_qs[next_hop]
+        batch = []
+        size = 0
+        msg = q.get()
+        deadline = time() + self.flush_time
         while (True):
+            if (self.prepare_send(next_hop, msg)):
+                batch.append(msg)
+                size += frame_size(msg)
+            if (size >= MAX_BATCH):
+                break
+            try:
+                msg = q.get(timeout=max(deadline - time(), 0))
+            except Empty:
+                break
+        return batch
+
+    def send_batch(self, next_hop: int, batch: list):
+        """
+        Send a list of messages with a single write.
+        """
+        if (not self.transport.send(self, next_hop, batch)):
+
+            # If sending fails, put msgs back on queue
+
+            self.metrics.inc("delayed_sends", next_hop, len(batch))
+            log.warn(log.SEND, "-- {} MSGS VIA PORT {:#x} ARE DELAYED",
+                     len(batch), next_hop)
+            for msg in batch:
+                self.out_qs[next_hop].put(msg)
             sleep(SLEEP_TIME)
-            if(self.send_q.empty()):
-                continue
-            next_hop, msg  = self.send_q.get()
+            return
+
+        self.metrics.inc("frames_sent", next_hop, len(batch))
+        if (self.capture is not None):
+            self.capture.sent(self.clock(), next_hop, batch)
+        if (log.on(log.SEND, log.DEBUG)):
+            for msg in batch:
+                log.debug(log.SEND, ">> {} SENDS '{}{}' TO {} VIA PORT {:#x}",
+                          msg.src, "" if (msg.size) else "ACK:",
+                          str(msg.payload, "utf-8", "replace"),
+                          msg.dest, next_hop)
+
+    def send_loop(self, next_hop: int, ready: t.Event = None):
+        """
+        This function will be run as a background thread
+        for every output port, sending any messages queued on it
+        once ready is set.
+        """
+        if (ready is not None):
+            ready.wait()
+        while (True):
+            batch = self.next_batch(next_hop)
+            if (batch):
+                self.send_batch(next_hop, batch)
 
+    def recieve_frame(self, port: int, data: bytes):
+        """
+        Handle the raw bytes of a frame that arrived on a port.
+        """
+        if (self.capture is not None):
+            self.capture.recieved(self.clock(), port, data)
+        self._recieve(port, self.parse_frame(data))
 
-            # Check to see if the message is firewalled
+    def parse_frame(self, data: bytes) -> Msg:
+        """
+        Turn the raw bytes of a frame into a Msg.
+        """
+        return loads(data)
 
-            if(self.is_blocked(msg)):
-                print("|| FIREWALL BLOCKED MSG")
+    def recieve_msg(self, port: int, new_msg: Msg):
+        """
+        Handle a Msg that arrived on a port.
+        """
+        if (self.capture is not None):
+            self.capture.recieved(self.clock(), port, dumps(new_msg))
+        self._recieve(port, new_msg)
 
-                # Send NACK
+    def _recieve(self, port: int, new_msg: Msg):
+        self.metrics.inc("frames_received", port)
 
-                msg.size = 0
-                msg.atype = 0b00000010
-                tmp = msg.dest
-                msg.dest = msg.src
-                msg.src = tmp
-                self.rcv_q.put((-1, msg))
-                continue
+        # Add or remove firewall rules, repeats change nothing
 
+        if ((new_msg.atype == ADD_RULE) or (new_msg.atype == DEL_RULE)):
+            if (self.do_firewall and
+                    self.firewall.apply(new_msg.atype, new_msg.data)):
+                log.info(log.FIREWALL, "\\ RECIEVED FIREWALL RULE"
+                         " {} {} AT {}",
+                         "+" if (new_msg.atype == ADD_RULE) else "-",
+                         new_msg.data, self)
 
-            # Can not send on a port that is not attached
+        # Spanning tree frames (see stp.py) are not NACKed
 
-            if(next_hop not in self.ports_out):
-                raise Exception(
-                        f"Can not send to port {next_hop:x}")
+        elif ((new_msg.atype == BPDU) and (not new_msg.crc)):
+            self.metrics.inc("stp_drops", port)
 
+        # Check to see if its CRC is bad
 
-            # Create TCP/IP socket and send
+        elif (not new_msg.crc):
 
-            next_sock = socket.socket(socket.AF_INET,
-                                        socket.SOCK_STREAM)
-            next_port = next_hop + TCP_PORT_PREFIX
-            tmp = msg.data if (msg.size) else \
-                    f"ACK:{msg.data}"
-            try:
-                next_sock.connect(("", next_port))
-                tmp2 = dumps(msg)
-                next_sock.sendall(tmp2)
-                # print(f"-> SENT {tmp}:{next_port}")
-            except Exception as e:
-
-                # If sending fails, put msg back on queue
-
-                print(f"-- MSG '{tmp}'"
-                      f" TO {msg.dest}"
-                      f" VIA PORT {hex(next_hop)} IS DELAYED")
-                next_sock.close()
-                self.send_q.put((next_hop, msg))
-                continue
+            # Make send a NACK
 
-            print(f">> {msg.src} SENDS '{tmp}' TO {msg.dest}"
-                  f" VIA PORT {hex(next_hop)}")
+            new_msg.bounce(0b00000001)
+            self.put_rcv(-1, new_msg)
 
+            log.warn(log.RECV, "~~ CRC FAIL. NACK SENT.")
+            self.metrics.inc("crc_nacks", port)
+
+        else:
+            self.put_rcv(port, new_msg)
 
-            next_sock.close()
+            # Only decode the data when it is shown, switches pass
+            # it on as is (and it may not even be utf-8)
 
-    def listen(self):
+            if (log.on(log.RECV, log.DEBUG)):
+                log.debug(log.RECV, "<< DELIVERED '{}{}' VIA PORT {:#x}",
+                          "" if (new_msg.size) else "ACK:",
+                          str(new_msg.payload, "utf-8", "replace"), port)
+                if (new_msg.priority):
+                    log.debug(log.RECV, "!! PRIORITY PACKET FOUND"
+                              " MOVING TO FRONT!")
+
+    def gauges(self) -> dict:
+        """
+        The current value of every gauge of this device.
         """
-        Start Listening ports for incoming messages.
+        return {"send_q": sum(len(x) for x in self.out_qs.values()),
+                "rcv_q": self.rcv_q.qsize()}
 
-        NOTE: must be closed latter.
+    def snapshot(self) -> dict:
         """
-        self.sockets_in = []
-        for port in self.ports_in:
-            tmp = socket.socket(socket.AF_INET,
-                                          socket.SOCK_STREAM)
-            self.sockets_in.append((port, tmp))
-            my_tcp = TCP_PORT_PREFIX + port
-            try:
-                tmp.bind(("", my_tcp))
-            except Exception as e:
-                raise Exception(f'The ports that are required'
-                                f' for this program are in'
-                                f' in use. If you recently'
-                                f' ran this program, please'
-                                f' wait a couple seconds'
-                                f' while the OS marks them'
-                                f' as available.')
-            tmp.listen()
-
-    def recieve_loop(self):
-        """
-        On an indepenednt thread, recieve messages via TCP/IP
-        and add them to the rcv_q for processing by another
-        thread.
+        The metrics of this device, see metrics.py.
         """
-        while(True):
-            for port, socket in self.sockets_in:
-                tmp = tuple()
-                try:
-                    tmp = socket.accept()
-                except Exception as e:
-                    continue
-                clientsocket = tmp[0]
-                data = clientsocket.recv(255)
-                if (not data):
-                    continue
-                # print(f'<- {data}')
-                clientsocket.close()
-                new_msg = loads(data)
-
-                # Add firewall rules
-
-                if (new_msg.atype == 0b11111111):
-                    if (self.do_firewall):
-                        self.local_blocks.append(self.to_hac(new_msg.data))
-                    print(f"\\ RECIEVED FIREWALL RULE AT {self}")
-
-                # Check to see if its CRC is bad
-
-                elif (not new_msg.crc):
-
-                    # Make send a NACK
-
-                    new_msg.size = 0
-                    new_msg.atype = 0b00000001
-                    tmp = new_msg.dest
-                    new_msg.dest = new_msg.src
-                    new_msg.src = tmp
-                    self.rcv_q.put((-1, new_msg))
-
-                    print("~~ CRC FAIL. NACK SENT.")
-
-                else:
-                    self.rcv_q.put((port, new_msg))
-                    tmp = new_msg.data if (new_msg.size) \
-                            else f"ACK:{new_msg.data}"
-                    print(f"<< DELIVERED '{tmp}'"
-                          f" VIA PORT {hex(port)}")
-                    if (new_msg.priority):
-                        print(f"!! PRIORITY PACKET FOUND"
-                               " MOVING TO FRONT!")
-                sleep(SLEEP_TIME)
-
-    def process_loop(self):
-        """
-        The third thread to process frames on rcv_q.
+        return self.metrics.snapshot(self.gauges())
+
+    def process_msg(self, in_port: int, in_msg: Msg):
+        """
+        Handle one frame pulled from rcv_q.
         To be implemented in children.
         """
         ...
 
-    def start_device(self):
+    def tick(self) -> float:
+        """
+        Called by the processing thread before every frame, and
+        whenever the time it returns (in sec) has passed without
+        a frame. None means there is nothing to wait for.
+        To be implemented in children that need timers.
+        """
+        return None
+
+    def process_loop(self, ready: t.Event = None):
+        """
+        The third thread to process frames on rcv_q, once
+        ready is set.
+        """
+        if (ready is not None):
+            ready.wait()
+        while(True):
+            try:
+                in_port, in_msg = self.rcv_q.get(timeout=self.tick())
+            except Empty:
+                continue
+            self.process_msg(in_port, in_msg)
+
+    def start_device(self, ready: t.Event = None):
         """
         Start the above defined functions as threads.
+
+        The transport is opened right away, but if ready is
+        given nothing is sent or processed until it is set. Set
+        it once every device is started, so no frame is sent to
+        a port that is not listened on yet.
         """
-        self.listen()
+        self.transport.open(self)
         self.jobs = [
-                t.Thread(target=self.recieve_loop,
-                         daemon=True),
-                t.Thread(target=self.send_loop,
-                         daemon=True),
-                t.Thread(target=self.process_loop,
+                *[t.Thread(target=self.send_loop, args=(x, ready),
+                           daemon=True)
+                  for x in self.ports_out],
+                t.Thread(target=self.process_loop, args=(ready,),
                          daemon=True)
                 ]
         for job in self.jobs:
@@ -285,6 +367,34 @@ def unit_test():
     print(f"device: {tmp}")
     print(f"device: {tmp2}")
 
+    # The firewall lets the ACKs into a blocked network through
+
+    tmp3 = NetDevice([10], [11], global_blocks=[0x20])
+    assert tmp3.is_blocked(Msg(0, 0x12, 0x21, 1, 0, 0, "x"))
+    assert not tmp3.is_blocked(Msg(0, 0x12, 0x21, 0, 0, 0, "x"))
+
+    # A port with nobody listening does not hold up the others
+
+    from transport import InProcTransport
+    link = InProcTransport()
+    tmp = NetDevice([10], [11, 21], transport=link)
+    tmp2 = NetDevice([11], [10], transport=link)
+    for i in range(3):
+        tmp.put_send(21, Msg(0, 0x12, 0x23, 1, 0, i, "x"))
+    tmp.put_send(11, Msg(0, 0x12, 0x13, 1, 0, 0, "y"))
+    tmp2.transport.open(tmp2)
+    tmp.start_device()
+    port, got = tmp2.rcv_q.get(timeout=2)
+    print(f"output: {got}")
+    assert got.data == "y"
+
+    # Until it comes up
+
+    tmp3 = NetDevice([21], [10], transport=link)
+    link.open(tmp3)
+    for i in range(3):
+        tmp3.rcv_q.get(timeout=2)
+
 if __name__ == "__main__":
     unit_test()
 
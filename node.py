@@ -1,14 +1,151 @@
 """
 This module manages nodes and node funtions. Nodes are tracked
 via HACs (Hamdy Access Codes). These are my versions of MACs.
+
+Nodes send their data with a selective repeat ARQ. Frames to each
+destination are numbered on their own (in the ordering field) and
+at most window of them are unacked at once. Every frame has its own
+retransmit timer, and a NACK (from a failed CRC) makes the frame be
+resent right away. Recievers buffer frames that arrive out of order
+and only record them once every earlier frame from that sender has
+been recorded.
+
+A sender gives up on a frame after MAX_TRIES sends, or once it is
+firewalled, and on the rest of the message it is part of with it.
+It sends a SKIP notice (a frame without data) with the same number
+in place of every unacked frame of the message, and in place of its
+last fragment if that was not sent yet. The notices are resent and
+acked like any frame. The reciever skips the frames as the notices
+come in, and drops the message. If a notice is lost as well, the
+reciever skips the frame once it knows the sender moved on. Either a
+frame comes in window or more past it (all nodes use the same
+window, and senders never send that far past a frame they still
+try), or frames behind it have waited for gap_time sec, longer than
+a sender tries. Messages are not split over a skipped frame, so a
+partly recieved message is dropped with it. A node is not done while
+frames it recieved wait on a gap.
+
+Payloads larger than frag_size bytes are sent as several frames.
+Every fragment but the last has the MORE_FRAGS bit set in its
+atype, and the reciever joins them back together as they come in.
+Messages are cut from the node file's text lazily as the window
+opens, and partly recieved messages are limited to max_msg bytes and
+dropped if they stop making progress for REASSEMBLY_TIME sec.
+
+The node file itself is read a line at a time as messages are
+needed (see read_messages), and at most send_buf frames are unacked
+at once, so a node's memory does not grow with its input. Files of
+mmap_size bytes or more are memory mapped instead of read.
 """
-from time import sleep
-from netdevice import SLEEP_TIME, NetDevice
-from itertools import count
+from collections import deque
+from copy import copy
+from heapq import heappush, heappop
+from netdevice import NetDevice
 from msg import Msg
-import re
+from sink import OutputSink
+import log
+import mmap
+import os
 import random as r
 
+WINDOW = 16 # Max number of unacked frames per destination
+SEND_BUF = 256 # Max number of unacked frames in total
+RTO = 0.5 # Sec to wait for an ACK before resending
+MAX_TRIES = 10 # Sends of a frame before giving up on it
+
+# Sec a reciever waits for a missing frame before skipping it, a
+# little longer than a sender tries to send it
+
+GAP_TIME = sum(RTO * (2 ** min(i, 4)) for i in range(MAX_TRIES)) + RTO
+RTT_SAMPLES = 4096 # Send to ACK times kept for stats
+
+# The size field is one byte, so that is the most data a frame
+# can hold
+
+FRAG_SIZE = 255
+MAX_MSG = 1 << 24 # Max bytes of a reassembled message
+REASSEMBLY_TIME = 30 # Sec before a stalled message is dropped
+MMAP_SIZE = 1 << 26 # Node files this big are memory mapped
+
+# The ordering field is one byte, so sequence numbers wrap
+
+SEQ_MOD = 256
+
+# The atype of ACKs and NACKs (frames with size 0)
+
+ACK = 0b00000000
+CRC_NACK = 0b00000001
+FIREWALL_NACK = 0b00000010
+
+# The atype of a SKIP notice (also a frame with size 0), with the
+# MORE_FRAGS bit of the frame it stands in for
+
+SKIP = 0b00000011
+
+# Set in the atype of every fragment of a message but the last
+
+MORE_FRAGS = 0b10000000
+
+def _cut(payload: bytes, start: int, size: int) -> int:
+    """
+    Find where the fragment starting at start ends. Fragments are
+    at most size bytes and never split a utf-8 character, so each
+    one can be decoded on its own.
+    """
+    end = start + size
+    if (end >= len(payload)):
+        return len(payload)
+    while ((end > start + 1) and ((payload[end] & 0xC0) == 0x80)):
+        end -= 1
+    return end
+
+def read_messages(path: str, mmap_size: int = MMAP_SIZE):
+    """
+    Parse a node file on demand, lines are <dest>: <data>.
+    Yields (dest, data) with the data as bytes. Files of at least
+    mmap_size bytes are memory mapped, None never maps them.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if ((mmap_size is not None) and (size > 0)
+                and (size >= mmap_size)):
+            lines = iter(mmap.mmap(f.fileno(), 0,
+                                   access=mmap.ACCESS_READ).readline,
+                         b"")
+        else:
+            lines = f
+        for x in lines:
+            dest, sep, data = x.rstrip(b"\n").partition(b": ")
+            if (not sep):
+                raise Exception("Malformed Node File!")
+            yield str(dest, "utf-8"), data
+
+class Flow():
+    """
+    Sender state for the frames going to one destination. Frames
+    are numbered from 0 without wrapping, the ordering field holds
+    the number % SEQ_MOD.
+    """
+    __slots__ = ("base", "next_n", "unacked", "ends")
+
+    def __init__(self) -> None:
+        self.base = 0 # Lowest unacked number
+        self.next_n = 0 # Number of the next new frame
+        self.unacked = {} # number → Msg
+        self.ends = set() # Numbers from base on that end a message
+
+class Partial():
+    """
+    Reciever state for a message whose fragments are coming in.
+    """
+    __slots__ = ("parts", "size", "last", "dropped")
+
+    def __init__(self, now: float) -> None:
+        self.parts = [] # payloads of the fragments so far
+        self.size = 0
+        self.last = now # When the last fragment came in
+        self.dropped = False # Skip fragments till the last one
+
 class Node(NetDevice):
     """
     Represents a node as described in the directions.
@@ -16,134 +153,724 @@ class Node(NetDevice):
     def __init__(self, switch_in: int,
                  switch_out: int,
                  shac: str,
-                 priority=False) -> None:
+                 priority=False,
+                 sink_thread=False,
+                 window: int = WINDOW,
+                 rto: float = RTO,
+                 frag_size: int = FRAG_SIZE,
+                 max_msg: int = MAX_MSG,
+                 send_buf: int = SEND_BUF,
+                 mmap_size: int = MMAP_SIZE,
+                 gap_time: float = GAP_TIME) -> None:
         super().__init__([switch_in], [switch_out])
 
+        if (not (0 < window <= SEQ_MOD // 2)):
+            raise Exception(f"Window must be 1 to {SEQ_MOD // 2}!")
+        if (not (4 <= frag_size <= FRAG_SIZE)):
+            raise Exception(f"Fragment size must be 4 to {FRAG_SIZE}!")
+
         # Setup node variables
 
         self.shac = shac
         self.node_id = self.to_hac(shac)
+        self.metrics.name = f"node{shac}"
         self.gateway_switch = switch_out
-        send_dat = []
-        m_count = count()
-        self.send_dat = {}
+        self.window = window
+        self.rto = rto
+        self.frag_size = frag_size
+        self.max_msg = max_msg
+        self.send_buf = send_buf
+        self.gap_time = gap_time
+        self.priority = priority
         self.exit = False
-        self.rcv_counts = {}
 
-        # Setup node files
-
-        with open(f"node{self.shac}.txt") as f:
-            send_dat = f.readlines()
-        with open(f"node{self.shac}output.txt",
-                  "w") as f:
-            f.write("")
-
-        # Extract data that needs to tbe sent from node file
-
-        if (not send_dat):
+        # Sender state, frames are identified by (dest, number)
+
+        self.pending = None # The message being sent
+        self.frag_at = 0 # Bytes of pending already sent
+        self.drop_pending = False # Send only the end of pending
+        self.flows = {} # dest → Flow
+        self.send_dat = {} # (dest, number) → unacked Msg
+        self.deadlines = {} # (dest, number) → when to resend
+        self.tries = {} # (dest, number) → times sent
+        self.timers = [] # heap of (deadline, dest, number)
+        self.sent_at = {} # (dest, number) → first send
+        self.rtts = deque(maxlen=RTT_SAMPLES) # Latest send to ACK
+
+        # Reciever state, per sender
+
+        self.rcv_counts = {} # sender → next ordering to record
+        self.rcv_buf = {} # sender → {ordering: (payload, more)}, a
+                          # payload of None is a SKIP notice
+        self.partial = {} # sender → Partial
+        self.gaps = {} # sender → when frames started waiting on a gap
+
+        # Goodput, counted over whole recorded messages
+
+        self.rcv_bytes = 0
+        self.rcv_msgs = 0
+        self.rcv_start = None # First data frame
+        self.rcv_last = None # Last recorded message
+
+        # Setup node files, the messages to send are read from
+        # the node file as they are needed
+
+        self.source = read_messages(f"node{self.shac}.txt", mmap_size)
+        self.sink = OutputSink(f"node{self.shac}output.txt",
+                               thread=sink_thread)
+        if (self.next_pending() is None):
             self.exit = True
-        for x in send_dat:
-            m = re.match(r"(.*): (.*)", x)
-            if (m is None):
-                raise Exception("Malformed Node File!")
 
-            # Convert m to a hac
-            hac = self.to_hac(m[1])
+        log.info(log.NODE, "NODE #{} CREATED: \n {} \n", self.node_id, self)
+
+    def transmit(self, key: tuple, now: float):
+        """
+        (Re)send frame key and start its timer.
+        """
+        tries = self.tries.get(key, 0)
+        if (not tries):
+            self.sent_at[key] = now
+        deadline = now + (self.rto * (2 ** min(tries, 4)))
+        self.tries[key] = tries + 1
+        self.deadlines[key] = deadline
+        heappush(self.timers, (deadline, *key))
+        self.put_send(self.gateway_switch, copy(self.send_dat[key]))
+
+    def next_pending(self) -> Msg:
+        """
+        The message being sent, reading the next one from the node
+        file if there is none. None once the file is done.
+        """
+        if ((self.pending is None) and (self.source is not None)):
+            tmp = next(self.source, None)
+            if (tmp is None):
+                self.source = None
+                return None
+            dest, data = tmp
 
             # If priority is enabled, randomly
             # give frames priority
 
             pri = 0
-            if (priority):
+            if (self.priority):
                 pri = r.randint(0,1)
 
-            # Add messages to send queue
+            # The message is cut into fragments and numbered
+            # when it is sent
+
+            self.pending = Msg(pri, self.node_id, self.to_hac(dest),
+                               len(data), 0, 0, None)
+            self.pending._payload = data
+        return self.pending
+
+    def fill_window(self, now: float):
+        """
+        Send the next fragments of the pending messages while their
+        flow has room in its window, and the send buffer has room.
+        """
+        while (len(self.send_dat) < self.send_buf):
+            tmp = self.next_pending()
+            if (tmp is None):
+                return
+            flow = self.flows.get(tmp.dest, None)
+            if (flow is None):
+                flow = self.flows[tmp.dest] = Flow()
+            if (flow.next_n - flow.base >= self.window):
+                return
+
+            n = flow.next_n
+            flow.next_n += 1
+            if (self.drop_pending):
+
+                # The message was dropped, the reciever only needs
+                # to know where it ends
+
+                frag = Msg(tmp.priority, tmp.src, tmp.dest, 0, SKIP,
+                           n % SEQ_MOD, "")
+                self.pending = None
+                self.frag_at = 0
+                self.drop_pending = False
+            else:
 
-            tmp = Msg(pri, self.node_id, hac,
-                      len(m[2]), 0, next(m_count),
-                      m[2])
-            self.send_dat[tmp.ordering] = tmp
-            self.send_q.put((switch_out, tmp))
+                # Cut the next fragment off the message
 
-        print(f"NODE #{self.node_id} CREATED: \n {self} \n")
+                payload = tmp.payload
+                start = self.frag_at
+                end = _cut(payload, start, self.frag_size)
+                atype = MORE_FRAGS
+                if (end >= len(payload)):
+                    self.pending = None
+                    self.frag_at = 0
+                    atype = 0
+                else:
+                    self.frag_at = end
+                frag = Msg(tmp.priority, tmp.src, tmp.dest, end - start,
+                           atype, n % SEQ_MOD, None)
+                frag._payload = memoryview(payload)[start:end]
+            if (not (frag.atype & MORE_FRAGS)):
+                flow.ends.add(n)
+            flow.unacked[n] = frag
+            self.send_dat[(tmp.dest, n)] = frag
+            self.transmit((tmp.dest, n), now)
+
+    def give_up(self, key: tuple, now: float):
+        """
+        Stop sending data frame key, and send a SKIP notice in its
+        place so the reciever moves past it.
+        """
+        frag = self.send_dat[key]
+        tmp = Msg(frag.priority, frag.src, frag.dest, 0,
+                  SKIP | (frag.atype & MORE_FRAGS), frag.ordering, "")
+        self.flows[key[0]].unacked[key[1]] = tmp
+        self.send_dat[key] = tmp
+        self.tries[key] = 0
+        self.transmit(key, now)
+
+    def drop_msg(self, key: tuple, now: float):
+        """
+        Give up on the whole message frame key is part of. Its
+        unacked frames are replaced by SKIP notices, and if it is
+        still being sent only a notice of its end is sent.
+        """
+        dest, n = key
+        flow = self.flows[dest]
+        start = n
+        while ((start > flow.base) and (start - 1 not in flow.ends)):
+            start -= 1
+        end = n
+        while ((end < flow.next_n) and (end not in flow.ends)):
+            end += 1
+        if (end == flow.next_n):
+            self.drop_pending = True
+        for i in range(start, min(end + 1, flow.next_n)):
+            tmp = flow.unacked.get(i, None)
+            if ((tmp is not None) and tmp.size):
+                self.give_up((dest, i), now)
+
+    def done_with(self, key: tuple):
+        """
+        Stop tracking frame key and slide its window.
+        """
+        dest, n = key
+        flow = self.flows[dest]
+        flow.unacked.pop(n, None)
+        self.send_dat.pop(key, None)
+        self.deadlines.pop(key, None)
+        self.tries.pop(key, None)
+        self.sent_at.pop(key, None)
+        while ((flow.base < flow.next_n)
+               and (flow.base not in flow.unacked)):
+            flow.ends.discard(flow.base)
+            flow.base += 1
+
+    def find_sent(self, in_msg: Msg) -> tuple:
+        """
+        Find the unacked frame an ACK/NACK is for.
+        Returns None if there is none.
+        """
+        flow = self.flows.get(in_msg.src, None)
+        if (flow is None):
+            return None
+        n = flow.base + ((in_msg.ordering - flow.base) % SEQ_MOD)
+        tmp = flow.unacked.get(n, None)
+        if ((tmp is None) or (tmp.data != in_msg.data)):
+            return None
+        return (in_msg.src, n)
+
+    def record(self, sender: int, payload: bytes, now: float):
+        """
+        Write a whole message to the output file.
+        """
+        data = str(payload, "utf-8")
+        if (log.on(log.NODE)):
+            tmp = f"{sender}: {data}"
+            if (len(tmp) > 80):
+                tmp = f"{tmp[:80]}... ({len(payload)} bytes)"
+            log.info(log.NODE, ">| DATA '{}' RECORDED AT {}", tmp,
+                     self.node_id)
+        self.sink.write(f"{sender}: {data}\n")
+        self.metrics.inc("msgs_recorded")
+        self.metrics.inc("bytes_recorded", n=len(payload))
+        self.rcv_bytes += len(payload)
+        self.rcv_msgs += 1
+        self.rcv_last = now
+
+    def reassemble(self, sender: int, payload: bytes, more: bool,
+                   now: float):
+        """
+        Add the next in order fragment from sender to its message,
+        a payload of None is a fragment the sender gave up on.
+        """
+        if (payload is None):
+            log.warn(log.NODE, "XX NODE {} SKIPPED A FRAME FROM {}",
+                     self.node_id, sender)
+            self.metrics.inc("frames_skipped")
+            if (not more):
+                self.partial.pop(sender, None)
+                return
+            part = self.partial.setdefault(sender, Partial(now))
+            part.last = now
+            part.dropped = True
+            part.parts = []
+            return
+
+        part = self.partial.get(sender, None)
+        if (part is None):
+            if (not more):
+                self.record(sender, payload, now)
+                return
+            part = self.partial[sender] = Partial(now)
+        part.last = now
+
+        if (not part.dropped):
+            part.size += len(payload)
+            if (part.size > self.max_msg):
+                log.warn(log.NODE, "XX NODE {} DROPPED A MESSAGE"
+                         " FROM {}, OVER {} BYTES", self.node_id, sender,
+                         self.max_msg)
+                part.dropped = True
+                part.parts = []
+            else:
+                part.parts.append(bytes(payload))
+
+        if (not more):
+            del self.partial[sender]
+            if (not part.dropped):
+                self.record(sender, b''.join(part.parts), now)
+
+    def skip(self, sender: int, to: int, now: float):
+        """
+        Move the next ordering to record from sender on to to,
+        recording the buffered frames on the way and giving up on
+        the missing ones.
+        """
+        buf = self.rcv_buf.setdefault(sender, {})
+        m_count = self.rcv_counts.get(sender, 0)
+        while (m_count != to):
+            if (m_count in buf):
+                self.reassemble(sender, *buf.pop(m_count), now)
+            else:
+                log.warn(log.NODE, "XX NODE {} SKIPPED FRAME {} FROM {}",
+                         self.node_id, m_count, sender)
+                self.metrics.inc("frames_skipped")
+                part = self.partial.get(sender, None)
+                if (part is not None):
+                    part.dropped = True
+                    part.parts = []
+            m_count = (m_count + 1) % SEQ_MOD
+        self.rcv_counts[sender] = m_count
+        self.gaps.pop(sender, None)
+
+    def drain(self, sender: int, now: float):
+        """
+        Record the buffered frames from sender that are next in
+        order, and note when the others started waiting. Every
+        frame missing before them was sent before that.
+        """
+        buf = self.rcv_buf.setdefault(sender, {})
+        start = m_count = self.rcv_counts.get(sender, 0)
+        while (m_count in buf):
+            self.reassemble(sender, *buf.pop(m_count), now)
+            m_count = (m_count + 1) % SEQ_MOD
+        self.rcv_counts[sender] = m_count
+        if (not buf):
+            self.gaps.pop(sender, None)
+        elif ((m_count != start) or (sender not in self.gaps)):
+            self.gaps[sender] = now
+
+    def goodput(self) -> float:
+        """
+        Bytes per sec of recorded messages, from the first data
+        frame to the last recorded message. None before any.
+        """
+        if ((self.rcv_last is None) or
+                (self.rcv_last <= self.rcv_start)):
+            return None
+        return self.rcv_bytes / (self.rcv_last - self.rcv_start)
+
+    def check_done(self):
+        """
+        Check to see if all messages are sent, and no recieved
+        frames wait on a gap.
+        """
+        done = ((not self.send_dat) and (self.next_pending() is None)
+                and (not self.gaps))
+        if (done and (not self.exit)):
+            log.info(log.NODE, "-- NODE {} FINISHED", self.node_id)
+        self.exit = done
+
+    def tick(self) -> float:
+        now = self.clock()
+
+        # Resend every frame whose timer ran out
+
+        while (self.timers and (self.timers[0][0] <= now)):
+            deadline, *key = heappop(self.timers)
+            key = tuple(key)
+            if (self.deadlines.get(key, None) != deadline):
+                continue
+            if (self.tries[key] >= MAX_TRIES):
+                log.warn(log.NODE, "XX NODE {} GAVE UP ON '{}'",
+                         self.node_id, self.send_dat[key].data)
+                self.metrics.inc("given_up")
+                if (self.send_dat[key].size):
+                    self.drop_msg(key, now)
+                else:
+                    self.done_with(key)
+                continue
+            log.warn(log.NODE, "<> NODE {} RESENDING '{}'",
+                     self.node_id, self.send_dat[key].data)
+            self.metrics.inc("retransmits")
+            self.transmit(key, now)
 
-    def process_loop(self):
-        while(True):
+        # Free messages that stopped getting fragments
 
-            # Check to see if all messages are sent
+        for sender, part in self.partial.items():
+            if ((not part.dropped) and
+                    (part.last + REASSEMBLY_TIME <= now)):
+                log.warn(log.NODE, "XX NODE {} DROPPED A STALLED"
+                         " MESSAGE FROM {}", self.node_id, sender)
+                part.dropped = True
+                part.parts = []
 
-            self.send_dat_old = self.send_dat
-            self.send_dat = {k:v for k,v in
-                             self.send_dat.items()
-                             if not(v is None)}
-            if ((not self.send_dat) and (not self.exit)):
-                self.exit = True
-                print(f"-- NODE {self.node_id} FINISHED")
-            elif ((not self.exit)
-                  and (self.send_dat_old != self.send_dat)):
-                print(f"## NODE {self.node_id}"
-                      f" WATING FOR"
-                      f" {len(self.send_dat)} ACKs.")
+        # Skip frames the sender must have given up on
 
-            # Pull a message from a queue
+        for sender, since in list(self.gaps.items()):
+            if (since + self.gap_time <= now): # Same sum as the wait
+                m_count = self.rcv_counts.get(sender, 0)
+                self.skip(sender, min(self.rcv_buf[sender], key=lambda x:
+                                      (x - m_count) % SEQ_MOD), now)
+                self.drain(sender, now)
 
-            if (self.rcv_q.empty()):
-                sleep(SLEEP_TIME)
-                continue
-            in_port, in_msg = self.rcv_q.get()
+        self.fill_window(now)
+        self.check_done()
 
-            # Reject messages that are not for me
+        # Drop timers of frames that are already acked
 
-            if (in_msg.dest != self.node_id):
-                continue
+        while (self.timers and
+               (self.deadlines.get(tuple(self.timers[0][1:]), None)
+                != self.timers[0][0])):
+            heappop(self.timers)
 
-            # Check to see if the packet is an ack
+        wait = [x + self.gap_time for x in self.gaps.values()]
+        wait.extend(x.last + REASSEMBLY_TIME
+                    for x in self.partial.values() if (not x.dropped))
+        if (self.timers):
+            wait.append(self.timers[0][0])
+        if (not wait):
+            return None
+        return max(min(wait) - now, 0)
 
-            if (in_msg.size <= 0):
+    def process_msg(self, in_port: int, in_msg: Msg):
 
-                # Remove message from send buffer
+        # Reject messages that are not for me
+
+        if (in_msg.dest != self.node_id):
+            return
+
+        # Check to see if the packet is an ack
+
+        if ((in_msg.size <= 0) and
+                ((in_msg.atype & ~MORE_FRAGS) != SKIP)):
+            key = self.find_sent(in_msg)
+            if (key is None):
+                return
+
+            if (in_msg.atype == CRC_NACK):
+
+                # Resend right away
+
+                log.warn(log.NODE, "|< NACK FOR '{}' NOTED", in_msg.data)
+                self.metrics.inc("nack_retransmits")
+                self.transmit(key, self.clock())
+
+            elif (in_msg.atype == FIREWALL_NACK):
+                log.warn(log.NODE, "|< '{}' WAS FIREWALLED", in_msg.data)
+                self.metrics.inc("firewalled")
+                self.drop_msg(key, self.clock())
 
-                print(f"|< ACK FOR '{in_msg.data}' NOTED")
-                tmp = self.send_dat.get(in_msg.ordering, None)
-                if (tmp is None):
-                    continue
-                if (in_msg.data == tmp.data):
-                    self.send_dat[in_msg.ordering] = None
-                else:
-                    raise Exception("Invalid ACK!")
             else:
 
+                # Remove message from send buffer
 
-                # Message is a normal message
+                log.debug(log.NODE, "|< ACK FOR '{}' NOTED", in_msg.data)
+                if (self.send_dat[key].size):
+                    rtt = self.clock() - self.sent_at[key]
+                    self.rtts.append(rtt)
+                    self.metrics.observe("ack_rtt", rtt)
+                self.done_with(key)
+        else:
 
-                sender = in_msg.src
-                order = in_msg.ordering
-                data = in_msg.data
 
-                # Make sure message is in order
-                # Curently unu used
+            # Message is a normal message, or a SKIP notice that
+            # takes the place of one
 
-                m_count = self.rcv_counts.get(sender, 0)
-                #if (order > m_count):
-                #    self.rcv_q.appendleft(in_msg)
-                #elif (order == m_count):
+            sender = in_msg.src
+            order = in_msg.ordering
+            payload = in_msg.payload if (in_msg.size) else None
+            if ((self.rcv_start is None) and (payload is not None)):
+                self.rcv_start = self.clock()
 
-                self.rcv_counts[sender] = (m_count + 1)
-                with open(f"node{self.node_id}output.txt",
-                          "a") as f:
-                    tmp = f"{sender}: {data}"
-                    print(f">| DATA '{tmp}' RECORDED AT"
-                          f" {self.node_id}")
-                    f.write(tmp + '\n')
+            # Make sure message is in order. Frames ahead
+            # of the next expected one are buffered, frames
+            # behind it were already recorded
 
-                # Make ack
+            m_count = self.rcv_counts.get(sender, 0)
+            ahead = (order - m_count) % SEQ_MOD
+            if (ahead < SEQ_MOD - self.window):
+                now = self.clock()
 
-                in_msg.src = in_msg.dest
-                in_msg.dest = sender
-                in_msg.size = 0
-                self.send_q.put(
-                        (self.gateway_switch, in_msg))
+                # A frame window or more ahead means the sender
+                # gave up on the frames that far behind it
 
-            sleep(SLEEP_TIME)
+                if (ahead >= self.window):
+                    self.skip(sender, (order - self.window + 1)
+                              % SEQ_MOD, now)
+                self.rcv_buf.setdefault(sender, {})[order] = (
+                        payload, bool(in_msg.atype & MORE_FRAGS))
+                self.drain(sender, now)
 
+            # Make ack
 
+            in_msg.bounce(ACK)
+            self.put_send(self.gateway_switch, in_msg)
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    import os
+    import tempfile
+    from time import sleep
+
+    def take(dev: Node) -> list:
+        ret = []
+        for q in dev.out_qs.values():
+            while (not q.empty()):
+                ret.append(q.get_nowait())
+        return ret
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        with open("node1_1.txt", "w") as f:
+            f.write("1_2: a\n1_2: b\n1_2: c\n")
+        open("node1_2.txt", "w").close()
+        tmp = Node(1, 2, "1_1", window=2, rto=0.01)
+        tmp2 = Node(2, 1, "1_2")
+
+        # Only window frames go out, the reciever gets them
+        # in reverse order
+
+        tmp.tick()
+        out = take(tmp)
+        assert [x.data for x in out] == ["a", "b"]
+        for x in reversed(out):
+            tmp2.process_msg(2, x)
+        acks = take(tmp2)
+        assert len(acks) == 2
+
+        # The ACK for "a" is lost, so the window is stuck
+        # until it is resent
+
+        tmp.process_msg(1, acks[0])
+        tmp.tick()
+        assert not take(tmp)
+        sleep(0.02)
+        tmp.tick()
+        out = take(tmp)
+        assert [x.data for x in out] == ["a"]
+        tmp2.process_msg(2, out[0])
+        tmp.process_msg(1, take(tmp2)[0])
+        tmp.tick()
+        out = take(tmp)
+        assert [x.data for x in out] == ["c"]
+        tmp2.process_msg(2, out[0])
+        tmp.process_msg(1, take(tmp2)[0])
+        tmp.tick()
+        assert tmp.exit
+        tmp2.sink.close()
+        tmp.sink.close()
+        with open("node1_2output.txt") as f:
+            got = f.read()
+        print(f"output: {got!r}")
+        assert got == "17: a\n17: b\n17: c\n"
+
+        # Large payloads are cut into fragments (without splitting
+        # any utf-8 characters) and joined back together
+
+        big = "héllo wörld " * 100
+        with open("node1_3.txt", "w") as f:
+            f.write(f"1_4: {big}\n1_4: {'x' * 40}\n1_4: end\n")
+        open("node1_4.txt", "w").close()
+        tmp = Node(3, 4, "1_3", window=8, frag_size=16)
+        tmp2 = Node(4, 3, "1_4", max_msg=1000)
+        while (not tmp.exit):
+            tmp.tick()
+            out = take(tmp)
+            for x in out:
+                assert x.size <= 16
+                x.data # Every fragment decodes on its own
+            for x in reversed(out):
+                tmp2.process_msg(4, x)
+            for x in take(tmp2):
+                tmp.process_msg(3, x)
+        tmp2.tick()
+        tmp2.sink.close()
+        tmp.sink.close()
+        with open("node1_4output.txt") as f:
+            got = f.read()
+        print(f"goodput: {tmp2.goodput()}")
+        assert got == f"19: {'x' * 40}\n19: end\n"
+        assert tmp2.rcv_bytes == 43
+        assert not tmp2.partial
+
+        # A node that only recieves still wakes up to drop a
+        # stalled message
+
+        tmp2 = Node(4, 3, "1_4")
+        assert tmp2.tick() is None
+        tmp2.process_msg(4, Msg(0, 0x13, 0x14, 1, MORE_FRAGS, 0, "a"))
+        assert 0 < tmp2.tick() <= REASSEMBLY_TIME
+        tmp2.sink.close()
+
+        tmp = Node(3, 4, "1_3", window=8, frag_size=16)
+        tmp2 = Node(4, 3, "1_4")
+        while (not tmp.exit):
+            tmp.tick()
+            for x in take(tmp):
+                tmp2.process_msg(4, x)
+            for x in take(tmp2):
+                tmp.process_msg(3, x)
+        tmp2.sink.close()
+        tmp.sink.close()
+        with open("node1_4output.txt") as f:
+            assert f.readline() == f"19: {big}\n"
+
+        # Node files are parsed as they are read, mapped or not
+
+        with open("node1_5.txt", "w") as f:
+            for i in range(1000):
+                f.write(f"1_6: line {i}: é\n")
+        for size in [None, 0]:
+            tmp = read_messages("node1_5.txt", size)
+            assert next(tmp) == ("1_6", "line 0: é".encode())
+            assert len(list(tmp)) == 999
+        with open("node1_7.txt", "w") as f:
+            f.write("1_6: ok\nbad\n")
+        tmp = read_messages("node1_7.txt")
+        next(tmp)
+        try:
+            next(tmp)
+            assert False
+        except Exception as e:
+            print(f"error: {e}")
+
+        # Only send_buf frames are unacked at once
+
+        tmp = Node(5, 6, "1_5", send_buf=4, mmap_size=0)
+        tmp.tick()
+        assert len(take(tmp)) == 4
+        assert tmp.pending is None # Line 4 is not read yet
+        assert tmp.next_pending().data == "line 4: é"
+        tmp.sink.close()
+
+        # A frame that is always lost is given up on by the sender,
+        # and its SKIP notice moves the reciever past it. The message
+        # it is part of is dropped, and every other one recorded
+
+        big = "a" * 16 + "b" * 16 + "c" * 16
+        with open("node1_8.txt", "w") as f:
+            f.write(f"1_9: m0\n1_9: {big}\n1_9: m2\n1_9: m3\n")
+        for lost in range(3):
+            open("node1_9.txt", "w").close()
+            tmp = Node(8, 9, "1_8", window=4, rto=0.001, frag_size=16)
+            tmp2 = Node(9, 8, "1_9", window=4)
+            while (not (tmp.exit and tmp2.exit)):
+                tmp.tick()
+                tmp2.tick()
+                for x in take(tmp):
+                    if (x.data != big[lost * 16:lost * 16 + 16]):
+                        tmp2.process_msg(9, x)
+                for x in take(tmp2):
+                    tmp.process_msg(8, x)
+                sleep(0.001)
+            tmp2.sink.close()
+            tmp.sink.close()
+            with open("node1_9output.txt") as f:
+                got = f.read()
+            print(f"skipped fragment {lost}: {got!r}")
+            assert got == "24: m0\n24: m2\n24: m3\n"
+            assert tmp2.snapshot()["counters"]["frames_skipped"] == \
+                    {"": 1}
+            assert (not tmp2.partial) and (not tmp2.gaps)
+
+        # A firewall NACK for a fragment (here of a flooded copy, the
+        # reciever got the frame) drops the whole message, the rest
+        # of it is never sent and the reciever drops what it has
+
+        big = "a" * 16 + "b" * 16 + "c" * 16 + "d" * 16
+        with open("node1_10.txt", "w") as f:
+            f.write(f"1_11: {big}\n1_11: after\n")
+        open("node1_11.txt", "w").close()
+        tmp = Node(10, 11, "1_10", window=2, frag_size=16)
+        tmp2 = Node(11, 10, "1_11", window=2)
+        tmp.tick()
+        out = take(tmp)
+        for x in out:
+            tmp2.process_msg(11, copy(x))
+        take(tmp2) # The ACKs are late
+        assert len(tmp2.partial[0x1A].parts) == 2
+        out[1].bounce(FIREWALL_NACK)
+        tmp.process_msg(10, out[1])
+        sent = []
+        while (not (tmp.exit and tmp2.exit)):
+            tmp.tick()
+            tmp2.tick()
+            for x in take(tmp):
+                sent.append(x)
+                tmp2.process_msg(11, copy(x))
+            for x in take(tmp2):
+                tmp.process_msg(10, x)
+        tmp2.sink.close()
+        tmp.sink.close()
+        with open("node1_11output.txt") as f:
+            got = f.read()
+        print(f"firewalled: {got!r}")
+        assert got == "26: after\n"
+        assert [x.data for x in sent if (x.size)] == ["after"]
+        assert (not tmp2.partial) and (not tmp2.rcv_buf[0x1A])
+
+        # If the notice is lost too, the reciever skips the frame
+        # with a small window (the frames after it show the sender
+        # moved on) or a large one (it times out), and is not done
+        # until then
+
+        with open("node1_8.txt", "w") as f:
+            f.write("".join(f"1_9: m{i}\n" for i in range(8)))
+        for window in [2, 8]:
+            open("node1_9.txt", "w").close()
+            tmp = Node(8, 9, "1_8", window=window, rto=0.001)
+            tmp2 = Node(9, 8, "1_9", window=window, gap_time=0.5)
+            waited = False
+            while (not (tmp.exit and tmp2.exit)):
+                tmp.tick()
+                tmp2.tick()
+                waited |= (tmp.exit and (not tmp2.exit))
+                for x in take(tmp):
+                    if (x.size and (x.data != "m1")):
+                        tmp2.process_msg(9, x)
+                for x in take(tmp2):
+                    tmp.process_msg(8, x)
+                sleep(0.001)
+            tmp2.sink.close()
+            tmp.sink.close()
+            with open("node1_9output.txt") as f:
+                got = f.read()
+            print(f"skipped: {got!r}")
+            assert got == "".join(f"24: m{i}\n" for i in range(8)
+                                  if (i != 1))
+            assert tmp.snapshot()["counters"]["given_up"] == {"": 2}
+            assert waited == (window == 8)
+    finally:
+        os.chdir(cwd)
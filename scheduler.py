@@ -0,0 +1,150 @@
+"""
+Output queues of the NetDevice ports.
+
+Every port in ports_out has its own Scheduler and its own sender, so
+a slow or down link only holds up the frames queued for it.
+
+A Scheduler has a number of classes, frames go in the class of their
+priority (capped at the highest class) and higher classes are always
+sent first. Within a class flows (a src, dest pair) share the link
+by weighted fair queuing: every frame gets a finish tag of
+
+    max(virtual time, last tag of its flow) + cost / weight
+
+where cost is the frame's data plus one byte, and the frame with the
+lowest tag is sent next (self clocked, the virtual time is the tag
+of the last frame sent). Flows are weighted 1 unless given a weight.
+"""
+
+import threading as t
+from heapq import heappush, heappop
+from queue import Empty
+from msg import Msg
+
+CLASSES = 2 # Normal and priority frames
+WEIGHT = 1 # Weight of a flow without one
+
+class Scheduler():
+    """
+    The output queue of one port, safe to use from any thread.
+
+    get blocks until a frame is queued, the asyncio engine uses
+    get_nowait and waits for on_put to be called instead.
+    """
+
+    def __init__(self, classes: int = CLASSES,
+                 weights: dict = None) -> None:
+        if (classes < 1):
+            raise Exception("A scheduler needs at least one class!")
+        self.weights = dict() if (weights is None) else weights
+        self.heaps = [[] for i in range(classes)] # (tag, n, Msg)
+        self.vtime = [0] * classes
+        self.tags = [dict() for i in range(classes)] # flow → last tag
+        self.n = 0 # Frames queued so far, keeps ties in order
+        self.size = 0
+        self.lock = t.Lock()
+        self.ready = t.Condition(self.lock)
+        self.on_put = None # Called after every put
+
+    def __len__(self) -> int:
+        return self.size
+
+    def empty(self) -> bool:
+        return (self.size == 0)
+
+    def put(self, msg: Msg):
+        """
+        Queue a frame.
+        """
+        with self.lock:
+            c = min(max(int(msg.priority), 0), len(self.heaps) - 1)
+            flow = (msg.src, msg.dest)
+            tags = self.tags[c]
+            tag = (max(self.vtime[c], tags.get(flow, 0))
+                   + (len(msg.payload) + 1)
+                   / self.weights.get(flow, WEIGHT))
+            tags[flow] = tag
+            heappush(self.heaps[c], (tag, self.n, msg))
+            self.n += 1
+            self.size += 1
+            self.ready.notify()
+        if (self.on_put is not None):
+            self.on_put()
+
+    def _pop(self) -> Msg:
+        """
+        Take the next frame, the lock has to be held.
+        """
+        for c in range(len(self.heaps) - 1, -1, -1):
+            heap = self.heaps[c]
+            if (not heap):
+                continue
+            tag, n, msg = heappop(heap)
+            self.size -= 1
+
+            # Once a class is empty every flow starts over
+
+            if (heap):
+                self.vtime[c] = tag
+            else:
+                self.vtime[c] = 0
+                self.tags[c].clear()
+            return msg
+        raise Empty
+
+    def get_nowait(self) -> Msg:
+        """
+        Take the next frame, raises queue.Empty if there is none.
+        """
+        with self.lock:
+            return self._pop()
+
+    def get(self, timeout: float = None) -> Msg:
+        """
+        Wait up to timeout sec (forever if None) for the next frame,
+        raises queue.Empty if there is none.
+        """
+        with self.lock:
+            if (not self.ready.wait_for(lambda: self.size, timeout)):
+                raise Empty
+            return self._pop()
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    tmp = Scheduler()
+    for i in range(3):
+        tmp.put(Msg(0, 0x11, 0x21, 1, 0, i, "a"))
+    tmp.put(Msg(0, 0x12, 0x21, 1, 0, 0, "b"))
+    tmp.put(Msg(1, 0x13, 0x21, 1, 0, 0, "p"))
+    got = [tmp.get_nowait().data for i in range(len(tmp))]
+    print(f"order: {got}")
+
+    # Priority first, then the flows take turns
+
+    assert got == ["p", "a", "b", "a", "a"]
+    assert tmp.empty()
+    try:
+        tmp.get(timeout=0.01)
+        assert False
+    except Empty:
+        pass
+
+    # A flow with weight 2 gets twice the frames
+
+    tmp = Scheduler(1, {(0x11, 0x21): 2})
+    for i in range(4):
+        tmp.put(Msg(0, 0x11, 0x21, 1, 0, i, "a"))
+        tmp.put(Msg(0, 0x12, 0x21, 1, 0, i, "b"))
+    got = "".join(tmp.get_nowait().data for i in range(6))
+    print(f"weighted: {got}")
+    assert got.count("a") == 4
+
+    # Waiting senders wake up on put
+
+    job = t.Timer(0.01, tmp.put, [Msg(0, 1, 2, 1, 0, 0, "c")])
+    job.start()
+    tmp.get_nowait()
+    tmp.get_nowait()
+    assert tmp.get(timeout=2).data == "c"
@@ -0,0 +1,216 @@
+"""
+Runs a simulation split over several processes, so that it is not
+limited to one core by the GIL.
+
+The devices are split into groups that talk mostly among themselves
+(an edge switch and the nodes attached to it, every other switch on
+its own), and the groups are spread over the shards. Each shard is a
+forked process that runs its devices with either engine. Frames
+between devices of the same shard never leave the process, the links
+between shards are TCP/IP (see ShardTransport in transport.py).
+
+The parent process only coordinates. Every shard reports once its
+nodes are done, but keeps forwarding and acking frames for the other
+shards until the parent tells all of them to stop. The shards then
+send back the goodput counters of their nodes.
+
+Shards are created with fork, so the devices (open files, queues)
+never have to be pickled.
+"""
+
+import asyncio
+import threading as t
+import multiprocessing as mp
+from time import sleep
+from netdevice import SLEEP_TIME
+from aioengine import AsyncEngine
+from faults import FaultModel, FaultyTransport
+import transport as tr
+import log
+
+# Node attributes sent back to the parent
+
+STATS = ("exit", "rcv_bytes", "rcv_msgs", "rcv_start", "rcv_last",
+         "rtts")
+
+def partition(nodes: list, switches: list, shards: int) -> list:
+    """
+    Split the devices of a topology into at most shards lists.
+
+    Nodes stay with the switch they are attached to, and groups are
+    given to the shard with the fewest devices, largest first.
+    """
+    groups = {id(x): [x] for x in switches}
+    for node in nodes:
+        for sw in switches:
+            if (node.gateway_switch in sw.ports_in):
+                groups[id(sw)].append(node)
+                break
+        else:
+            groups[id(node)] = [node]
+
+    ret = [[] for i in range(min(shards, len(groups)))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(ret, key=len).extend(group)
+    return ret
+
+def _run_shard(devices: list, nodes: list, conn, engine: str):
+    """
+    The body of a shard process.
+    """
+    if (engine == "asyncio"):
+        async def until():
+            conn.send("done")
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, conn.recv)
+
+        asyncio.run(AsyncEngine(devices, nodes).run(until))
+    else:
+        ready = t.Event()
+        for dev in devices:
+            dev.start_device(ready)
+        ready.set()
+        while (not all(x.exit for x in nodes)):
+            sleep(SLEEP_TIME)
+        conn.send("done")
+        conn.recv()
+        for dev in devices:
+            dev.transport.close(dev)
+
+    # Processes started by multiprocessing skip atexit
+
+    for node in nodes:
+        node.sink.close()
+    for dev in devices:
+        if (dev.capture is not None):
+            dev.capture.close()
+    log.flush()
+    conn.send([[getattr(x, y) for y in STATS] for x in nodes])
+    conn.send([x.snapshot() for x in devices])
+    conn.close()
+
+def run(nodes: list, switches: list, shards: int,
+        engine: str = "thread", faults: FaultModel = None):
+    """
+    Run the devices over shards processes until every node is done.
+    The counters and metrics of the devices in this process are
+    updated with the ones from the shards. The links get the faults
+    of faults, if given.
+    """
+    groups = partition(nodes, switches, shards)
+    node_ids = {id(x) for x in nodes}
+    ctx = mp.get_context("fork")
+    registry = tr.PortRegistry()
+    jobs = []
+    for devices in groups:
+
+        # Ports listened on by this shard, and the ones other
+        # shards send to
+
+        local = {x for dev in devices for x in dev.ports_in}
+        remote = {x for other in groups if (other is not devices)
+                  for dev in other for x in dev.ports_out}
+        link = tr.ShardTransport(local, local & remote, registry)
+        if (faults):
+            link = FaultyTransport(link, faults)
+        for dev in devices:
+            dev.transport = link
+
+        # Bound before any shard starts, so the shards can send
+        # to each other right away and inherit the sockets
+
+        link.bind(devices)
+
+        watch = [x for x in devices if (id(x) in node_ids)]
+        conn, child = ctx.Pipe()
+        job = ctx.Process(target=_run_shard,
+                          args=(devices, watch, child, engine),
+                          daemon=True)
+        jobs.append((job, conn, devices, watch))
+    log.info(log.SIM, "STARTING {} SHARDS", len(jobs))
+    log.flush()
+    for job, conn, devices, watch in jobs:
+        job.start()
+    registry.close()
+
+    # Wait for every shard to finish, then stop them all
+
+    for job, conn, devices, watch in jobs:
+        conn.recv()
+    log.info(log.SIM, "SHUTING DOWN SHARDS")
+    for job, conn, devices, watch in jobs:
+        conn.send("stop")
+    for job, conn, devices, watch in jobs:
+        for node, stats in zip(watch, conn.recv()):
+            for x, y in zip(STATS, stats):
+                setattr(node, x, y)
+        for dev, snap in zip(devices, conn.recv()):
+            dev.metrics.final = snap
+        job.join()
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    from netdevice import NetDevice
+
+    class Dev(NetDevice):
+        pass
+
+    sw = Dev([1, 3, 8], [0, 2, 9])
+    sw2 = Dev([9], [8])
+    nodes = [Dev([0], [1]), Dev([2], [3])]
+    for x in nodes:
+        x.gateway_switch = x.ports_out[0]
+    groups = partition(nodes, [sw, sw2], 4)
+    print(f"shards: {groups}")
+    assert len(groups) == 2
+    assert [len(x) for x in groups] == [3, 1]
+    groups = partition(nodes, [sw, sw2], 1)
+    assert [id(x) for x in groups[0]] == \
+            [id(x) for x in [sw, *nodes, sw2]]
+
+    # A small simulation over 2 shards, the frames between the edge
+    # switches cross shards, and everything the shards counted comes
+    # back to this process
+
+    import os
+    import tempfile
+    import main
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        open("firewall.txt", "w").close()
+        sent = {"1_0": ["2_3", "1_2"], "2_1": ["1_0"],
+                "1_2": ["2_1", "2_1"], "2_3": []}
+        for me, dests in sent.items():
+            with open(f"node{me}.txt", "w") as f:
+                f.write("".join(f"{x}: {i} from {me}\n"
+                                for i, x in enumerate(dests)))
+        for engine in ("thread", "asyncio"):
+            sim = main.Main(4)
+            run(sim.nodes, sim.switches, 2, engine)
+            sim.close_sinks()
+            for node in sim.nodes:
+                got = [x for x, dests in sent.items()
+                       for y in dests if (y == node.shac)]
+                with open(f"node{node.shac}output.txt") as f:
+                    lines = f.read().splitlines()
+                print(f"{engine} {node.shac}: {lines}")
+                assert sorted(x.split(" from ")[1] for x in lines) == \
+                        sorted(got)
+                assert node.exit and (node.rcv_msgs == len(got))
+                assert node.snapshot()["counters"].get(
+                        "msgs_recorded", {}).get("", 0) == len(got)
+            tmp = [sum(x.snapshot()["counters"].get(
+                           "frames_received", {}).values())
+                   for x in sim.switches]
+            print(f"{engine} switch frames: {tmp}")
+            assert all(tmp)
+            assert all(x.metrics.final is not None
+                       for x in [*sim.nodes, *sim.switches])
+            for node in sim.nodes:
+                os.remove(f"node{node.shac}output.txt")
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,136 @@
+"""
+Buffered output files for nodes.
+
+A sink keeps its file open and collects records in memory. They are
+written out once SINK_BYTES are buffered, once the oldest record is
+SINK_TIME sec old, and when the sink is flushed or closed. With a
+writer thread the writes are done in the background, so the thread
+handing records to the sink never waits on the file system.
+"""
+
+import threading as t
+from time import time
+
+SINK_BYTES = 1 << 16 # Bytes to buffer before writing
+SINK_TIME = 0.5 # Max sec a record is buffered
+
+class OutputSink():
+    """
+    A buffered append only text file.
+    """
+
+    def __init__(self, path: str, max_bytes: int = SINK_BYTES,
+                 max_time: float = SINK_TIME,
+                 thread: bool = False) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.file = open(path, "w")
+        self.buf = []
+        self.size = 0
+        self.first = 0 # When the oldest buffered record was added
+        self.closed = False
+        self.lock = t.Condition()
+        self.writer = None
+        if (thread):
+            self.writer = t.Thread(target=self.write_loop,
+                                   daemon=True)
+            self.writer.start()
+
+    def _take(self) -> list:
+        """
+        Empty the buffer, must be called with the lock held.
+        """
+        ret = self.buf
+        self.buf = []
+        self.size = 0
+        return ret
+
+    def _write(self, records: list):
+        if (records):
+            self.file.write(''.join(records))
+            self.file.flush()
+
+    def write(self, record: str):
+        """
+        Add a record (a line, including its newline) to the file.
+        """
+        with self.lock:
+            if (not self.buf):
+                self.first = time()
+            self.buf.append(record)
+            self.size += len(record)
+            full = ((self.size >= self.max_bytes)
+                    or (time() - self.first >= self.max_time))
+            if (not full):
+                return
+            if (self.writer is not None):
+                self.lock.notify()
+                return
+            records = self._take()
+        self._write(records)
+
+    def write_loop(self):
+        """
+        Background thread writing the buffer when it is full
+        or old enough.
+        """
+        while (True):
+            with self.lock:
+                while ((not self.closed)
+                       and (self.size < self.max_bytes)
+                       and ((not self.buf) or
+                            (time() - self.first < self.max_time))):
+                    timeout = None if (not self.buf) else \
+                            self.first + self.max_time - time()
+                    self.lock.wait(timeout)
+                records = self._take()
+                closed = self.closed
+            self._write(records)
+            if (closed):
+                return
+
+    def flush(self):
+        """
+        Write everything buffered so far.
+        """
+        with self.lock:
+            records = self._take()
+        self._write(records)
+
+    def close(self):
+        """
+        Write everything buffered and close the file.
+        """
+        if (self.closed):
+            return
+        if (self.writer is not None):
+            with self.lock:
+                self.closed = True
+                self.lock.notify()
+            self.writer.join()
+        self.closed = True
+        self.flush()
+        self.file.close()
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    import os
+    import tempfile
+
+    for thread in [False, True]:
+        path = os.path.join(tempfile.mkdtemp(), "out.txt")
+        tmp = OutputSink(path, max_bytes=8, max_time=60,
+                         thread=thread)
+        tmp.write("1: a\n")
+        with open(path) as f:
+            assert f.read() == ""
+        tmp.write("2: b\n")
+        tmp.write("3: c\n")
+        tmp.close()
+        with open(path) as f:
+            out = f.read()
+        print(f"output: {out!r}")
+        assert out == "1: a\n2: b\n3: c\n"
@@ -0,0 +1,179 @@
+"""
+A spanning tree protocol for the switches of the HAC system.
+
+Every switch has a bridge id, the switch with the lowest one is the
+root of the tree. Switches send BPDU frames (atype BPDU, data
+"<root> <cost> <bridge>") on every port each HELLO_TIME sec and
+whenever their view changes. The cost is the number of links to the
+root. From the BPDUs it heard last on each port a switch picks:
+  - its root ports, the ports with the best path to the root
+  - blocked ports, links where the switch on the other end has a
+    better path to the root than this one
+  - designated ports, all others (including ports to nodes, which
+    never send BPDUs)
+Frames are only flooded on designated ports and one root port, and
+frames coming in on blocked ports are dropped, so frames never go
+around in circles however the switches are linked.
+
+Unlike the classic protocol, all ports whose BPDUs are the same
+(same root, cost and bridge) are root ports. These are parallel
+links to the same bridge, like the links of an edge switch to the
+core switches, which share a bridge id. A switch spreads its flows
+over them by a hash of the flow (equal cost multipath), see
+SpanningTree.pick.
+
+Switches hold their frames until the tree has not changed for
+FORWARD_DELAY sec, and forget a port's BPDU after MAX_AGE sec.
+"""
+
+BPDU = 0b11111110 # atype of a BPDU frame
+
+HELLO_TIME = 0.1 # Sec between BPDUs
+MAX_AGE = 1 # Sec a BPDU is kept, long enough for a busy switch
+FORWARD_DELAY = 0.05 # Sec the tree has to be stable to forward
+BRIDGE_ID = 1 << 16 # First bridge id given out
+CORE_ID = 1 # Bridge id shared by the core switches of Main
+
+_next_id = BRIDGE_ID
+
+def new_id() -> int:
+    """
+    A bridge id no other switch has, higher than CORE_ID.
+    """
+    global _next_id
+    _next_id += 1
+    return _next_id
+
+def flow_hash(src: int, dest: int) -> int:
+    """
+    The hash of a flow, the same in both directions so both take
+    the same path.
+    """
+    if (src > dest):
+        src, dest = dest, src
+    return ((src * 0x9E3779B1) ^ dest) * 0x85EBCA6B >> 7
+
+class SpanningTree():
+    """
+    The spanning tree state of one switch.
+
+    Ports are the input ports of the switch, every one is paired
+    with the output port of the same link.
+    """
+
+    def __init__(self, bridge: int) -> None:
+        self.bridge = bridge
+        self.heard = dict() # port → ((root, cost, bridge), when)
+        self.root = bridge
+        self.cost = 0
+        self.root_ports = [] # Sorted
+        self.blocked = set()
+        self.changed = None # When the roles last changed
+
+    def bpdu(self) -> str:
+        """
+        The data of the BPDUs of this switch.
+        """
+        return f"{self.root} {self.cost} {self.bridge}"
+
+    def hear(self, port: int, data: str, now: float) -> bool:
+        """
+        Note a BPDU that came in on a port.
+        Returns True if the roles changed.
+        """
+        root, cost, bridge = map(int, data.split())
+        self.heard[port] = ((root, cost, bridge), now)
+        return self.update(now)
+
+    def age(self, now: float) -> bool:
+        """
+        Forget old BPDUs. Returns True if the roles changed.
+        """
+        old = [x for x, (tmp, when) in self.heard.items()
+               if (now - when >= MAX_AGE)]
+        for x in old:
+            del self.heard[x]
+        if (self.changed is None):
+            self.changed = now # Starting up
+        return (bool(old) and self.update(now))
+
+    def update(self, now: float) -> bool:
+        """
+        Pick the roles of all ports from the BPDUs heard.
+        Returns True if they changed.
+        """
+        best = (self.bridge, 0, self.bridge)
+        root_ports = []
+        for port, (tmp, when) in self.heard.items():
+            tmp = (tmp[0], tmp[1] + 1, tmp[2])
+            if (tmp < best):
+                best = tmp
+                root_ports = [port]
+            elif ((tmp == best) and root_ports):
+                root_ports.append(port)
+        root, cost = best[:2]
+
+        # A link is blocked if the other end is closer to the root
+
+        mine = (root, cost, self.bridge)
+        blocked = {port for port, (tmp, when) in self.heard.items()
+                   if ((tmp <= mine) and (port not in root_ports))}
+
+        root_ports.sort()
+        if ((root, cost, root_ports, blocked) ==
+                (self.root, self.cost, self.root_ports, self.blocked)):
+            return False
+        self.root = root
+        self.cost = cost
+        self.root_ports = root_ports
+        self.blocked = blocked
+        self.changed = now
+        return True
+
+    def settled(self, now: float) -> bool:
+        """
+        Checks if frames may be forwarded, before the switch starts
+        running they always may.
+        """
+        return ((self.changed is None)
+                or (now - self.changed >= FORWARD_DELAY))
+
+    def pick(self, flow: int) -> int:
+        """
+        The root port a flow uses.
+        """
+        return self.root_ports[flow % len(self.root_ports)]
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+
+    # An edge switch linked to two core switches on ports 1 and 2,
+    # and to a node on port 0
+
+    tmp = SpanningTree(new_id())
+    assert tmp.settled(0)
+    tmp.age(0)
+    assert (not tmp.settled(0)) and tmp.settled(FORWARD_DELAY)
+    assert tmp.hear(1, f"{CORE_ID} 0 {CORE_ID}", 0.01)
+    assert tmp.hear(2, f"{CORE_ID} 0 {CORE_ID}", 0.01)
+    assert not tmp.hear(2, f"{CORE_ID} 0 {CORE_ID}", 0.02)
+    print(f"tree: {tmp.bpdu()} {tmp.root_ports} {tmp.blocked}")
+    assert (tmp.root_ports == [1, 2]) and (not tmp.blocked)
+    assert tmp.bpdu() == f"{CORE_ID} 1 {tmp.bridge}"
+    assert {tmp.pick(flow_hash(0x12, x)) for x in range(32)} == {1, 2}
+    assert flow_hash(0x12, 0x23) == flow_hash(0x23, 0x12)
+
+    # A switch with a shorter path to the root on port 3
+    # blocks that link
+
+    tmp.hear(3, f"{CORE_ID} 1 {tmp.bridge - 1}", 0.03)
+    assert tmp.blocked == {3}
+    tmp.hear(3, f"{CORE_ID} 2 {tmp.bridge - 1}", 0.03)
+    assert not tmp.blocked
+
+    # Ports go quiet
+
+    assert tmp.age(MAX_AGE + 0.1)
+    assert (tmp.root == tmp.bridge) and (not tmp.root_ports)
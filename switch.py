@@ -4,117 +4,376 @@ managed via simplex connections called ports.
 These are not to be confused with the TCP ip
 ports that support them.
 """
-from msg import Msg
-from netdevice import SLEEP_TIME, NetDevice
-from time import sleep, time
+from collections import OrderedDict
+from msg import Msg, peek
+from netdevice import NetDevice
+from firewall import ADD_RULE, DEL_RULE
+from stp import BPDU, HELLO_TIME, FORWARD_DELAY, SpanningTree, \
+        new_id, flow_hash
+import log
 
-# The amount of time to wait before clearing the ST
+# The amount of time an ST entry lives after its HAC was last seen
 
 ST_TIME = 8
 
-class Switch(NetDevice):
-    """
-    Represents a switch as defined in the project.
-    """
-    def __init__(self, ports_in: list,
-                 ports_out: list, global_blocks: list = [],
-                 local_blocks: list = []) -> None:
-        self.do_firewall = True # Enable firewall
-        super().__init__(ports_in, ports_out, global_blocks)
+# The max number of entries in the ST, enough for tens of
+# thousands of HACs with wide addresses (see hac.py)
 
-        # Setus up the Switching table(s)
-        # Twos tables are actualy used since
-        # the connecions are simplex
+ST_SIZE = 1 << 16
 
-        self.in_st = dict()
-        self.out_st = dict()
-        self.ito = dict()
-        self.oti = dict()
-        self.cach_time = time() + (ST_TIME)
-        self.init_switching_table()
+# The max number of frames held while the spanning tree settles
 
-        # Forward firewall rules to other switches.
+HOLD_SIZE = 1 << 12
 
-        for rule in local_blocks:
-            tmp = Msg(0, 0, 0, 0, 0b11111111, 0, rule)
-            self.send_q.put((-1, rule))
-            print(f"FORWARDING RULE: \n {rule} \n")
+class SwitchingTable():
+    """
+    Maps a HAC to the output port it was last seen behind.
 
-        print(f"SWITCH CREATED: \n {self} \n")
+    Entries are kept in the order they were last seen in, so expired
+    entries are always at the front and can be dropped one at a time
+    as new ones are learned. Lookups of expired entries miss.
+    """
+
+    def __init__(self, max_age: float = ST_TIME,
+                 max_size: int = ST_SIZE) -> None:
+        self.max_age = max_age
+        self.max_size = max_size
+        self.table = OrderedDict() # HAC → (port, last seen)
 
+    def __len__(self) -> int:
+        return len(self.table)
 
-    def init_switching_table(self):
+    def learn(self, hac: int, port: int, now: float):
         """
-        Creates a blank switching table
+        Note that hac can be reached via port.
         """
-        for i, o in zip(self.ports_in, self.ports_out):
-            self.in_st[i] = list()
-            self.out_st[o] = list()
-            self.ito[i] = o
-            self.oti[o] = i
+        self.table[hac] = (port, now)
+        self.table.move_to_end(hac)
 
-    def process_loop(self):
+        # Age out old entries, and the oldest if there is no room
 
-        # Get a message from the recieved queue
+        while (self.table):
+            old_port, seen = next(iter(self.table.values()))
+            if ((now - seen < self.max_age)
+                    and (len(self.table) <= self.max_size)):
+                break
+            self.table.popitem(last=False)
 
-        while(True):
-            if (self.rcv_q.empty()):
-                sleep(SLEEP_TIME)
-                continue
-            in_port, in_msg = self.rcv_q.get()
+    def lookup(self, hac: int, now: float) -> int:
+        """
+        Find the port for a HAC, None if it is unknown.
+        """
+        tmp = self.table.get(hac, None)
+        if (tmp is None):
+            return None
+        if (now - tmp[1] >= self.max_age):
+            del self.table[hac]
+            return None
+        return tmp[0]
 
-            # Check to see if the message is a self send
-            if (in_port == -1):
-                self.cach_time = 0
+class Switch(NetDevice):
+    """
+    Represents a switch as defined in the project.
 
-            # Check to see if we have seen this message before
+    Switches only look at the header of a frame, and send on the
+    bytes they recieved as they are (see msg.peek). By default the
+    crc of every frame is checked before it is forwarded (store and
+    forward), with cut_through set it is not, and frames with a bad
+    crc are only caught by the node they are for.
+
+    Switches may be linked in loops, they run a spanning tree (see
+    stp.py) to only use the links of a tree, and spread the flows
+    over parallel links to the root. Switches with the same bridge_id
+    act as one root, every switch linked to all of them spreads its
+    flows over them.
+    """
+    def __init__(self, ports_in: list,
+                 ports_out: list, global_blocks: list = [],
+                 local_blocks: list = [],
+                 st_time: float = ST_TIME,
+                 st_size: int = ST_SIZE,
+                 cut_through: bool = False,
+                 bridge_id: int = None) -> None:
+        super().__init__(ports_in, ports_out,
+                         [self.to_hac(x) for x in global_blocks],
+                         do_firewall=True) # Enable firewall
+        self.cut_through = cut_through
+
+        # Setus up the Switching table, it maps HACs to output
+        # ports. Since the connecions are simplex the input
+        # and output port of a link are paired up.
+
+        self.st = SwitchingTable(st_time, st_size)
+        self.ito = dict(zip(self.ports_in, self.ports_out))
+        self.oti = dict(zip(self.ports_out, self.ports_in))
+
+        # Spanning tree, frames are held until it settles
+
+        self.stp = SpanningTree(new_id() if (bridge_id is None)
+                                else bridge_id)
+        self.next_hello = 0
+        self.held = []
+
+        # Forward firewall rules to other switches.
 
-            if (time() >= self.cach_time):
-                print("%% ST HAS EXPIRED"
-                      ", CLEARING ST")
+        self.pushed = set() # Rules sent to other switches
+        for rule in local_blocks:
+            self.push_rule(rule)
 
-                # Wipe ST if time is up
+        log.info(log.SWITCH, "SWITCH CREATED: \n {} \n", self)
 
-                self.cach_time = time() + (ST_TIME)
-                self.init_switching_table()
+    def push_rule(self, rule: str, remove: bool = False) -> bool:
+        """
+        Send a firewall rule to the devices on every port, or tell
+        them to remove it. Rules that were already sent (or removed)
+        are not sent again. Returns False if nothing was sent.
+        """
+        if ((rule in self.pushed) != remove):
+            return False
+        if (remove):
+            self.pushed.discard(rule)
+        else:
+            self.pushed.add(rule)
+        tmp = Msg(0, 0, 0, 0, DEL_RULE if (remove) else ADD_RULE, 0,
+                  rule)
+        for port in self.ports_out:
+            self.put_send(port, tmp)
+        log.info(log.FIREWALL, "FORWARDING RULE: \n {}{} \n",
+                 "-" if (remove) else "", rule)
+        return True
+
+    def parse_frame(self, data: bytes) -> Msg:
+        return peek(data, not self.cut_through)
+
+    def gauges(self) -> dict:
+        ret = super().gauges()
+        ret["st_size"] = len(self.st)
+        ret["stp_held"] = len(self.held)
+        return ret
+
+    def hello(self, now: float):
+        """
+        Send a BPDU on every port.
+        """
+        self.next_hello = now + HELLO_TIME
+        tmp = Msg(1, 0, 0, 0, BPDU, 0, self.stp.bpdu())
+        for port in self.ports_out:
+            self.put_send(port, tmp)
+
+    def tick(self) -> float:
+        now = self.clock()
+        if (self.stp.age(now) or (now >= self.next_hello)):
+            self.hello(now)
+        wait = self.next_hello - now
+
+        # Forward the frames held while the tree was changing
+
+        if (self.held):
+            if (self.stp.settled(now)):
+                held = self.held
+                self.held = []
+                for x in held:
+                    self.process_msg(*x)
+            else:
+                wait = min(wait, self.stp.changed + FORWARD_DELAY - now)
+        return max(wait, 0)
 
+    def uplink(self, flow: int) -> int:
+        """
+        The output port of the root port a flow uses.
+        """
+        return self.ito[self.stp.pick(flow)]
+
+    def process_msg(self, in_port: int, in_msg: Msg):
+        now = self.clock()
+        stp = self.stp
+
+        # Spanning tree frames are not forwarded
+
+        if (in_msg.atype == BPDU):
+            if (stp.hear(in_port, in_msg.data, now)):
+                log.info(log.SWITCH, "SPANNING TREE CHANGED: ROOT {}"
+                         " COST {} ROOT PORTS {} BLOCKED {}", stp.root,
+                         stp.cost, stp.root_ports, sorted(stp.blocked))
+                self.hello(now)
+            return
+        if (in_port in stp.blocked):
+            self.metrics.inc("stp_drops", in_port)
+            return
+        if (not stp.settled(now)):
+            if (len(self.held) >= HOLD_SIZE):
+                self.metrics.inc("stp_drops", in_port)
             else:
+                self.held.append((in_port, in_msg))
+            return
 
-                # Calculate inbound tables
+        back_port = self.ito.get(in_port, None)
+        from_root = in_port in stp.root_ports
+        flow = flow_hash(in_msg.src, in_msg.dest)
 
-                tmp_in = self.in_st[in_port]
-                tmp_out = self.out_st[self.ito[in_port]]
+        # Add inbound connection to the switching table,
+        # self sends (in_port -1) come from this switch
 
-                # Add inbound connection to the switching
-                # tables
+        if (back_port is not None):
+            self.st.learn(in_msg.src, back_port, now)
 
-                tmp_in.append(in_msg.src)
-                tmp_out.append(in_msg.src)
+        # Find port to forward frame to the requested HAC
 
-            # Find port to forward frame to the requested HAC
+        send_port = self.st.lookup(in_msg.dest, now)
+        to_root = False
+        if (send_port is not None):
+            tmp = self.oti[send_port]
+            if (tmp in stp.blocked):
+                send_port = None
+            elif (tmp in stp.root_ports):
+                to_root = True
+                send_port = self.uplink(flow)
 
-            dest = in_msg.dest
-            send_port = None
-            for k, o in self.out_st.items():
-                if (dest in o):
-                    send_port = k
-                    break
+        # If there is no known route, flood on the tree
 
-            # If there is no known route, flood
+        if (send_port is None):
+            log.debug(log.SWITCH, "~~ SWITCH IS FLOODING")
+            self.metrics.inc("floods")
+            for port in self.ports_out:
 
-            if (send_port is None):
-                print("~~ SWITCH IS FLOODING")
-                for port in self.ports_out:
+                # Dont send on input port, and only on one root port
 
-                    # Dont send on input port
+                tmp = self.oti[port]
+                if ((port == back_port) or (tmp in stp.blocked)
+                        or (tmp in stp.root_ports)):
+                    continue
+                self.put_send(port, in_msg)
+            if (stp.root_ports and (not from_root)):
+                self.put_send(self.uplink(flow), in_msg)
 
-                    if (port == in_port):
-                        continue
-                    self.send_q.put((port, in_msg))
+        # Frames for a HAC on the link they came from
+        # have already reached it
 
+        elif ((send_port == back_port) or (to_root and from_root)):
+            self.metrics.inc("filtered")
+            return
 
-            # otherwise forward single frame
+        # otherwise forward single frame
 
-            else:
-                print("@@ SWITCH IS SENDING DIRECT")
-                self.send_q.put((send_port, in_msg))
+        else:
+            log.debug(log.SWITCH, "@@ SWITCH IS SENDING DIRECT")
+            self.metrics.inc("forwards", send_port)
+            self.put_send(send_port, in_msg)
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    tmp = SwitchingTable(max_age=10, max_size=2)
+    tmp.learn(0x11, 1, 0)
+    tmp.learn(0x12, 2, 5)
+    assert tmp.lookup(0x11, 5) == 1
+    assert tmp.lookup(0x13, 5) is None
+
+    # Entries age out one at a time
+
+    assert tmp.lookup(0x11, 10) is None
+    assert tmp.lookup(0x12, 10) == 2
+
+    # The oldest entry makes room for new ones
+
+    tmp.learn(0x13, 3, 11)
+    tmp.learn(0x14, 4, 12)
+    print(f"table: {tmp.table}")
+    assert len(tmp) == 2
+    assert tmp.lookup(0x12, 12) is None
+    assert tmp.lookup(0x14, 12) == 4
+
+    # Repeated rules are only sent once
+
+    tmp = Switch([0, 1], [2, 3], local_blocks=["1_2", "1_3", "1_2"])
+    assert tmp.gauges()["send_q"] == 4
+    assert not tmp.push_rule("1_3")
+    assert tmp.push_rule("1_3", remove=True)
+    assert not tmp.push_rule("1_3", remove=True)
+    assert tmp.gauges()["send_q"] == 6
+
+    # Frames are forwarded as the bytes that came in, bad ones are
+    # NACKed unless the switch cuts through
+
+    from msg import dumps
+    data = dumps(Msg(0, 0x12, 0x23, 1, 0, 0, "a"))
+    bad = data[:-1] + b"b"
+    for cut in [False, True]:
+        tmp = Switch([0, 1], [2, 3], cut_through=cut)
+        for x in [data, bad]:
+            tmp.recieve_frame(0, x)
+            tmp.process_msg(*tmp.rcv_q.get_nowait())
+        out = [tmp.out_qs[3].get_nowait()]
+        assert dumps(out[0]) is data
+        if (cut):
+            out.append(tmp.out_qs[3].get_nowait())
+            assert dumps(out[1]) is bad
+        else:
+            nack = tmp.out_qs[2].get_nowait()
+            assert (nack.atype == 1) and (nack.dest == 0x12)
+        assert tmp.gauges()["send_q"] == 0
+
+    # The data of forwarded frames is never decoded, it need not
+    # even be utf-8
+
+    tmp2 = Msg(0, 0x12, 0x23, 2, 0, 0, None)
+    tmp2._payload = b"\xff\xfe"
+    for cut in [False, True]:
+        tmp = Switch([0, 1], [2, 3], cut_through=cut)
+        tmp.recieve_frame(0, dumps(tmp2))
+        tmp.process_msg(*tmp.rcv_q.get_nowait())
+        out = tmp.next_batch(3)
+        assert (len(out) == 1) and (out[0]._data is None)
+
+    # Two edge switches linked directly and by two core switches
+    # with the same bridge id. The direct link is blocked, and the
+    # flows between the edges are spread over the cores.
+
+    import des
+    import stp
+
+    got = []
+    host_a = NetDevice([100], [101])
+    host_b = NetDevice([200], [201])
+    host_b.process_msg = lambda port, msg: (
+            got.append(msg.ordering) if (msg.atype != BPDU) else None)
+    edge_a = Switch([101, 111, 121, 131], [100, 110, 120, 130])
+    edge_b = Switch([201, 211, 221, 130], [200, 210, 220, 131])
+    cores = [Switch([110, 210], [111, 211], bridge_id=stp.CORE_ID),
+             Switch([120, 220], [121, 221], bridge_id=stp.CORE_ID)]
+    sim = des.DesEngine([host_a, host_b, edge_a, edge_b, *cores])
+
+    def send():
+        for i in range(64):
+            host_a.put_send(101, Msg(0, 0x10 + i, 0xF0, 1, 0, i, "x"))
+
+    sim.at(0.5, send)
+    sim.run(1)
+    tree = [x.stp for x in [edge_a, edge_b]]
+    print(f"trees: {[(x.root_ports, x.blocked) for x in tree]}")
+    print(f"cores: {[x.snapshot()['counters'] for x in cores]}")
+    assert (tree[0].root_ports == [111, 121]) and (not tree[0].blocked)
+    assert (tree[1].root_ports == [211, 221]) and (tree[1].blocked ==
+                                                   {130})
+    assert sorted(got) == list(range(64))
+    assert all(x.snapshot()["counters"]["floods"][""] > 16 for x in cores)
+
+    # A frame blocked by a network rule is NACKed, and the NACK gets
+    # past the host rule further on
+
+    got = []
+    host_a = NetDevice([300], [301])
+    host_a.process_msg = lambda port, msg: (
+            got.append(msg.atype) if (msg.atype != BPDU) else None)
+    host_b = NetDevice([320], [321])
+    edge = Switch([301, 311], [300, 310])
+    core = Switch([310, 321], [311, 320], ["2_0"], ["1_2"])
+    sim = des.DesEngine([host_a, host_b, edge, core])
+    sim.at(0.5, host_a.put_send, 301,
+           Msg(0, 0x12, 0x21, 1, 0, 0, "x"))
+    sim.run(1)
+    blocks = [sum(x.snapshot()["counters"].get(
+            "firewall_blocks", {}).values()) for x in [edge, core]]
+    print(f"firewall: {blocks} {got}")
+    assert (blocks == [0, 1]) and (got == [0b00000010])
@@ -0,0 +1,561 @@
+"""
+The links that carry frames between NetDevices.
+
+A transport is shared by all devices of a simulation. It is opened
+once for each device, which makes it start delivering the frames
+that arrive on the device's ports_in to recieve_frame/recieve_msg,
+and it is asked to send batches of Msg objects on a port in
+ports_out. Every method has an async version used by the asyncio
+engine.
+
+Three transports are provided:
+  - TcpTransport → every port is a loopback TCP/IP port, picked by
+    the OS and published in a PortRegistry
+  - InProcTransport → frames are handed straight to the device
+    listening on the port, without any sockets
+  - ShardTransport → InProcTransport for the ports of devices in
+    the same process and TcpTransport for the rest, see shard.py
+"""
+
+from copy import copy
+from time import time
+import asyncio
+import selectors
+import socket
+import threading as t
+from msg import dumps
+from framing import FrameReader, FrameWriter, RECV_SIZE
+
+TCP_HOST = "127.0.0.1" # Address used for the TCP/IP connections
+
+# Backoff in sec between reconnect attempts to a port that is down
+
+BACKOFF_MIN = 0.01
+BACKOFF_MAX = 1
+
+class PortRegistry():
+    """
+    Maps the simplex ports of a simulation to the TCP/IP ports
+    listening for them.
+
+    Sockets are bound to a port picked by the OS, so simulations
+    running side by side (or right after each other) never collide.
+    bind can be done for every port before any device starts, the
+    socket is then kept until the device listening on the port
+    takes it. Forked processes inherit the sockets and the mapping.
+    """
+
+    def __init__(self) -> None:
+        self.tcp_ports = dict() # port → TCP/IP port
+        self.socks = dict() # port → bound socket not taken yet
+
+    def bind(self, port: int):
+        """
+        Bind and listen on a new socket for a port.
+        """
+        if (port in self.tcp_ports):
+            return
+        tmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tmp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tmp.bind((TCP_HOST, 0))
+        tmp.listen()
+        self.socks[port] = tmp
+        self.tcp_ports[port] = tmp.getsockname()[1]
+
+    def take(self, port: int) -> socket.socket:
+        """
+        Get the listening socket of a port, binding it if needed.
+        """
+        self.bind(port)
+        tmp = self.socks.pop(port, None)
+        if (tmp is None):
+            raise Exception(f"Port {port:x} is already listened on!")
+        return tmp
+
+    def lookup(self, port: int) -> int:
+        """
+        The TCP/IP port of a port, None if nothing listens on it.
+        """
+        return self.tcp_ports.get(port, None)
+
+    def release(self, port: int):
+        """
+        Forget a port once its socket is closed.
+        """
+        self.tcp_ports.pop(port, None)
+        tmp = self.socks.pop(port, None)
+        if (tmp is not None):
+            tmp.close()
+
+    def close(self):
+        """
+        Close the sockets no device has taken.
+        """
+        for tmp in self.socks.values():
+            tmp.close()
+        self.socks.clear()
+
+REGISTRY = PortRegistry() # Used by TcpTransports not given one
+
+class ConnPool():
+    """
+    Keeps one long lived connection open for each output port.
+
+    If a port can not be reached it is not retried until its
+    backoff has passed, the backoff doubles on every failure.
+    """
+
+    def __init__(self, registry: PortRegistry = REGISTRY) -> None:
+        self.registry = registry
+        self.conns = dict()
+        self.writers = dict() # port → FrameWriter
+        self.backoff = dict()
+        self.retry_at = dict()
+        self.closed = False
+
+    def ready(self, port: int) -> bool:
+        """
+        Checks if a connection to the port may be attempted.
+        """
+        return (time() >= self.retry_at.get(port, 0))
+
+    def failed(self, port: int):
+        """
+        Drop the connection to a port and back off.
+        """
+        conn = self.conns.pop(port, None)
+        if (conn is not None):
+            conn.close()
+        tmp = min(self.backoff.get(port, BACKOFF_MIN / 2) * 2,
+                  BACKOFF_MAX)
+        self.backoff[port] = tmp
+        self.retry_at[port] = time() + tmp
+
+    def connected(self, port: int, conn):
+        """
+        Store a new connection to a port.
+        """
+
+        # A sender thread may connect while the pool is closed
+
+        if (self.closed):
+            conn.close()
+            return
+        self.conns[port] = conn
+        self.backoff.pop(port, None)
+        self.retry_at.pop(port, None)
+
+    def writer(self, port: int) -> FrameWriter:
+        """
+        The buffer frames to a port are encoded into, only one
+        thread sends on a port at a time.
+        """
+        tmp = self.writers.get(port, None)
+        if (tmp is None):
+            tmp = self.writers[port] = FrameWriter()
+        return tmp
+
+    def get(self, port: int) -> socket.socket:
+        """
+        Get the connection for a port, connecting if needed.
+        Returns None if the port can not be reached right now.
+        """
+        conn = self.conns.get(port, None)
+        if (conn is not None):
+            return conn
+        tcp_port = self.registry.lookup(port)
+        if ((tcp_port is None) or (not self.ready(port))):
+            return None
+        try:
+            conn = socket.create_connection((TCP_HOST, tcp_port))
+        except OSError:
+            self.failed(port)
+            return None
+        self.connected(port, conn)
+        return conn
+
+    async def aget(self, port: int) -> asyncio.StreamWriter:
+        """
+        Async version of get.
+        """
+        writer = self.conns.get(port, None)
+        if ((writer is not None) or (not self.ready(port))):
+            return writer
+        tcp_port = self.registry.lookup(port)
+        if (tcp_port is None):
+            return None
+        try:
+            reader, writer = await asyncio.open_connection(
+                    TCP_HOST, tcp_port)
+        except OSError:
+            self.failed(port)
+            return None
+        self.connected(port, writer)
+        return writer
+
+    def close(self):
+        """
+        Close all connections.
+        """
+        self.closed = True
+        for conn in list(self.conns.values()):
+            conn.close()
+        self.conns.clear()
+
+class Transport():
+    """
+    The interface every transport implements.
+    """
+
+    def bind(self, devices: list):
+        """
+        Get ready to open the devices, before any of them is.
+        """
+        pass
+
+    def open(self, dev):
+        """
+        Start delivering frames that arrive on dev.ports_in.
+        """
+        ...
+
+    def send(self, dev, next_hop: int, msgs: list) -> bool:
+        """
+        Send a list of Msg objects from dev on the port next_hop.
+        Returns False if the port can not be reached right now.
+        """
+        ...
+
+    def close(self, dev):
+        """
+        Stop delivering frames to dev and release its resources.
+        """
+        ...
+
+    async def aopen(self, dev):
+        """
+        Async version of open.
+        """
+        self.open(dev)
+
+    async def asend(self, dev, next_hop: int, msgs: list) -> bool:
+        """
+        Async version of send.
+        """
+        return self.send(dev, next_hop, msgs)
+
+class TcpTransport(Transport):
+    """
+    Sends frames over loopback TCP/IP, the TCP/IP port of a
+    simplex port is found in registry.
+
+    If ports is given only those ports are listened on.
+    """
+
+    def __init__(self, ports: set = None,
+                 registry: PortRegistry = REGISTRY) -> None:
+        self.ports = ports
+        self.registry = registry
+
+    def ports_in(self, dev) -> list:
+        """
+        The ports of dev that are listened on.
+        """
+        if (self.ports is None):
+            return dev.ports_in
+        return [x for x in dev.ports_in if (x in self.ports)]
+
+    def bind(self, devices: list):
+        """
+        Bind the listening sockets of all devices at once, so every
+        port is known before the first frame is sent.
+        """
+        for dev in devices:
+            for port in self.ports_in(dev):
+                self.registry.bind(port)
+
+    def listen(self, dev):
+        """
+        Start Listening ports for incoming messages.
+        """
+        dev.sockets_in = []
+        for port in self.ports_in(dev):
+            tmp = self.registry.take(port)
+            tmp.setblocking(False)
+            dev.sockets_in.append((port, tmp))
+
+    def recieve_loop(self, dev, sel: selectors.BaseSelector):
+        """
+        On an indepenednt thread, wait on all listening and
+        accepted sockets of a device at once and service whichever
+        are ready. Frames are added to the rcv_q for processing by
+        another thread.
+
+        The data of a listening socket is its port, the data of an
+        accepted one is (port, FrameReader).
+        """
+        while(True):
+            for key, events in sel.select():
+                sock = key.fileobj
+                if (key.data is None):
+
+                    # Woken up by close
+
+                    for x in list(sel.get_map().values()):
+                        if (isinstance(x.data, tuple)):
+                            x.fileobj.close()
+                    sel.close()
+                    for x in dev.wake:
+                        x.close()
+                    return
+                elif (isinstance(key.data, int)):
+                    try:
+                        conn, addr = sock.accept()
+                    except OSError:
+                        continue
+                    conn.setblocking(False)
+                    sel.register(conn, selectors.EVENT_READ,
+                                 (key.data, FrameReader()))
+                    continue
+
+                port, reader = key.data
+                try:
+                    size = reader.recv_into(sock)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    size = 0
+                if (not size):
+                    sel.unregister(sock)
+                    sock.close()
+                    continue
+                for data in reader.frames():
+                    # print(f'<- {data}')
+                    dev.recieve_frame(port, data)
+
+    def open(self, dev):
+        self.listen(dev)
+        dev.pool = ConnPool(self.registry)
+        sel = selectors.DefaultSelector()
+        for port, sock in dev.sockets_in:
+            sel.register(sock, selectors.EVENT_READ, port)
+        dev.wake = socket.socketpair()
+        sel.register(dev.wake[1], selectors.EVENT_READ, None)
+        t.Thread(target=self.recieve_loop, args=(dev, sel),
+                 daemon=True).start()
+
+    def send(self, dev, next_hop: int, msgs: list) -> bool:
+        next_sock = dev.pool.get(next_hop)
+        if (next_sock is None):
+            return False
+        try:
+            next_sock.sendall(dev.pool.writer(next_hop).pack(msgs))
+        except OSError:
+            dev.pool.failed(next_hop)
+            return False
+        return True
+
+    def close(self, dev):
+        if (hasattr(dev, "wake")):
+            dev.wake[0].send(b"\0")
+        for port, sock in getattr(dev, "sockets_in", []):
+            sock.close()
+        for server in getattr(dev, "servers", []):
+            server.close()
+        for port in self.ports_in(dev):
+            self.registry.release(port)
+        dev.pool.close()
+
+    async def _handle(self, dev, port: int,
+                      reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        """
+        Async version of recieve_loop.
+        """
+        frames = FrameReader()
+        try:
+            while (True):
+                data = await reader.read(RECV_SIZE)
+                if (not data):
+                    break
+                frames.feed(data)
+                for data in frames.frames():
+                    dev.recieve_frame(port, data)
+        except (OSError, asyncio.CancelledError):
+
+            # Cancelled when the loop shuts down while the other
+            # end (in another process) is still connected
+
+            pass
+        finally:
+            writer.close()
+
+    async def aopen(self, dev):
+        dev.servers = []
+        dev.pool = ConnPool(self.registry)
+        for port in self.ports_in(dev):
+            def handle(reader, writer, dev=dev, port=port):
+                return self._handle(dev, port, reader, writer)
+            server = await asyncio.start_server(
+                    handle, sock=self.registry.take(port))
+            dev.servers.append(server)
+
+    async def asend(self, dev, next_hop: int, msgs: list) -> bool:
+        writer = await dev.pool.aget(next_hop)
+        if (writer is None):
+            return False
+        try:
+
+            # The transport may keep what it could not send yet,
+            # so it gets a copy of the buffer
+
+            writer.write(bytes(dev.pool.writer(next_hop).pack(msgs)))
+            await writer.drain()
+        except OSError:
+            dev.pool.failed(next_hop)
+            return False
+        return True
+
+class InProcTransport(Transport):
+    """
+    Hands frames directly to the device listening on a port.
+
+    All devices have to live in the same process (and, with the
+    asyncio engine, on the same event loop). Msg objects are copied
+    so that the sender and reciever never share one. With raw set
+    every frame goes through dumps/loads like it would on a wire.
+    """
+
+    def __init__(self, raw: bool = False) -> None:
+        self.raw = raw
+        self.registry = dict() # port → listening device
+
+    def open(self, dev):
+        for port in dev.ports_in:
+            self.registry[port] = dev
+
+    def send(self, dev, next_hop: int, msgs: list) -> bool:
+        peer = self.registry.get(next_hop, None)
+        if (peer is None):
+            return False
+        for msg in msgs:
+            if (self.raw):
+                peer.recieve_frame(next_hop, dumps(msg))
+            else:
+                peer.recieve_msg(next_hop, copy(msg))
+        return True
+
+    def close(self, dev):
+        for port in dev.ports_in:
+            if (self.registry.get(port, None) is dev):
+                del self.registry[port]
+
+class ShardTransport(Transport):
+    """
+    The transport of one process of a sharded simulation.
+
+    Frames for a port in local are handed over in process, all
+    others go over TCP/IP. Only the ports in remote_in (the ones
+    with a sender in another process) are listened on.
+    """
+
+    def __init__(self, local: set, remote_in: set,
+                 registry: PortRegistry = REGISTRY) -> None:
+        self.local = set(local)
+        self.inproc = InProcTransport()
+        self.tcp = TcpTransport(set(remote_in), registry)
+
+    def bind(self, devices: list):
+        self.tcp.bind(devices)
+
+    def open(self, dev):
+        self.inproc.open(dev)
+        self.tcp.open(dev)
+
+    def send(self, dev, next_hop: int, msgs: list) -> bool:
+        if (next_hop in self.local):
+            return self.inproc.send(dev, next_hop, msgs)
+        return self.tcp.send(dev, next_hop, msgs)
+
+    def close(self, dev):
+        self.inproc.close(dev)
+        self.tcp.close(dev)
+
+    async def aopen(self, dev):
+        self.inproc.open(dev)
+        await self.tcp.aopen(dev)
+
+    async def asend(self, dev, next_hop: int, msgs: list) -> bool:
+        if (next_hop in self.local):
+            return self.inproc.send(dev, next_hop, msgs)
+        return await self.tcp.asend(dev, next_hop, msgs)
+
+def make(name: str) -> Transport:
+    """
+    Create a transport by name.
+    """
+    if (name == "tcp"):
+        return TcpTransport()
+    elif (name == "inproc"):
+        return InProcTransport()
+    elif (name == "inproc-raw"):
+        return InProcTransport(raw=True)
+    raise Exception(f"Unknown transport {name}!")
+
+def unit_test():
+    """
+    Tests this unit.
+    """
+    from msg import Msg
+    from netdevice import NetDevice
+
+    for link in [InProcTransport(), InProcTransport(raw=True)]:
+        tmp = NetDevice([10], [11], transport=link)
+        tmp2 = NetDevice([11], [10], transport=link)
+        link.open(tmp2)
+        out = Msg(0, 0x12, 0x13, 4, 0, 0, "test")
+        assert link.send(tmp, 11, [out])
+        assert not link.send(tmp2, 10, [out])
+        port, got = tmp2.rcv_q.get_nowait()
+        print(f"output: {got}")
+        assert (port == 11) and (got.data == "test")
+        assert got is not out
+        link.close(tmp2)
+        assert not link.send(tmp, 11, [out])
+
+    # One thread recieves on all ports of a device
+
+    link = TcpTransport()
+    tmp = NetDevice([920, 921, 922], [923], transport=link)
+    tmp2 = NetDevice([923], [920, 921, 922], transport=link)
+    link.open(tmp)
+    link.open(tmp2)
+    for port in [922, 920, 921]:
+        assert link.send(tmp2, port, [Msg(0, 0x12, 0x13, 1, 0, 0,
+                                          str(port))])
+    got = sorted(tmp.rcv_q.get(timeout=2) for i in range(3))
+    assert [x[0] for x in got] == [920, 921, 922]
+    link.close(tmp)
+    link.close(tmp2)
+    assert link.registry.lookup(920) is None
+
+    # A connection made after its pool closed is not kept
+
+    tmp = ConnPool()
+    tmp.close()
+    a, b = socket.socketpair()
+    tmp.connected(920, a)
+    assert (not tmp.conns) and (a.fileno() == -1)
+    b.close()
+
+    # Every simulation gets its own TCP/IP ports for the same
+    # simplex ports, so they can run side by side
+
+    tmp = PortRegistry()
+    tmp2 = PortRegistry()
+    tmp.bind(930)
+    tmp2.bind(930)
+    print(f"tcp ports: {tmp.lookup(930)} {tmp2.lookup(930)}")
+    assert tmp.lookup(930) != tmp2.lookup(930)
+    tmp.close()
+    tmp2.close()
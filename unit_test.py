@@ -9,3 +9,81 @@ def test_msg():
 def test_device():
     import netdevice
     netdevice.unit_test()
+
+def test_aioengine():
+    import aioengine
+    aioengine.unit_test()
+
+def test_framing():
+    import framing
+    framing.unit_test()
+
+def test_transport():
+    import transport
+    transport.unit_test()
+
+def test_switch():
+    import switch
+    switch.unit_test()
+
+def test_batch():
+    import pytest
+    pytest.importorskip("numpy")
+    import batch
+    batch.unit_test()
+
+def test_sink():
+    import sink
+    sink.unit_test()
+
+def test_node():
+    import node
+    node.unit_test()
+
+def test_shard():
+    import shard
+    shard.unit_test()
+
+def test_hac():
+    import hac
+    hac.unit_test()
+
+def test_bench():
+    import bench
+    bench.unit_test()
+
+def test_metrics():
+    import metrics
+    metrics.unit_test()
+
+def test_log():
+    import log
+    log.unit_test()
+
+def test_firewall():
+    import firewall
+    firewall.unit_test()
+
+def test_scheduler():
+    import scheduler
+    scheduler.unit_test()
+
+def test_des():
+    import des
+    des.unit_test()
+
+def test_capture():
+    import capture
+    capture.unit_test()
+
+def test_crc():
+    import crc
+    crc.unit_test()
+
+def test_faults():
+    import faults
+    faults.unit_test()
+
+def test_stp():
+    import stp
+    stp.unit_test()